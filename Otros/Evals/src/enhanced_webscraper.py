@@ -2,15 +2,19 @@ import pandas as pd
 import requests
 import re
 import os
+import sys
 import time
 import io
 from urllib.parse import urlparse
 from bs4 import BeautifulSoup
 import logging
-import pdfplumber
-from PyPDF2 import PdfReader
 import warnings
 
+# Normalizador de texto y extracción de PDF compartidos con python/questionsMongo.py y python/marketing.py
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..', '..', 'python')))
+from text_normalizer import normalize_text
+from pdf_extract import backend_order, extract_page_texts
+
 # Configurar logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
@@ -38,47 +42,21 @@ def extract_doc_id_from_input(input_text):
 
 def extract_text_from_pdf_content(pdf_content):
     """
-    Extrae texto de contenido PDF usando múltiples métodos.
+    Extrae texto de contenido PDF con el backend más rápido instalado
+    (pdf_extract: PyMuPDF, pypdf, PyPDF2 o pdfplumber, con respaldo por documento).
     """
     try:
-        # Método 1: pdfplumber (preferido)
-        logger.info("Intentando extracción con pdfplumber...")
-        pdf_stream = io.BytesIO(pdf_content)
-        text_content = []
-        
-        with pdfplumber.open(pdf_stream) as pdf:
-            for page_num, page in enumerate(pdf.pages[:10]):  # Limitar a 10 páginas
-                text = page.extract_text()
-                if text and text.strip():
-                    text_content.append(text.strip())
-        
-        if text_content:
-            full_text = '\n'.join(text_content)
-            logger.info(f"Texto extraído con pdfplumber: {len(full_text)} caracteres")
-            return full_text
-            
-    except Exception as e:
-        logger.warning(f"Error con pdfplumber: {e}")
-    
-    try:
-        # Método 2: PyPDF2 (respaldo)
-        logger.info("Intentando extracción con PyPDF2...")
-        pdf_stream = io.BytesIO(pdf_content)
-        reader = PdfReader(pdf_stream)
-        text_content = []
-        
-        for page_num, page in enumerate(reader.pages[:10]):  # Limitar a 10 páginas
-            text = page.extract_text()
-            if text and text.strip():
-                text_content.append(text.strip())
+        logger.info(f"Extrayendo texto del PDF (backends: {', '.join(backend_order())})...")
+        pages = extract_page_texts(pdf_bytes=pdf_content, max_pages=10)  # Limitar a 10 páginas
+        text_content = [text.strip() for _, text, _ in pages if text and text.strip()]
         
         if text_content:
             full_text = '\n'.join(text_content)
-            logger.info(f"Texto extraído con PyPDF2: {len(full_text)} caracteres")
+            logger.info(f"Texto extraído del PDF: {len(full_text)} caracteres")
             return full_text
             
     except Exception as e:
-        logger.warning(f"Error con PyPDF2: {e}")
+        logger.warning(f"Error extrayendo texto del PDF: {e}")
     
     return None
 
@@ -158,6 +136,9 @@ def clean_extracted_text(text):
     if not text:
         return ""
     
+    # Reparar doble codificación, caracteres inválidos y de control (normalizador compartido)
+    text = normalize_text(text)
+    
     # Eliminar caracteres especiales de encoding
     text = text.replace('Â', '').replace('â€œ', '"').replace('â€', '"').replace('â€™', "'")
     text = text.replace('\x00', '').replace('\x0c', '')
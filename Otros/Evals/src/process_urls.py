@@ -6,10 +6,14 @@ import re
 from urllib.parse import urlparse
 import logging
 import io
-import fitz  # PyMuPDF para PDFs
 from PIL import Image
 import tempfile
 import os
+import sys
+
+# Extracción de PDF compartida con python/questionsMongo.py y python/marketing.py (PyMuPDF si está instalado)
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..', '..', 'python')))
+from pdf_extract import extract_page_texts
 
 # Configurar logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -22,21 +26,13 @@ def is_pdf_url(url):
 
 def extract_text_from_pdf(content):
     """
-    Extrae texto de contenido PDF usando PyMuPDF
+    Extrae texto de contenido PDF con el backend más rápido instalado (ver python/pdf_extract.py)
     """
     try:
-        # Crear un documento PDF desde bytes
-        pdf_document = fitz.open(stream=content, filetype="pdf")
-        
         text_content = []
         # Extraer texto de las primeras páginas (máximo 2 para obtener 75 palabras)
-        max_pages = min(2, pdf_document.page_count)
-        
-        for page_num in range(max_pages):
-            page = pdf_document[page_num]
-            text = page.get_text()
-            
-            if text.strip():
+        for _, text, _ in extract_page_texts(pdf_bytes=content, max_pages=2):
+            if text and text.strip():
                 text_content.append(text)
                 
             # Si ya tenemos suficiente texto, parar
@@ -44,8 +40,6 @@ def extract_text_from_pdf(content):
             if total_words >= 100:  # Un poco más para asegurar 75 palabras limpias
                 break
         
-        pdf_document.close()
-        
         # Unir todo el texto
         full_text = ' '.join(text_content)
         
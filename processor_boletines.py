@@ -9,13 +9,63 @@ JSON data for MongoDB storage.
 import asyncio
 import json
 import logging
+import os
+import sys
 from typing import Dict, List, Any, Optional, Tuple
 from datetime import datetime
 import openai
 from src.initialize import get_openai_client, get_mongodb_client
 
+# Shared per-request timing records with the rest of the Python tier (python/perf_metrics.py)
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "python"))
+import llm_budget  # noqa: E402
+from bulk_writer import BulkWriteBuffer  # noqa: E402
+import perf_metrics  # noqa: E402
+from perf_metrics import RequestTimer  # noqa: E402
+
 logger = logging.getLogger(__name__)
 
+MODEL = "gpt-5-mini"
+# Documents extracted at once by process_documents_batch / process_collection_documents
+# (1 = one after another). Calls are paced by the RPM/TPM budget in python/llm_budget.py.
+CONCURRENCY = int(os.getenv("NORMATIVE_UPDATES_CONCURRENCY", "1"))
+# 429 answers retried per document before the extraction counts as an error
+RATE_LIMIT_RETRIES = int(os.getenv("NORMATIVE_UPDATES_RATE_LIMIT_RETRIES", "5"))
+# Answer size reserved in the token budget until the real usage is known
+ESTIMATED_OUTPUT_TOKENS = 2000
+# Documents per cursor batch in process_collection_documents (0 = 8 per concurrent
+# extraction). A batch must be consumed within the 10 min cursor idle timeout.
+CURSOR_BATCH_SIZE = int(os.getenv("NORMATIVE_UPDATES_CURSOR_BATCH_SIZE", "0"))
+# Field with the document text; the only one read besides _id
+TEXT_FIELD = "contenido"
+
+METRICS_PIPELINE = "normative_updates"
+
+
+def _timing_fields(result: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+    """Attributes of an extraction result for its timing record."""
+    if not result:
+        return {"ok": False}
+    tokens = result.get("extraction_metadata", {}).get("tokens", {})
+    return {
+        "ok": True,
+        "initiatives": len(result.get("iniciativas", [])),
+        "prompt_tokens": tokens.get("input"),
+        "output_tokens": tokens.get("output"),
+    }
+
+
+def _add_result_stats(stats: Dict[str, Any], result: Dict[str, Any], count_tokens: bool = True):
+    """Adds the initiatives (and token usage) of one extraction result to ``stats``."""
+    initiatives = result.get("iniciativas", [])
+    stats["initiatives_found"] += len(initiatives)
+    if initiatives:
+        stats["documents_with_initiatives"] += 1
+
+    # Add token usage
+    if count_tokens and "tokens" in result.get("extraction_metadata", {}):
+        stats["total_tokens"] += result["extraction_metadata"]["tokens"]["total"]
+
 
 class LegalInitiativesProcessor:
     """Processes documents to extract normative updates and their metadata."""
@@ -171,7 +221,7 @@ class LegalInitiativesProcessor:
                     - tipo_iniciativa: Clasificar según la lista cerrada proporcionada (tipo de norma)
                     - titulo_iniciativa: Título o descripción breve de la norma
                     - sector: Clasificar según la lista cerrada
-                    - subsector: Determinar mediante razonamiento según el contenido y los ejemplos. Formato exacto: "{sector} - {Subsector_determinado_por_ia}"
+                    - subsector: Determinar mediante razonamiento según el contenido y los ejemplos. Formato exacto: "{{sector}} - {{Subsector_determinado_por_ia}}"
                     - tema: Determinar mediante razonamiento y ejemplos (no lista cerrada)
                     - marco_geografico: Clasificar según la lista cerrada
                     - fuente: Origen de la publicación según la lista cerrada
@@ -292,6 +342,47 @@ class LegalInitiativesProcessor:
 
         return prompt
 
+    async def _create_completion(self, prompt: str, document_text: str, document_id: str = None):
+        """Call the model within its RPM/TPM budget, retrying 429 responses."""
+        budget = llm_budget.for_model(MODEL)
+        estimate = llm_budget.estimate_tokens(
+            prompt, document_text, output_tokens=ESTIMATED_OUTPUT_TOKENS
+        )
+        for attempt in range(RATE_LIMIT_RETRIES + 1):
+            reservation = await budget.acquire(estimate)
+            perf_metrics.add(budget_wait_ms=reservation.waited_ms)
+            try:
+                response = await self.client.chat.completions.create(
+                    model=MODEL,
+                    messages=[
+                        {
+                            "role": "system",
+                            "content": prompt,
+                        },
+                        {
+                            "role": "user",
+                            "content": "<DOCUMENTO>" + document_text + "</DOCUMENTO>",
+                        },
+                    ],
+                    seed=1,
+                    response_format={"type": "json_object"},
+                    metadata={"prompt": "normative_updates"},
+                )
+            except openai.RateLimitError as e:
+                budget.rate_limited(llm_budget.retry_after_seconds(e))
+                perf_metrics.add(rate_limited=1)
+                if attempt == RATE_LIMIT_RETRIES:
+                    raise
+                logger.warning(
+                    f"Rate limited on document {document_id or 'unknown'}, "
+                    f"retry {attempt + 1}/{RATE_LIMIT_RETRIES}"
+                )
+                continue
+            budget.succeeded(
+                reservation, response.usage.total_tokens if response.usage else None
+            )
+            return response
+
     async def extract_initiatives(
         self, document_text: str, document_id: str = None
     ) -> Optional[Dict[str, Any]]:
@@ -315,22 +406,7 @@ class LegalInitiativesProcessor:
             prompt = self._build_prompt(document_text)
 
             # Call gpt-5-mini
-            response = await self.client.chat.completions.create(
-                model="gpt-5-mini",
-                messages=[
-                    {
-                        "role": "system",
-                        "content": prompt,
-                    },
-                    {
-                        "role": "user",
-                        "content": "<DOCUMENTO>" + document_text + "</DOCUMENTO>",
-                    },
-                ],
-                seed=1,
-                response_format={"type": "json_object"},
-                metadata={"prompt": "normative_updates"},
-            )
+            response = await self._create_completion(prompt, document_text, document_id)
 
             # Parse response
             result_text = response.choices[0].message.content
@@ -370,13 +446,14 @@ class LegalInitiativesProcessor:
             return None
 
     async def process_documents_batch(
-        self, documents: Dict[str, Any]
+        self, documents: Dict[str, Any], concurrency: int = None
     ) -> Tuple[Dict[str, Any], Dict[str, Any]]:
         """
         Process a batch of documents to extract normative updates before MongoDB upload.
 
         Args:
             documents: Dictionary of documents with doc_id as key
+            concurrency: Documents extracted at once (defaults to CONCURRENCY)
 
         Returns:
             Tuple of (processed_documents, extraction_stats)
@@ -391,50 +468,62 @@ class LegalInitiativesProcessor:
             "total_tokens": 0,
         }
 
-        for doc_id, doc in documents.items():
-            stats["documents_processed"] += 1
+        concurrency = CONCURRENCY if concurrency is None else concurrency
 
-            # Get document text (from page_content or contenido field)
-            text = (
-                doc.page_content
-                if hasattr(doc, "page_content")
-                else doc.metadata.get("contenido", "")
-            )
+        # Results come back in document order, so stats accumulate as in a sequential run
+        results = llm_budget.map_ordered(
+            self._extract_batch_document, documents.items(), concurrency
+        )
+        async for doc_id, doc, has_text, result in results:
+            stats["documents_processed"] += 1
 
-            if not text:
+            if not has_text:
                 logger.warning(f"Document {doc_id} has no text content")
                 stats["errors"] += 1
                 continue
 
-            # Extract initiatives
-            result = await self.extract_initiatives(text, doc_id)
-
             if result:
                 # Add initiatives to document metadata
                 doc.metadata["legal_initiatives"] = result
 
                 # Update stats
-                initiatives = result.get("iniciativas", [])
-                stats["initiatives_found"] += len(initiatives)
-                if initiatives:
-                    stats["documents_with_initiatives"] += 1
-
-                # Add token usage
-                if "tokens" in result.get("extraction_metadata", {}):
-                    stats["total_tokens"] += result["extraction_metadata"]["tokens"][
-                        "total"
-                    ]
+                _add_result_stats(stats, result)
             else:
                 stats["errors"] += 1
                 logger.warning(f"Failed to extract initiatives from document {doc_id}")
 
         return documents, stats
 
+    async def _extract_batch_document(
+        self, item: Tuple[str, Any]
+    ) -> Tuple[str, Any, bool, Optional[Dict[str, Any]]]:
+        """Extract the initiatives of one (doc_id, doc) pair of process_documents_batch."""
+        doc_id, doc = item
+
+        # Get document text (from page_content or contenido field)
+        text = (
+            doc.page_content
+            if hasattr(doc, "page_content")
+            else doc.metadata.get("contenido", "")
+        )
+        if not text:
+            return doc_id, doc, False, None
+
+        # Extract initiatives
+        timer = RequestTimer(METRICS_PIPELINE, document_id=doc_id, doc_chars=len(text))
+        perf_metrics.bind(timer)
+        timer.mark("start")
+        result = await self.extract_initiatives(text, doc_id)
+        timer.mark("extraction")
+        timer.finish(**_timing_fields(result))
+        return doc_id, doc, True, result
+
     async def process_collection_documents(
         self,
         collection_name: str,
         date_filter: Optional[Dict] = None,
         limit: int = None,
+        concurrency: int = None,
     ) -> Dict[str, Any]:
         """
         Process all documents in a collection to extract normative updates.
@@ -442,7 +531,8 @@ class LegalInitiativesProcessor:
         Args:
             collection_name: Name of the MongoDB collection to process
             date_filter: Optional date filter for documents
-            limit: Optional limit on number of documents to process
+            limit: Optional limit on number of documents to extract
+            concurrency: Documents extracted at once (defaults to CONCURRENCY)
 
         Returns:
             Summary statistics of the processing
@@ -455,6 +545,7 @@ class LegalInitiativesProcessor:
             "errors": 0,
             "total_tokens": 0,
             "processing_time": None,
+            "bulk_write": None,
         }
 
         start_time = datetime.now()
@@ -467,54 +558,49 @@ class LegalInitiativesProcessor:
             if date_filter:
                 query.update(date_filter)
 
-            # Get documents
-            cursor = collection.find(query)
+            # Documents that already have initiatives are only counted
+            processed = await self._count_processed(collection, query)
+            stats["documents_processed"] += processed["documents"]
+            stats["initiatives_found"] += processed["initiatives"]
+            stats["documents_with_initiatives"] += processed["with_initiatives"]
+
+            # Stream the pending ones: filtered on the server, _id and text only
+            concurrency = CONCURRENCY if concurrency is None else concurrency
+            batch_size = CURSOR_BATCH_SIZE or max(16, 8 * concurrency)
+            documents = collection.find(
+                {**query, "legal_initiatives": {"$exists": False}},
+                {"_id": 1, TEXT_FIELD: 1},
+                batch_size=batch_size,
+            )
             if limit:
-                cursor = cursor.limit(limit)
-
-            documents = await cursor.to_list(length=None)
-
-            logger.info(f"Processing {len(documents)} documents from {collection_name}")
-
-            # Process each document
-            for doc in documents:
-                stats["documents_processed"] += 1
-
-                # Skip if already processed
-                if "legal_initiatives" in doc:
-                    existing_initiatives = doc.get("legal_initiatives", {}).get(
-                        "iniciativas", []
-                    )
-                    stats["initiatives_found"] += len(existing_initiatives)
-                    if existing_initiatives:
-                        stats["documents_with_initiatives"] += 1
-                    continue
-
-                # Extract initiatives
-                result = await self.extract_initiatives(doc)
-
-                if result:
-                    # Update document with initiatives
-                    await collection.update_one(
-                        {"_id": doc["_id"]}, {"$set": {"legal_initiatives": result}}
-                    )
-
-                    # Update stats
-                    initiatives = result.get("iniciativas", [])
-                    stats["initiatives_found"] += len(initiatives)
-                    if initiatives:
-                        stats["documents_with_initiatives"] += 1
-
-                    # Add token usage
-                    if "tokens" in result.get("extraction_metadata", {}):
-                        stats["total_tokens"] += result["extraction_metadata"][
-                            "tokens"
-                        ]["total"]
-                else:
-                    stats["errors"] += 1
-
-                # Add small delay to avoid rate limits
-                await asyncio.sleep(0.1)
+                documents = documents.limit(limit)
+
+            logger.info(
+                f"Processing documents from {collection_name} without initiatives "
+                f"({processed['documents']} already processed, concurrency {concurrency})"
+            )
+
+            # Results are written behind in unordered bulk_writes; leaving the block
+            # (also on an error) flushes what is still buffered
+            writes = BulkWriteBuffer(collection, pipeline=METRICS_PIPELINE)
+            try:
+                async with writes:
+
+                    async def process(doc):
+                        return await self._process_stored_document(writes, collection_name, doc)
+
+                    # Process each document; results come back in document order
+                    async for doc, result in llm_budget.map_ordered(
+                        process, documents, concurrency
+                    ):
+                        stats["documents_processed"] += 1
+
+                        if result:
+                            _add_result_stats(stats, result)
+                        else:
+                            stats["errors"] += 1
+            finally:
+                stats["bulk_write"] = writes.stats()
 
         except Exception as e:
             logger.error(f"Error processing collection {collection_name}: {e}")
@@ -522,9 +608,67 @@ class LegalInitiativesProcessor:
 
         # Calculate processing time
         stats["processing_time"] = (datetime.now() - start_time).total_seconds()
+        logger.info(f"Rate budget for {MODEL}: {llm_budget.for_model(MODEL).stats()}")
 
         return stats
 
+    async def _process_stored_document(
+        self, writes: BulkWriteBuffer, collection_name: str, doc: Dict[str, Any]
+    ) -> Tuple[Dict[str, Any], Optional[Dict[str, Any]]]:
+        """Extract the initiatives of one collection document and queue their write."""
+        document_id = str(doc["_id"])
+        text = doc.get(TEXT_FIELD) or ""
+
+        # Extract initiatives
+        timer = RequestTimer(
+            METRICS_PIPELINE,
+            collection=collection_name,
+            document_id=document_id,
+            doc_chars=len(text),
+        )
+        perf_metrics.bind(timer)
+        timer.mark("start")
+        result = await self.extract_initiatives(text, document_id)
+        timer.mark("extraction")
+
+        if result:
+            # Update document with initiatives (may flush a full buffer)
+            await writes.update_one(
+                {"_id": doc["_id"]}, {"$set": {"legal_initiatives": result}}
+            )
+            timer.mark("mongo_buffer")
+
+        timer.finish(**_timing_fields(result))
+        return doc, result
+
+    async def _count_processed(self, collection, query: Dict) -> Dict[str, int]:
+        """Count the documents matching ``query`` that already have initiatives, and the
+        initiatives they hold, without transferring the documents."""
+        initiatives = "$legal_initiatives.iniciativas"
+        pipeline = [
+            {"$match": {**query, "legal_initiatives": {"$exists": True}}},
+            {
+                "$project": {
+                    "_id": 0,
+                    "count": {
+                        "$cond": [{"$isArray": initiatives}, {"$size": initiatives}, 0]
+                    },
+                }
+            },
+            {
+                "$group": {
+                    "_id": None,
+                    "documents": {"$sum": 1},
+                    "initiatives": {"$sum": "$count"},
+                    "with_initiatives": {"$sum": {"$cond": [{"$gt": ["$count", 0]}, 1, 0]}},
+                }
+            },
+        ]
+        result = await collection.aggregate(pipeline).to_list(length=1)
+        if not result:
+            return {"documents": 0, "initiatives": 0, "with_initiatives": 0}
+        return {key: result[0][key] for key in ("documents", "initiatives", "with_initiatives")}
+
     async def get_initiatives_summary(self, collection_name: str) -> Dict[str, Any]:
         """
         Get a summary of all normative updates in a collection.
@@ -588,7 +732,7 @@ class LegalInitiativesProcessor:
 
 
 async def process_bocg_initiatives(
-    date_start: str = None, date_end: str = None
+    date_start: str = None, date_end: str = None, concurrency: int = None
 ) -> Dict[str, Any]:
     """
     Main function to process BOCG documents for normative updates.
@@ -596,6 +740,7 @@ async def process_bocg_initiatives(
     Args:
         date_start: Start date for filtering (YYYY-MM-DD format)
         date_end: End date for filtering (YYYY-MM-DD format)
+        concurrency: Documents extracted at once (defaults to CONCURRENCY)
 
     Returns:
         Processing statistics
@@ -610,7 +755,7 @@ async def process_bocg_initiatives(
 
     # Process BOCG collection
     stats = await processor.process_collection_documents(
-        collection_name="BOCG", date_filter=date_filter
+        collection_name="BOCG", date_filter=date_filter, concurrency=concurrency
     )
 
     # Get summary
@@ -0,0 +1,219 @@
+"""
+Admission control for analysis jobs in worker mode.
+
+Only a few analyses can run at once on one box (see Otros/Docs/Refactoring&Escalado/
+scaling_plan.md), so instead of an unbounded executor queue the worker puts jobs
+through an AdmissionScheduler:
+
+- a fixed number of execution threads (the worker's concurrency);
+- a bounded queue. When it is full, submit() fails immediately with
+  AdmissionRejected carrying a retry-after estimate, instead of piling up work
+  until the box runs out of memory;
+- priority classes: queued "interactive" jobs (analyze-norma clicks) are always
+  dispatched before "bulk" jobs, and bulk jobs may only fill part of the queue so
+  interactive requests still find room under load;
+- per-tenant fairness: within a class tenants are served round-robin, and each
+  tenant has its own cap on queued jobs.
+
+Cancelling the Future returned by submit() while the job is still queued removes
+it from the queue at once.
+
+Queue wait times feed the perf_metrics histograms (pipeline "scheduler") and
+stats() reports depth, running jobs and admitted/rejected counters.
+"""
+
+import logging
+import os
+import threading
+import time
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import Future
+
+import perf_metrics
+
+PRIORITIES = ("interactive", "bulk")
+DEFAULT_PRIORITY = "interactive"
+
+MAX_QUEUE = int(os.getenv("ANALYSIS_MAX_QUEUE", "20"))
+MAX_QUEUE_PER_TENANT = int(os.getenv("ANALYSIS_MAX_QUEUE_PER_TENANT", "5"))
+# Share of the queue bulk jobs may occupy; the rest is kept for interactive requests
+BULK_QUEUE_SHARE = float(os.getenv("ANALYSIS_BULK_QUEUE_SHARE", "0.5"))
+# Service time assumed for the retry-after hint until real jobs have been measured
+INITIAL_SERVICE_MS = 8000
+
+
+class AdmissionRejected(Exception):
+    """Job refused at submission. ``code`` is QUEUE_FULL or TENANT_QUEUE_FULL."""
+
+    def __init__(self, code, retry_after_ms):
+        super().__init__(f"{code} (retry after {retry_after_ms} ms)")
+        self.code = code
+        self.retry_after_ms = retry_after_ms
+
+
+def normalize_priority(priority):
+    return priority if priority in PRIORITIES else DEFAULT_PRIORITY
+
+
+class _Job:
+    __slots__ = ("fn", "tenant", "priority", "future", "enqueued_at")
+
+    def __init__(self, fn, tenant, priority):
+        self.fn = fn
+        self.tenant = tenant
+        self.priority = priority
+        self.future = Future()
+        self.enqueued_at = time.perf_counter()
+
+
+class AdmissionScheduler:
+    """Bounded, prioritised, tenant-fair job queue served by ``workers`` threads."""
+
+    def __init__(self, workers, max_queue=MAX_QUEUE, max_queue_per_tenant=MAX_QUEUE_PER_TENANT,
+                 bulk_queue_share=BULK_QUEUE_SHARE, thread_name_prefix="analysis"):
+        self.workers = max(1, int(workers))
+        self.max_queue = max(0, int(max_queue))
+        self.max_queue_per_tenant = max(1, int(max_queue_per_tenant))
+        self.max_bulk_queue = int(self.max_queue * bulk_queue_share)
+        self._cond = threading.Condition()
+        # priority -> {tenant: deque of jobs}; dict order is the round-robin order
+        self._queues = {priority: OrderedDict() for priority in PRIORITIES}
+        self._queued_by_priority = Counter()
+        self._queued_by_tenant = Counter()
+        self._running = 0
+        self._avg_service_ms = None
+        self._admitted = Counter()
+        self._rejected = Counter()
+        self._shutdown = False
+        self._threads = [
+            threading.Thread(target=self._serve, name=f"{thread_name_prefix}-{i}", daemon=True)
+            for i in range(self.workers)
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    @property
+    def queued(self):
+        return sum(self._queued_by_priority.values())
+
+    def submit(self, fn, tenant=None, priority=DEFAULT_PRIORITY):
+        """Queues ``fn()`` and returns a Future for its result. Raises AdmissionRejected when saturated."""
+        priority = normalize_priority(priority)
+        tenant = tenant or "anonymous"
+        with self._cond:
+            if self._shutdown:
+                raise RuntimeError("Scheduler is shut down")
+            # Jobs that can start right away never wait in the queue
+            idle = self._running + self.queued < self.workers
+            if not idle:
+                code = None
+                limit = self.max_bulk_queue if priority == "bulk" else self.max_queue
+                if self.queued >= self.max_queue or self._queued_by_priority[priority] >= limit:
+                    code = "QUEUE_FULL"
+                elif self._queued_by_tenant[tenant] >= self.max_queue_per_tenant:
+                    code = "TENANT_QUEUE_FULL"
+                if code:
+                    self._rejected[priority] += 1
+                    retry_after_ms = self._retry_after_ms()
+                    logging.warning(
+                        f"[scheduler] Rejected {priority} job for tenant {tenant}: {code} "
+                        f"(queued={self.queued}, running={self._running}, retry after {retry_after_ms} ms)"
+                    )
+                    raise AdmissionRejected(code, retry_after_ms)
+            job = _Job(fn, tenant, priority)
+            self._queues[priority].setdefault(tenant, deque()).append(job)
+            self._queued_by_priority[priority] += 1
+            self._queued_by_tenant[tenant] += 1
+            self._admitted[priority] += 1
+            self._cond.notify()
+        job.future.add_done_callback(lambda future: future.cancelled() and self._drop(job))
+        return job.future
+
+    def _drop(self, job):
+        """Removes a job whose future was cancelled while it was still queued, freeing its slot."""
+        with self._cond:
+            jobs = self._queues[job.priority].get(job.tenant)
+            if not jobs or job not in jobs:
+                return
+            jobs.remove(job)
+            if not jobs:
+                del self._queues[job.priority][job.tenant]
+            self._queued_by_priority[job.priority] -= 1
+            self._queued_by_tenant[job.tenant] -= 1
+            if not self._queued_by_tenant[job.tenant]:
+                del self._queued_by_tenant[job.tenant]
+
+    def _retry_after_ms(self):
+        """Rough time until a queue slot frees up: the queue ahead drained by every worker."""
+        service_ms = self._avg_service_ms or INITIAL_SERVICE_MS
+        return int(service_ms * (self.queued / self.workers + 1))
+
+    def _next_job(self):
+        """Pops the next job: highest priority first, tenants round-robin within a class."""
+        for priority in PRIORITIES:
+            tenants = self._queues[priority]
+            if not tenants:
+                continue
+            tenant, jobs = next(iter(tenants.items()))
+            job = jobs.popleft()
+            if jobs:
+                tenants.move_to_end(tenant)
+            else:
+                del tenants[tenant]
+            self._queued_by_priority[priority] -= 1
+            self._queued_by_tenant[tenant] -= 1
+            if not self._queued_by_tenant[tenant]:
+                del self._queued_by_tenant[tenant]
+            return job
+        return None
+
+    def _serve(self):
+        while True:
+            with self._cond:
+                while not self._shutdown and not self.queued:
+                    self._cond.wait()
+                if not self.queued:
+                    return
+                job = self._next_job()
+                self._running += 1
+            started = time.perf_counter()
+            perf_metrics.observe("scheduler", f"queue_wait.{job.priority}", round((started - job.enqueued_at) * 1000, 1))
+            ran = job.future.set_running_or_notify_cancel()
+            if ran:
+                try:
+                    job.future.set_result(job.fn())
+                except BaseException as e:
+                    job.future.set_exception(e)
+            service_ms = (time.perf_counter() - started) * 1000
+            with self._cond:
+                self._running -= 1
+                # Exponentially weighted average feeds the retry-after hint; a job cancelled
+                # before it started took no service time and must not drag it down
+                if ran:
+                    self._avg_service_ms = service_ms if self._avg_service_ms is None else 0.8 * self._avg_service_ms + 0.2 * service_ms
+
+    def stats(self):
+        with self._cond:
+            return {
+                "workers": self.workers,
+                "running": self._running,
+                "queued": self.queued,
+                "queued_by_priority": {priority: self._queued_by_priority[priority] for priority in PRIORITIES},
+                "queued_tenants": len(self._queued_by_tenant),
+                "max_queue": self.max_queue,
+                "max_bulk_queue": self.max_bulk_queue,
+                "max_queue_per_tenant": self.max_queue_per_tenant,
+                "admitted": dict(self._admitted),
+                "rejected": dict(self._rejected),
+                "avg_service_ms": round(self._avg_service_ms, 1) if self._avg_service_ms is not None else None,
+                "retry_after_ms": self._retry_after_ms(),
+            }
+
+    def shutdown(self, wait=True):
+        """Stops accepting jobs; queued jobs still run before the threads exit."""
+        with self._cond:
+            self._shutdown = True
+            self._cond.notify_all()
+        if wait:
+            for thread in self._threads:
+                thread.join()
@@ -0,0 +1,611 @@
+"""
+Long-lived worker mode for the analysis scripts.
+
+Instead of spawning a fresh interpreter per /api/analyze-norma call (re-importing
+google.generativeai, pypdf and pymongo and rebuilding the clients every time), the
+calling script is loaded once and serves newline-delimited JSON frames over
+stdin/stdout or a local Unix socket.
+
+Request frame (one JSON object per line):
+    {"id": "abc", "document_id": "BOE-A-2024-1", "user_prompt": "...",
+     "collection_name": "BOE", "html_content": null}
+
+Response frame:
+    {"id": "abc", "ok": true, "output": "<what main() printed>", "duration_ms": 812.4}
+
+With ``"stream": true`` in the request, the NDJSON frames printed by main()
+(delta / done / error) are forwarded as they are produced, each tagged with the
+request id, before the closing response frame.
+
+Identical requests (same collection, document_id, prompt hash, html_content hash
+and stream flag) that arrive while one is already running join it instead of
+starting their own download/parse/Gemini call: they receive the same output (and,
+when streaming, the frames produced so far followed by the live ones), with
+``"coalesced": true`` on their response frame. Set ANALYSIS_WORKER_COALESCE=false
+to disable. A request may carry ``"deadline_ms"``: if its answer is not ready by
+then it gets ``{"ok": false, "error": "DEADLINE_EXCEEDED"}`` and stops waiting,
+while the shared execution carries on for the others. Once no request is waiting
+for it any more, the execution is cancelled: a queued one gives its admission slot
+back, a running one is asked to stop through current_cancellation().
+
+Requests are admitted through an AdmissionScheduler (see admission.py): a bounded
+queue where ``"priority": "interactive"`` requests (the default) run ahead of
+``"bulk"`` ones and tenants (``"tenant"``, e.g. the user id) are served round-robin.
+When the queue is full the request is answered at once with
+``{"ok": false, "error": "OVERLOADED", "reason": "QUEUE_FULL", "retry_after_ms": 24000}``
+so the caller can back off instead of the worker piling up work.
+
+Control frame (answered immediately, outside the request pool):
+    {"id": "m1", "command": "metrics", "reset": false}
+    -> {"id": "m1", "ok": true, "scheduler": {"queued": 3, "running": 2, "rejected": {...}, ...},
+        "metrics": {"questionsMongo": {"total": {"p50": ..., "p95": ..., "p99": ...}, ...},
+                    "scheduler": {"queue_wait.interactive": {...}}, "pdf_extract": {"pymupdf": {...}}},
+        "prompt_templates": {"analisis_normativo": {"SUMMARY": "0184a1275dd1", ...}, ...},
+        "pdf_backends": {"order": ["pymupdf", "pypdf"], "backends": {"pymupdf": {"ms_per_page": 2.1, ...}}}}
+
+Usage:
+    python questionsMongo.py --worker [--concurrency 2] [--max-queue 20] [--max-queue-per-tenant 5]
+                             [--socket /tmp/analysis.sock] [--supervise]
+"""
+
+import argparse
+import hashlib
+import io
+import json
+import logging
+import os
+import socketserver
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import Future
+
+import pdf_extract
+import perf_metrics
+import prompt_templates
+from admission import MAX_QUEUE, MAX_QUEUE_PER_TENANT, AdmissionRejected, AdmissionScheduler
+
+DEFAULT_CONCURRENCY = int(os.getenv("ANALYSIS_WORKER_CONCURRENCY", "2"))
+COALESCE_ENABLED = os.getenv("ANALYSIS_WORKER_COALESCE", "true").strip().lower() in ("1", "true", "yes", "on")
+MAX_RESTART_BACKOFF_SECONDS = 30
+# A child that stayed up this long is considered healthy again (backoff resets)
+HEALTHY_UPTIME_SECONDS = 60
+
+
+class _ThreadLocalStdout(io.TextIOBase):
+    """stdout replacement that routes print() output to the buffer of the current request.
+
+    Writes from threads that are not serving a request go to ``passthrough`` so they
+    never corrupt the framed output stream.
+    """
+
+    def __init__(self, passthrough):
+        super().__init__()
+        self._passthrough = passthrough
+        self._local = threading.local()
+
+    def begin_capture(self, sink=None):
+        self._local.buffer = io.StringIO()
+        self._local.sink = sink
+
+    def end_capture(self):
+        buffer = getattr(self._local, "buffer", None)
+        self._local.buffer = None
+        self._local.sink = None
+        return buffer.getvalue() if buffer is not None else ""
+
+    def write(self, s):
+        buffer = getattr(self._local, "buffer", None)
+        if buffer is None:
+            return self._passthrough.write(s)
+        sink = getattr(self._local, "sink", None)
+        if sink is not None:
+            # Streaming requests forward output live instead of buffering it
+            sink(s)
+            return len(s)
+        return buffer.write(s)
+
+    def flush(self):
+        try:
+            self._passthrough.flush()
+        except Exception:
+            pass
+
+    def reconfigure(self, *args, **kwargs):
+        # main() reconfigures stdout to UTF-8; captured output is already text
+        pass
+
+    @property
+    def encoding(self):
+        return "utf-8"
+
+    def isatty(self):
+        return False
+
+    def writable(self):
+        return True
+
+
+def _ndjson_forwarder(request_id, respond):
+    """Returns a sink that re-emits each NDJSON line printed by the handler, tagged with ``request_id``."""
+    pending = []
+
+    def sink(s):
+        pending.append(s)
+        if "\n" not in s:
+            return
+        data = "".join(pending)
+        lines = data.split("\n")
+        pending[:] = [lines.pop()]
+        for line in lines:
+            if not line.strip():
+                continue
+            try:
+                frame = json.loads(line)
+            except json.JSONDecodeError:
+                frame = None
+            if not isinstance(frame, dict):
+                frame = {"type": "output", "text": line}
+            frame["id"] = request_id
+            respond(frame)
+
+    return sink
+
+
+def _parse_frame(line):
+    """Parses one request line. Returns (request, error_message)."""
+    try:
+        request = json.loads(line)
+    except json.JSONDecodeError as e:
+        return None, f"INVALID_FRAME: {e}"
+    if not isinstance(request, dict):
+        return None, "INVALID_FRAME: expected a JSON object"
+    if request.get("command"):
+        return request, None
+    if not request.get("document_id") and not request.get("html_content"):
+        return request, "MISSING_DOCUMENT_ID"
+    return request, None
+
+
+def _flight_key(request):
+    """Requests with equal keys produce the same output and can share one execution."""
+    digest = hashlib.sha256()
+    for part in (request.get("user_prompt") or "Realiza un resumen", request.get("html_content") or ""):
+        digest.update(part.encode("utf-8", errors="replace"))
+        digest.update(b"\0")
+    return (
+        request.get("collection_name") or "BOE",
+        request.get("document_id"),
+        digest.hexdigest(),
+        bool(request.get("stream")),
+    )
+
+
+class Cancellation:
+    """Set once nobody waits for a flight any more; handlers register how to stop their work."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._callbacks = []
+        self.cancelled = False
+
+    def add_callback(self, fn):
+        """Calls ``fn()`` on cancellation (right away when already cancelled)."""
+        with self._lock:
+            if not self.cancelled:
+                self._callbacks.append(fn)
+                return
+        fn()
+
+    def cancel(self):
+        with self._lock:
+            if self.cancelled:
+                return
+            self.cancelled = True
+            callbacks, self._callbacks = self._callbacks, []
+        for fn in callbacks:
+            try:
+                fn()
+            except Exception as e:
+                logging.warning(f"[worker] Cancellation callback failed: {e}")
+
+
+_current = threading.local()
+
+
+def current_cancellation():
+    """The Cancellation of the request running on this thread, or None outside worker mode."""
+    return getattr(_current, "cancellation", None)
+
+
+class _Subscriber:
+    """One request waiting on a flight. ``future`` resolves once its response frame is written."""
+
+    def __init__(self, request_id, respond, stream, leader):
+        self.id = request_id
+        self.respond = respond
+        self.stream = stream
+        self.leader = leader
+        self.started = time.perf_counter()
+        self.future = Future()
+        self.timer = None
+
+
+class _Flight:
+    """One in-flight execution shared by every identical request that arrives while it runs."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subscribers = []
+        # Frames streamed so far, replayed to requests that join late
+        self._frames = []
+        self.abandoned = False
+        self.cancellation = Cancellation()
+        # Scheduler future of the execution, cancelled while still queued
+        self.job = None
+
+    def subscribe(self, subscriber):
+        """Adds ``subscriber``; returns False when the flight was already cancelled."""
+        with self._lock:
+            if self.abandoned:
+                return False
+            self._subscribers.append(subscriber)
+            if subscriber.stream:
+                for frame in self._frames:
+                    self._send(subscriber, dict(frame, id=subscriber.id))
+        return True
+
+    def publish(self, frame):
+        """Forwards one streamed frame to every waiting subscriber."""
+        with self._lock:
+            self._frames.append(frame)
+            for subscriber in self._subscribers:
+                if subscriber.stream:
+                    self._send(subscriber, dict(frame, id=subscriber.id))
+
+    def complete(self, response):
+        """Answers every remaining subscriber with the shared response."""
+        with self._lock:
+            subscribers, self._subscribers = self._subscribers, []
+            for subscriber in subscribers:
+                frame = dict(response, id=subscriber.id, duration_ms=self._waited_ms(subscriber))
+                if not subscriber.leader:
+                    frame["coalesced"] = True
+                self._finish(subscriber, frame)
+
+    def expire(self, subscriber):
+        """Deadline timer callback: answers ``subscriber`` with DEADLINE_EXCEEDED if still waiting.
+
+        Returns True when it was the last one waiting and the execution was cancelled.
+        """
+        with self._lock:
+            if subscriber not in self._subscribers:
+                return False
+            self._subscribers.remove(subscriber)
+            abandoned = self.abandoned = not self._subscribers
+            if abandoned:
+                logging.warning(f"[worker] Request {subscriber.id} hit its deadline; nobody else is waiting, cancelling the execution")
+            else:
+                logging.warning(f"[worker] Request {subscriber.id} hit its deadline; leaving the shared execution running")
+            self._finish(subscriber, {
+                "id": subscriber.id,
+                "ok": False,
+                "error": "DEADLINE_EXCEEDED",
+                "duration_ms": self._waited_ms(subscriber),
+            })
+        if abandoned:
+            self.cancel()
+        return abandoned
+
+    def cancel(self):
+        # A queued job gives its admission slot back; a running one is told to stop
+        if self.job is not None:
+            self.job.cancel()
+        self.cancellation.cancel()
+
+    @staticmethod
+    def _waited_ms(subscriber):
+        return round((time.perf_counter() - subscriber.started) * 1000, 1)
+
+    @staticmethod
+    def _send(subscriber, frame):
+        try:
+            subscriber.respond(frame)
+        except Exception as e:
+            # A closed client connection must not break delivery to the others
+            logging.warning(f"[worker] Could not deliver frame to request {subscriber.id}: {e}")
+
+    def _finish(self, subscriber, frame):
+        if subscriber.timer is not None:
+            subscriber.timer.cancel()
+        self._send(subscriber, frame)
+        subscriber.future.set_result(frame)
+
+
+class AnalysisWorker:
+    """Runs framed analysis requests against ``handler`` with bounded concurrency."""
+
+    def __init__(self, handler, concurrency=DEFAULT_CONCURRENCY, coalesce=COALESCE_ENABLED,
+                 max_queue=MAX_QUEUE, max_queue_per_tenant=MAX_QUEUE_PER_TENANT):
+        self.handler = handler
+        self.concurrency = max(1, int(concurrency))
+        self.coalesce = coalesce
+        self.scheduler = AdmissionScheduler(self.concurrency, max_queue=max_queue, max_queue_per_tenant=max_queue_per_tenant)
+        # Real stderr is used for stray prints so the framed stdout stays clean
+        self.stdout = _ThreadLocalStdout(sys.stderr)
+        self._requests_served = 0
+        self._requests_coalesced = 0
+        self._counter_lock = threading.Lock()
+        self._flights = {}
+        self._flights_lock = threading.Lock()
+
+    def install(self):
+        sys.stdout = self.stdout
+
+    def run_request(self, request, respond=None, cancellation=None):
+        """Executes one request on the current thread and returns the response frame.
+
+        Requests with ``"stream": true`` forward every NDJSON frame the handler prints
+        through ``respond`` as it is produced; the closing response frame follows.
+        ``cancellation`` is what current_cancellation() returns to the handler meanwhile.
+        """
+        request_id = request.get("id")
+        start = time.perf_counter()
+        stream = bool(request.get("stream")) and respond is not None
+        self.stdout.begin_capture(_ndjson_forwarder(request_id, respond) if stream else None)
+        _current.cancellation = cancellation
+        try:
+            self.handler(
+                request.get("document_id"),
+                request.get("user_prompt") or "Realiza un resumen",
+                request.get("collection_name") or "BOE",
+                request.get("html_content"),
+                **({"stream": True} if stream else {})
+            )
+            output = self.stdout.end_capture()
+            ok, error = True, None
+        except Exception as e:
+            output = self.stdout.end_capture()
+            if cancellation is not None and cancellation.cancelled:
+                logging.info(f"[worker] Request {request_id} cancelled")
+                ok, error = False, "CANCELLED"
+            else:
+                logging.exception(f"[worker] Request {request_id} failed: {e}")
+                ok, error = False, str(e)
+        finally:
+            _current.cancellation = None
+        duration_ms = (time.perf_counter() - start) * 1000
+        with self._counter_lock:
+            self._requests_served += 1
+        response = {"id": request_id, "ok": ok, "output": output, "duration_ms": round(duration_ms, 1)}
+        if error:
+            response["error"] = error
+        return response
+
+    def run_command(self, request):
+        """Answers a control frame. ``metrics`` returns the rolling per-stage latency percentiles."""
+        command = request.get("command")
+        if command == "metrics":
+            with self._counter_lock:
+                served, coalesced = self._requests_served, self._requests_coalesced
+            with self._flights_lock:
+                in_flight = len(self._flights)
+            return {
+                "id": request.get("id"),
+                "ok": True,
+                "requests_served": served,
+                "requests_coalesced": coalesced,
+                "in_flight": in_flight,
+                "scheduler": self.scheduler.stats(),
+                "metrics": perf_metrics.snapshot(reset=bool(request.get("reset"))),
+                "prompt_templates": prompt_templates.registry.versions(),
+                "pdf_backends": pdf_extract.backend_stats(),
+            }
+        return {"id": request.get("id"), "ok": False, "error": f"UNKNOWN_COMMAND: {command}"}
+
+    def submit(self, line, respond):
+        """Parses ``line`` and schedules it (or joins an identical request already running).
+
+        ``respond`` receives the response frame. The returned future only resolves
+        once that frame has been written.
+        """
+        request, error = _parse_frame(line)
+        if error:
+            respond({"id": request.get("id") if request else None, "ok": False, "error": error})
+            return None
+        if request.get("command"):
+            respond(self.run_command(request))
+            return None
+
+        # Without coalescing every request gets a key of its own
+        key = _flight_key(request) if self.coalesce else object()
+        with self._flights_lock:
+            flight = self._flights.get(key)
+            subscriber = _Subscriber(request.get("id"), respond, bool(request.get("stream")), flight is None)
+            if flight is None or not flight.subscribe(subscriber):
+                # No execution to join, or the one registered is being cancelled
+                flight = self._flights[key] = _Flight()
+                subscriber.leader = True
+                flight.subscribe(subscriber)
+            leader = subscriber.leader
+        if not leader:
+            with self._counter_lock:
+                self._requests_coalesced += 1
+            logging.info(f"[worker] Request {subscriber.id} joined an identical in-flight analysis")
+
+        deadline_ms = request.get("deadline_ms")
+        if deadline_ms:
+            subscriber.timer = threading.Timer(float(deadline_ms) / 1000, self._expire, [key, flight, subscriber])
+            subscriber.timer.daemon = True
+            subscriber.timer.start()
+
+        if leader:
+            try:
+                flight.job = self.scheduler.submit(
+                    lambda: self._run_flight(key, flight, request),
+                    tenant=request.get("tenant"),
+                    priority=request.get("priority"),
+                )
+            except AdmissionRejected as e:
+                # Fail fast; identical requests that joined meanwhile get the same answer
+                self._unregister(key, flight)
+                flight.complete({"ok": False, "error": "OVERLOADED", "reason": e.code, "retry_after_ms": e.retry_after_ms})
+        return subscriber.future
+
+    def _run_flight(self, key, flight, request):
+        if flight.cancellation.cancelled:
+            # Abandoned before the scheduler could drop it
+            return
+        try:
+            response = self.run_request(request, flight.publish if request.get("stream") else None,
+                                        flight.cancellation)
+        except Exception as e:
+            response = {"ok": False, "error": str(e)}
+        # Unregister before answering: requests arriving from now on start a fresh execution
+        self._unregister(key, flight)
+        flight.complete(response)
+
+    def _expire(self, key, flight, subscriber):
+        if flight.expire(subscriber):
+            self._unregister(key, flight)
+
+    def _unregister(self, key, flight):
+        # A cancelled flight may already have been replaced by a fresh one under the same key
+        with self._flights_lock:
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+
+    def shutdown(self):
+        self.scheduler.shutdown(wait=True)
+        logging.info(f"[worker] Shut down after {self._requests_served} requests")
+
+
+def _frame_writer(stream):
+    """Returns a thread-safe function that writes one JSON frame per line to ``stream``."""
+    lock = threading.Lock()
+
+    def write(frame):
+        data = json.dumps(frame, ensure_ascii=False) + "\n"
+        with lock:
+            stream.write(data)
+            stream.flush()
+
+    return write
+
+
+def serve_stdio(worker):
+    """Serves frames read from stdin, writing responses to the original stdout."""
+    real_stdout = sys.stdout
+    if hasattr(real_stdout, "reconfigure"):
+        real_stdout.reconfigure(encoding="utf-8", errors="replace")
+    if hasattr(sys.stdin, "reconfigure"):
+        sys.stdin.reconfigure(encoding="utf-8", errors="replace")
+    respond = _frame_writer(real_stdout)
+    worker.install()
+    logging.info(f"[worker] Serving on stdio (concurrency={worker.concurrency})")
+    respond({"event": "ready", "pid": os.getpid(), "concurrency": worker.concurrency})
+    for line in sys.stdin:
+        line = line.strip()
+        if line:
+            worker.submit(line, respond)
+    worker.shutdown()
+
+
+def serve_socket(worker, socket_path):
+    """Serves frames over a Unix domain socket; each connection may pipeline requests."""
+    if os.path.exists(socket_path):
+        os.unlink(socket_path)
+
+    class _Handler(socketserver.StreamRequestHandler):
+        def handle(self):
+            wfile = io.TextIOWrapper(self.wfile, encoding="utf-8", write_through=True)
+            respond = _frame_writer(wfile)
+            pending = []
+            for raw in self.rfile:
+                line = raw.decode("utf-8", errors="replace").strip()
+                if line:
+                    future = worker.submit(line, respond)
+                    if future is not None:
+                        pending.append(future)
+            # Keep the connection open until every pipelined request has answered
+            for future in pending:
+                future.exception()
+            wfile.detach()
+
+    class _Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+        daemon_threads = True
+
+    worker.install()
+    server = _Server(socket_path, _Handler)
+    logging.info(f"[worker] Serving on unix socket {socket_path} (concurrency={worker.concurrency})")
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        worker.shutdown()
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+
+
+def supervise(child_argv, emit_restart_events=True):
+    """Runs ``child_argv`` and restarts it with exponential backoff whenever it crashes.
+
+    The child inherits stdin/stdout, so in stdio mode the request stream simply
+    continues with the new process. A ``worker_restart`` event frame is written so
+    the caller can fail any request that was in flight when the child died.
+    """
+    backoff = 1
+    while True:
+        started = time.monotonic()
+        logging.info(f"[supervisor] Starting worker: {' '.join(child_argv)}")
+        proc = subprocess.Popen(child_argv)
+        try:
+            exit_code = proc.wait()
+        except KeyboardInterrupt:
+            proc.terminate()
+            proc.wait()
+            return 0
+        if exit_code == 0:
+            logging.info("[supervisor] Worker exited cleanly")
+            return 0
+        uptime = time.monotonic() - started
+        if uptime >= HEALTHY_UPTIME_SECONDS:
+            backoff = 1
+        logging.error(f"[supervisor] Worker crashed with exit code {exit_code} after {uptime:.1f}s; restarting in {backoff}s")
+        if emit_restart_events:
+            sys.stdout.write(json.dumps({"event": "worker_restart", "exit_code": exit_code}) + "\n")
+            sys.stdout.flush()
+        time.sleep(backoff)
+        backoff = min(backoff * 2, MAX_RESTART_BACKOFF_SECONDS)
+
+
+def run_worker(handler, script_path, argv):
+    """Entry point for ``--worker``: parses ``argv`` and serves until stdin/socket closes."""
+    parser = argparse.ArgumentParser(prog=os.path.basename(script_path) + " --worker")
+    parser.add_argument("--concurrency", type=int, default=DEFAULT_CONCURRENCY,
+                        help="Number of analyses run in parallel by this worker")
+    parser.add_argument("--max-queue", type=int, default=MAX_QUEUE,
+                        help="Requests that may wait for a free slot before new ones are rejected")
+    parser.add_argument("--max-queue-per-tenant", type=int, default=MAX_QUEUE_PER_TENANT,
+                        help="Requests a single tenant may have waiting")
+    parser.add_argument("--socket", default=os.getenv("ANALYSIS_WORKER_SOCKET"),
+                        help="Serve on this Unix socket instead of stdin/stdout")
+    parser.add_argument("--supervise", action="store_true",
+                        help="Run the worker as a child process and restart it when it crashes")
+    args = parser.parse_args(argv)
+
+    if args.supervise:
+        child_argv = [sys.executable, os.path.abspath(script_path), "--worker", "--concurrency", str(args.concurrency),
+                      "--max-queue", str(args.max_queue), "--max-queue-per-tenant", str(args.max_queue_per_tenant)]
+        if args.socket:
+            child_argv += ["--socket", args.socket]
+        return supervise(child_argv, emit_restart_events=not args.socket)
+
+    worker = AnalysisWorker(handler, concurrency=args.concurrency, max_queue=args.max_queue,
+                            max_queue_per_tenant=args.max_queue_per_tenant)
+    if args.socket:
+        serve_socket(worker, args.socket)
+    else:
+        serve_stdio(worker)
+    return 0
@@ -0,0 +1,129 @@
+"""
+Micro-benchmark: text_normalizer.normalize_text vs. the original clean_text_for_processing.
+
+Runs both implementations over real BOE/BOA document text taken from the Evals
+datasets (Otros/Evals/data/*.csv, column input_question), checks that they
+produce identical output and reports throughput in MB/s.
+
+Usage:
+    python bench_text_normalizer.py [--repeat 5] [--csv path/to/dataset.csv]
+"""
+
+import argparse
+import csv
+import logging
+import os
+import re
+import sys
+import time
+import unicodedata
+
+from text_normalizer import normalize_text
+
+DEFAULT_CSV = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Otros', 'Evals', 'data', 'Dataset_langsmith_enhanced_v2.csv')
+
+
+def legacy_clean_text_for_processing(text):
+    """The original questionsMongo.clean_text_for_processing, kept here as the baseline."""
+    if not text:
+        return ""
+    original_length = len(text)
+    try:
+        if isinstance(text, bytes):
+            try:
+                text = text.decode('utf-8')
+            except UnicodeDecodeError:
+                text = text.decode('latin-1')
+        if any(seq in text for seq in ['Ã¡', 'Ã©', 'Ã­', 'Ã³', 'Ãº', 'Ã±', 'Ã', 'Ã‰', 'Ã', 'Ã"', 'Ãš']):
+            logging.info("Detected double UTF-8 encoding, attempting to fix...")
+            try:
+                text = text.encode('latin-1').decode('utf-8')
+            except (UnicodeDecodeError, UnicodeEncodeError):
+                logging.warning("Could not fix double encoding, proceeding with original text")
+        if '\ufffd' in text:
+            text = text.replace('\ufffd', "'")
+        text = ''.join(char for char in text if not (0xD800 <= ord(char) <= 0xDFFF))
+        text = unicodedata.normalize('NFC', text)
+        text = re.sub(r'[\ufffd\ufeff]', '', text)
+        text = re.sub(r'[\x00-\x08\x0B\x0C\x0E-\x1F\x7F]', '', text)
+        text = re.sub(r'[ \t]+', ' ', text)
+        text = re.sub(r'\r\n', '\n', text)
+        text = text.strip()
+        try:
+            text.encode('utf-8')
+        except UnicodeEncodeError as e:
+            text = text[:e.start] + text[e.end:]
+        final_length = len(text)
+        if final_length < original_length * 0.9:
+            logging.warning(f"Significant text cleaning performed: {original_length} -> {final_length} characters")
+        return text
+    except Exception as e:
+        logging.error(f"Error in clean_text_for_processing: {e}")
+        return text if isinstance(text, str) else str(text)
+
+
+def load_corpus(csv_path):
+    """Loads document texts (BOE/BOA bodies) from an Evals dataset CSV."""
+    csv.field_size_limit(sys.maxsize)
+    texts = []
+    with open(csv_path, encoding='utf-8', newline='') as f:
+        for row in csv.DictReader(f):
+            text = row.get('input_question') or ''
+            if len(text) > 500:
+                texts.append(text)
+    return texts
+
+
+def bench(fn, texts, repeat):
+    """Returns (best seconds per pass, outputs of the last pass)."""
+    best = float('inf')
+    outputs = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        outputs = [fn(t) for t in texts]
+        best = min(best, time.perf_counter() - start)
+    return best, outputs
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--csv', default=DEFAULT_CSV)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    # Both implementations log per call; keep the benchmark output readable
+    logging.basicConfig(level=logging.ERROR)
+
+    texts = load_corpus(args.csv)
+    if not texts:
+        print(f"No document texts found in {args.csv}")
+        return 1
+    # Also exercise the mojibake path on a double-encoded copy of the corpus
+    mojibake = [t.encode('utf-8').decode('latin-1') for t in texts[:len(texts) // 4]]
+    # ...and every cleaning rule on a noisy copy (tabs, CRLF, BOM, U+FFFD, control chars, NFD accents)
+    noisy = [
+        '\ufeff' + t.replace('. ', '.\t  ').replace('\n', '\r\n').replace('ó', 'o\u0301') + '\x0c\ufffd  '
+        for t in texts[:len(texts) // 4]
+    ]
+    megabytes = sum(len(t.encode('utf-8')) for t in texts) / 1024 / 1024
+    moji_megabytes = sum(len(t.encode('utf-8')) for t in mojibake) / 1024 / 1024
+
+    print(f"Corpus: {len(texts)} documents, {megabytes:.2f} MB (+ {len(mojibake)} double-encoded, {moji_megabytes:.2f} MB)")
+    print(f"{'Implementation':32} | {'Corpus':>12} | {'Double-encoded':>14}")
+    print("-" * 66)
+    results = {}
+    for name, fn in (('legacy clean_text_for_processing', legacy_clean_text_for_processing), ('text_normalizer.normalize_text', normalize_text)):
+        seconds, outputs = bench(fn, texts, args.repeat)
+        moji_seconds, moji_outputs = bench(fn, mojibake, args.repeat)
+        results[name] = (outputs, moji_outputs)
+        print(f"{name:32} | {megabytes / seconds:7.1f} MB/s | {moji_megabytes / moji_seconds:9.1f} MB/s")
+
+    legacy, new = results.values()
+    identical = legacy == new and [legacy_clean_text_for_processing(t) for t in noisy] == [normalize_text(t) for t in noisy]
+    print("-" * 66)
+    print(f"Outputs identical: {'yes' if identical else 'NO'}")
+    return 0 if identical else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
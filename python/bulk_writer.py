@@ -0,0 +1,146 @@
+"""
+Write-behind buffer of MongoDB update operations for the asyncio processors.
+
+Instead of awaiting one update_one() round trip per document, the processors queue
+UpdateOne operations in a BulkWriteBuffer, which sends them with a single unordered
+bulk_write() when one of these is reached:
+
+- BULK_WRITE_MAX_OPS operations are queued (default 500);
+- the queued operations take BULK_WRITE_MAX_BYTES of BSON (default 8 MB, well below
+  the 48 MB message limit);
+- BULK_WRITE_FLUSH_SECONDS have passed since the last flush (default 5), so a slow
+  run still persists its results regularly.
+
+Use it as an async context manager: leaving the block (normally, on an exception or
+on cancellation) flushes whatever is still queued.
+
+    async with BulkWriteBuffer(collection, pipeline="legal_initiatives") as writes:
+        await writes.update_one({"_id": doc_id}, {"$set": {...}})
+    stats["bulk_write"] = writes.stats()
+
+Write errors do not raise: they are logged and counted in stats(), next to the
+latency of every flush. Flush latencies also feed the perf_metrics histograms
+(stage "bulk_write" of the given pipeline).
+"""
+
+import asyncio
+import logging
+import os
+import time
+
+import bson
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError, PyMongoError
+
+import perf_metrics
+
+MAX_OPS = int(os.getenv("BULK_WRITE_MAX_OPS", "500"))
+MAX_BYTES = int(os.getenv("BULK_WRITE_MAX_BYTES", str(8 * 1024 * 1024)))
+FLUSH_SECONDS = float(os.getenv("BULK_WRITE_FLUSH_SECONDS", "5"))
+# Write error messages kept in stats()
+MAX_ERROR_SAMPLES = 10
+
+
+class BulkWriteBuffer:
+    """Queues UpdateOne operations for ``collection`` (a motor collection) and flushes them in bulk."""
+
+    def __init__(self, collection, pipeline=None, max_ops=MAX_OPS, max_bytes=MAX_BYTES,
+                 flush_seconds=FLUSH_SECONDS):
+        self.collection = collection
+        self.pipeline = pipeline
+        self.max_ops = max(1, int(max_ops))
+        self.max_bytes = max(1, int(max_bytes))
+        self.flush_seconds = flush_seconds
+        self._ops = []
+        self._bytes = 0
+        self._lock = asyncio.Lock()
+        self._timer_task = None
+        self._last_flush = time.monotonic()
+        self.flush_ms = []
+        self.operations = 0
+        self.matched = 0
+        self.modified = 0
+        self.write_errors = 0
+        self.error_samples = []
+
+    async def __aenter__(self):
+        if self.flush_seconds and self.flush_seconds > 0:
+            self._timer_task = asyncio.ensure_future(self._flush_periodically())
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+        return False
+
+    async def update_one(self, filter, update):
+        """Queues one update; flushes when the buffer is full."""
+        self._ops.append(UpdateOne(filter, update))
+        self._bytes += len(bson.encode(filter)) + len(bson.encode(update))
+        if len(self._ops) >= self.max_ops or self._bytes >= self.max_bytes:
+            await self.flush()
+
+    async def flush(self):
+        """Sends the queued operations with one unordered bulk_write (no-op when empty)."""
+        async with self._lock:
+            ops, self._ops, self._bytes = self._ops, [], 0
+            self._last_flush = time.monotonic()
+            if not ops:
+                return
+            started = time.perf_counter()
+            try:
+                result = await self.collection.bulk_write(ops, ordered=False)
+                self.matched += result.matched_count
+                self.modified += result.modified_count
+            except BulkWriteError as e:
+                details = e.details or {}
+                errors = details.get("writeErrors", [])
+                self.matched += details.get("nMatched", 0)
+                self.modified += details.get("nModified", 0)
+                self._record_errors(len(errors), [err.get("errmsg", "") for err in errors])
+            except PyMongoError as e:
+                # Nothing is known to be written (network error, timeout...): count every operation
+                self._record_errors(len(ops), [str(e)])
+            ms = round((time.perf_counter() - started) * 1000, 1)
+            self.flush_ms.append(ms)
+            self.operations += len(ops)
+            if self.pipeline:
+                perf_metrics.observe(self.pipeline, "bulk_write", ms)
+            logging.info(f"bulk_write of {len(ops)} operations to {self.collection.name} took {ms} ms")
+
+    def _record_errors(self, count, messages):
+        self.write_errors += count
+        for message in messages:
+            if len(self.error_samples) < MAX_ERROR_SAMPLES:
+                self.error_samples.append(message)
+        logging.error(f"bulk_write to {self.collection.name}: {count} operations failed ({messages[0] if messages else ''})")
+
+    async def _flush_periodically(self):
+        while True:
+            await asyncio.sleep(max(0.0, self._last_flush + self.flush_seconds - time.monotonic()))
+            if time.monotonic() - self._last_flush >= self.flush_seconds:
+                await self.flush()
+
+    async def close(self):
+        """Stops the interval flush and writes what is still queued."""
+        if self._timer_task is not None:
+            # Holding the lock, the interval task is either sleeping or waiting for it,
+            # never in the middle of a bulk_write, so cancelling cannot drop operations
+            async with self._lock:
+                self._timer_task.cancel()
+            try:
+                await self._timer_task
+            except asyncio.CancelledError:
+                pass
+            self._timer_task = None
+        await self.flush()
+
+    def stats(self):
+        return {
+            "flushes": len(self.flush_ms),
+            "operations": self.operations,
+            "matched": self.matched,
+            "modified": self.modified,
+            "write_errors": self.write_errors,
+            "error_samples": list(self.error_samples),
+            "flush_ms": list(self.flush_ms),
+        }
@@ -0,0 +1,153 @@
+"""
+Persistent Gemini response cache.
+
+ask_gemini runs with temperature 0 / top_k 1, so an identical (prompt, text,
+model, generation config) tuple is expected to produce the same answer. This
+module stores those answers in a local SQLite file so repeated analyses of the
+same document with the same prompt become a local lookup instead of a full
+Gemini round trip.
+
+Entries expire after a TTL and the file is bounded by entry count and total
+size, evicting the least recently used rows first. Any SQLite or filesystem failure
+is logged and treated as a cache miss so the analysis itself never breaks.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+DEFAULT_CACHE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.cache', 'gemini_responses.sqlite3')
+
+
+def _env_flag(name, default):
+    return os.getenv(name, default).strip().lower() in ('1', 'true', 'yes', 'on')
+
+
+class GeminiResponseCache:
+    """SQLite-backed response cache with TTL and LRU eviction (entries and bytes)."""
+
+    def __init__(self, path=DEFAULT_CACHE_PATH, ttl_seconds=7 * 24 * 3600, max_entries=5000, max_bytes=200 * 1024 * 1024):
+        self.path = path
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._conn = None
+
+    @staticmethod
+    def make_key(content_hash, model_name, generation_config, safety_settings=None):
+        """Builds the cache key from the prompt+text hash, model name and generation settings."""
+        material = json.dumps({
+            'content_hash': content_hash,
+            'model': model_name,
+            'generation_config': generation_config,
+            'safety_settings': safety_settings or {},
+        }, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(material.encode('utf-8')).hexdigest()
+
+    def _connect(self):
+        if self._conn is None:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            # timeout: wait for other worker processes holding the write lock
+            conn = sqlite3.connect(self.path, timeout=5, check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS responses ('
+                ' key TEXT PRIMARY KEY,'
+                ' response TEXT NOT NULL,'
+                ' size INTEGER NOT NULL,'
+                ' created_at REAL NOT NULL,'
+                ' last_access REAL NOT NULL)'
+            )
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_responses_last_access ON responses(last_access)')
+            conn.commit()
+            self._conn = conn
+        return self._conn
+
+    def get(self, key):
+        """Returns the cached response for ``key`` or None (expired entries count as misses)."""
+        now = time.time()
+        try:
+            with self._lock:
+                conn = self._connect()
+                row = conn.execute('SELECT response, created_at FROM responses WHERE key = ?', (key,)).fetchone()
+                if row is None or now - row[1] > self.ttl_seconds:
+                    if row is not None:
+                        conn.execute('DELETE FROM responses WHERE key = ?', (key,))
+                        conn.commit()
+                    self.misses += 1
+                    return None
+                conn.execute('UPDATE responses SET last_access = ? WHERE key = ?', (now, key))
+                conn.commit()
+                self.hits += 1
+                return row[0]
+        except (sqlite3.Error, OSError) as e:
+            # OSError: the cache directory cannot be created (read-only or unwritable .cache)
+            logging.warning(f"Gemini cache read failed, treating as miss: {e}")
+            self.misses += 1
+            return None
+
+    def put(self, key, response):
+        """Stores ``response`` under ``key`` and evicts expired / least recently used entries."""
+        if not response:
+            return
+        now = time.time()
+        size = len(response.encode('utf-8'))
+        try:
+            with self._lock:
+                conn = self._connect()
+                conn.execute(
+                    'INSERT OR REPLACE INTO responses (key, response, size, created_at, last_access) VALUES (?, ?, ?, ?, ?)',
+                    (key, response, size, now, now)
+                )
+                self._evict(conn, now)
+                conn.commit()
+        except (sqlite3.Error, OSError) as e:
+            logging.warning(f"Gemini cache write failed: {e}")
+
+    def _evict(self, conn, now):
+        expired = conn.execute('DELETE FROM responses WHERE created_at < ?', (now - self.ttl_seconds,)).rowcount
+        count, total_bytes = conn.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses').fetchone()
+        evicted = 0
+        if count > self.max_entries or total_bytes > self.max_bytes:
+            to_delete = []
+            for key, size in conn.execute('SELECT key, size FROM responses ORDER BY last_access ASC'):
+                if count <= self.max_entries and total_bytes <= self.max_bytes:
+                    break
+                to_delete.append((key,))
+                count -= 1
+                total_bytes -= size
+            conn.executemany('DELETE FROM responses WHERE key = ?', to_delete)
+            evicted = len(to_delete)
+        if expired or evicted:
+            self.evictions += expired + evicted
+            logging.info(f"Gemini cache eviction: {expired} expired, {evicted} LRU")
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': round(self.hits / total, 3) if total else 0.0,
+        }
+
+
+def cache_from_env():
+    """Builds the process-wide cache from GEMINI_CACHE_* env vars, or None when disabled."""
+    if not _env_flag('GEMINI_CACHE_ENABLED', 'true'):
+        logging.info("Gemini response cache disabled (GEMINI_CACHE_ENABLED)")
+        return None
+    return GeminiResponseCache(
+        path=os.getenv('GEMINI_CACHE_PATH', DEFAULT_CACHE_PATH),
+        ttl_seconds=int(os.getenv('GEMINI_CACHE_TTL_SECONDS', str(7 * 24 * 3600))),
+        max_entries=int(os.getenv('GEMINI_CACHE_MAX_ENTRIES', '5000')),
+        max_bytes=int(os.getenv('GEMINI_CACHE_MAX_MB', '200')) * 1024 * 1024,
+    )
@@ -0,0 +1,102 @@
+"""
+HTML-to-text extraction for documents that are only published as a web page (url_html).
+
+lxml is used when installed (an order of magnitude faster than BeautifulSoup's
+pure-Python tree building); BeautifulSoup is the fallback. Both paths produce the
+same layout: scripts, styles and page chrome are dropped, the text is taken from
+the main content container when one is recognised (e.g. BOE's #textoxslt) and
+block elements (paragraphs, headings, list items, table rows) end a line, so the
+legal structure used by text_chunker survives.
+"""
+
+import logging
+import re
+
+try:
+    import lxml.html
+    from lxml import etree
+except ImportError:
+    lxml = None
+
+try:
+    from bs4 import BeautifulSoup
+except ImportError:
+    BeautifulSoup = None
+
+BACKEND = 'lxml' if lxml is not None else ('beautifulsoup' if BeautifulSoup is not None else None)
+
+# Never part of the document text
+_DROP_TAGS = ('script', 'style', 'noscript', 'template', 'svg', 'iframe', 'head', 'nav', 'header', 'footer', 'form', 'button')
+_BLOCK_TAGS = (
+    'p', 'div', 'section', 'article', 'main', 'aside', 'blockquote', 'pre', 'br', 'hr',
+    'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'li', 'dt', 'dd', 'tr', 'table', 'caption',
+)
+_CELL_TAGS = ('td', 'th')
+# Main content containers, most specific first: BOE/BOA document bodies, then generic landmarks
+_CONTENT_IDS = ('textoxslt', 'DOdocText', 'docBody', 'contenido', 'content', 'main-content')
+_CONTENT_TAGS = ('main', 'article')
+
+_SPACES = re.compile(r'[ \t\r\f\v\u00a0]+')
+
+
+def _tidy(text):
+    """Collapses runs of spaces and drops blank lines."""
+    lines = (_SPACES.sub(' ', line).strip() for line in text.split('\n'))
+    return '\n'.join(line for line in lines if line)
+
+
+def _lxml_to_text(body, encoding):
+    parser = lxml.html.HTMLParser(encoding=encoding, remove_comments=True)
+    root = lxml.html.document_fromstring(body, parser=parser)
+    etree.strip_elements(root, *_DROP_TAGS, with_tail=False)
+    content = None
+    for content_id in _CONTENT_IDS:
+        found = root.xpath('//*[@id=$id]', id=content_id)
+        if found:
+            content = found[0]
+            break
+    if content is None:
+        content = next((el for tag in _CONTENT_TAGS for el in root.iter(tag)), None)
+    if content is None:
+        content = root.body if root.find('body') is not None else root
+    for el in content.iter(*_BLOCK_TAGS):
+        el.tail = '\n' + (el.tail or '')
+    for el in content.iter(*_CELL_TAGS):
+        el.tail = ' ' + (el.tail or '')
+    return content.text_content()
+
+
+def _soup_to_text(body, encoding):
+    soup = BeautifulSoup(body, 'html.parser', from_encoding=encoding)
+    for tag in soup.find_all(_DROP_TAGS):
+        tag.decompose()
+    content = None
+    for content_id in _CONTENT_IDS:
+        content = soup.find(id=content_id)
+        if content is not None:
+            break
+    if content is None:
+        content = soup.find(_CONTENT_TAGS) or soup.body or soup
+    for tag in content.find_all(_BLOCK_TAGS):
+        tag.insert_after('\n')
+    for tag in content.find_all(_CELL_TAGS):
+        tag.insert_after(' ')
+    return content.get_text()
+
+
+def html_to_text(body, encoding=None):
+    """Returns the readable text of an HTML page (``body`` as bytes or str)."""
+    if not body:
+        return ''
+    if isinstance(body, str):
+        encoding = None
+    if lxml is not None:
+        try:
+            return _tidy(_lxml_to_text(body, encoding))
+        except (etree.ParserError, ValueError, LookupError) as e:
+            if BeautifulSoup is None:
+                raise
+            logging.warning(f"lxml could not parse the page ({e}); falling back to BeautifulSoup")
+    if BeautifulSoup is None:
+        raise RuntimeError("HTML extraction needs lxml or beautifulsoup4 (pip install -r requirements.txt)")
+    return _tidy(_soup_to_text(body, encoding))
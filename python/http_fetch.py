@@ -0,0 +1,594 @@
+"""
+Bounded-memory document downloads.
+
+requests.get(...).content keeps the whole response in memory, and several
+concurrent analyses of large annexes can push the instance into OOM. This module
+streams the body to a temp file in fixed-size chunks instead, enforcing a maximum
+size and a total deadline and aborting early when the server clearly is not
+returning a PDF. Parsers then read the spooled file through mmap, so the bytes are
+paged in from disk rather than copied onto the heap.
+
+download_pdf_async is the asyncio counterpart (pooled httpx.AsyncClient) with the
+same limits, errors and return value.
+
+fetch_html / fetch_html_async fetch web pages (url_html documents). Pages are small
+enough to keep in memory but get the same size cap and deadline. Sync requests go
+through one process-wide requests.Session (get_session) so keep-alive connections
+to the boletín hosts are reused across requests, and HostLimiter caps how many
+requests run at once against a single host.
+
+download_pdf_head fetches only the leading bytes of a PDF (HTTP Range request,
+or the start of the body when the server ignores ranges) for callers that need an
+excerpt; see pdf_extract.extract_head_page_texts.
+"""
+
+import asyncio
+import logging
+import mmap
+import os
+import socket
+import sys
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from urllib.parse import urlparse
+
+import requests
+
+import perf_metrics
+
+try:
+    import httpx
+except ImportError:  # only needed by the async path
+    httpx = None
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+MAX_DOWNLOAD_BYTES = int(os.getenv('PDF_MAX_MB', '50')) * 1024 * 1024
+DOWNLOAD_DEADLINE_SECONDS = float(os.getenv('PDF_DOWNLOAD_DEADLINE_SECONDS', '60'))
+MAX_HTML_BYTES = int(os.getenv('HTML_MAX_MB', '10')) * 1024 * 1024
+CHUNK_SIZE = 64 * 1024
+
+# Content types that can never be a PDF; anything else is confirmed by the %PDF magic bytes
+_NON_PDF_CONTENT_TYPES = ('text/', 'application/json', 'application/xml', 'application/xhtml', 'image/')
+
+
+class DownloadError(requests.exceptions.RequestException):
+    """Download aborted by a local limit. ``code`` is TOO_LARGE, DEADLINE_EXCEEDED or NOT_PDF."""
+
+    def __init__(self, code, message):
+        super().__init__(message)
+        self.code = code
+
+
+class FetchedPage:
+    """A web page held in memory. ``body`` is None for a 304 response."""
+
+    def __init__(self, url, status_code, headers, body=None, encoding=None, elapsed=0.0):
+        self.url = url
+        self.status_code = status_code
+        self.headers = headers
+        self.body = body
+        self.encoding = encoding
+        self.elapsed = elapsed
+
+    @property
+    def not_modified(self):
+        return self.status_code == 304
+
+    @property
+    def size(self):
+        return len(self.body) if self.body else 0
+
+
+class SpooledDownload:
+    """A response body spooled to a temp file. Use as a context manager to delete the file."""
+
+    def __init__(self, url, status_code, headers, path=None, size=0, elapsed=0.0):
+        self.url = url
+        self.status_code = status_code
+        self.headers = headers
+        self.path = path
+        self.size = size
+        self.elapsed = elapsed
+
+    @property
+    def not_modified(self):
+        return self.status_code == 304
+
+    def open_mmap(self):
+        """Returns a read-only mmap of the body (a file-like object pypdf can read from)."""
+        with open(self.path, 'rb') as f:
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def read_bytes(self):
+        with open(self.path, 'rb') as f:
+            return f.read()
+
+    def cleanup(self):
+        if self.path:
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
+            self.path = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.cleanup()
+        return False
+
+
+class PdfHead:
+    """The leading bytes of a PDF. ``complete`` is True when ``body`` is the whole file."""
+
+    def __init__(self, url, status_code, headers, body=b'', total_size=None, complete=False, elapsed=0.0):
+        self.url = url
+        self.status_code = status_code
+        self.headers = headers
+        self.body = body
+        self.total_size = total_size
+        self.complete = complete
+        self.elapsed = elapsed
+
+    @property
+    def size(self):
+        return len(self.body)
+
+    @property
+    def range_supported(self):
+        return self.status_code == 206
+
+
+def peak_rss_mb():
+    """Peak resident set size of this process since it started, in MB, or None where unsupported.
+
+    In worker mode this is the highest value any request has reached; per-request
+    records use the samples of sample_rss() / track_peak_rss() instead.
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in KB on Linux and in bytes on macOS
+    divisor = 1024 * 1024 if sys.platform == 'darwin' else 1024
+    return round(peak / divisor, 1)
+
+
+# Poll interval of track_peak_rss()
+RSS_SAMPLE_SECONDS = float(os.getenv('RSS_SAMPLE_SECONDS', '0.05'))
+_PAGE_SIZE = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+
+
+def current_rss_mb():
+    """Current resident set size of this process in MB (from /proc/self/statm), or None where unavailable."""
+    try:
+        with open('/proc/self/statm', 'rb') as f:
+            resident_pages = int(f.read().split()[1])
+    except (OSError, ValueError, IndexError):
+        return None
+    return round(resident_pages * _PAGE_SIZE / 1024 / 1024, 1)
+
+
+def sample_rss(timer=None):
+    """Records the current RSS as ``peak_rss_mb`` of ``timer`` (default: the current request) if it is a new high."""
+    timer = timer if timer is not None else perf_metrics.current()
+    if timer is not None:
+        timer.maximum(peak_rss_mb=current_rss_mb())
+
+
+@contextmanager
+def track_peak_rss(interval=RSS_SAMPLE_SECONDS):
+    """Samples the RSS every ``interval`` seconds while the block runs (download, PDF parsing).
+
+    The spike of a large PDF lasts only while the parser holds it, so sampling just
+    at the start and end of the request would miss it. The process is shared, so in
+    worker mode concurrent requests also show in the samples.
+    """
+    timer = perf_metrics.current()
+    if timer is None or current_rss_mb() is None:
+        yield
+        return
+    stop = threading.Event()
+
+    def poll():
+        while not stop.wait(interval):
+            sample_rss(timer)
+
+    sample_rss(timer)
+    thread = threading.Thread(target=poll, name="rss-sampler", daemon=True)
+    thread.start()
+    try:
+        yield
+    finally:
+        stop.set()
+        thread.join()
+        sample_rss(timer)
+
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def get_session():
+    """Process-wide pooled requests.Session (thread-safe for concurrent GETs)."""
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                session = requests.Session()
+                adapter = requests.adapters.HTTPAdapter(pool_connections=10, pool_maxsize=20)
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                _session = session
+    return _session
+
+
+class HostLimiter:
+    """Caps concurrent requests per host (boe.es and the regional gazettes throttle bursts)."""
+
+    def __init__(self, per_host):
+        self.per_host = max(1, int(per_host))
+        self._semaphores = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def slot(self, url):
+        host = urlparse(url).hostname or ''
+        with self._lock:
+            semaphore = self._semaphores.get(host)
+            if semaphore is None:
+                semaphore = self._semaphores[host] = threading.BoundedSemaphore(self.per_host)
+        with semaphore:
+            yield
+
+
+def _check_declared_size(headers, max_bytes, kind):
+    declared = headers.get('Content-Length')
+    if declared and declared.isdigit() and int(declared) > max_bytes:
+        raise DownloadError('TOO_LARGE', f"{kind} is {int(declared) / 1024 / 1024:.1f} MB, limit is {max_bytes / 1024 / 1024:.0f} MB")
+
+
+def _deadline_error(kind, deadline_seconds):
+    return DownloadError('DEADLINE_EXCEEDED', f"{kind} download exceeded {deadline_seconds:.0f}s")
+
+
+class _DeadlineWatchdog:
+    """Enforces the total deadline of a streaming requests response from outside the read loop.
+
+    The ``timeout`` given to requests applies to each socket read, so a server that keeps
+    sending a few bytes at a time can hold iter_content well past the deadline. When the
+    deadline passes, a timer thread shuts the socket down, which makes the blocked read
+    return; check() (called before every read) then raises DEADLINE_EXCEEDED.
+    """
+
+    def __init__(self, response, deadline_seconds, started, kind='PDF'):
+        self.response = response
+        self.deadline_seconds = deadline_seconds
+        self.deadline_at = started + deadline_seconds
+        self.kind = kind
+        self.fired = False
+        self._timer = threading.Timer(max(0.0, self.deadline_at - time.monotonic()), self._fire)
+        self._timer.daemon = True
+
+    def __enter__(self):
+        self._timer.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._timer.cancel()
+        if self.fired and exc is not None and not isinstance(exc, DownloadError):
+            # The read failed because the socket was shut down under it
+            raise self.error() from exc
+        return False
+
+    def _fire(self):
+        self.fired = True
+        fp = getattr(getattr(self.response, 'raw', None), '_fp', None)
+        sock = getattr(getattr(getattr(fp, 'fp', None), 'raw', None), '_sock', None)
+        if sock is not None:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def error(self):
+        return _deadline_error(self.kind, self.deadline_seconds)
+
+    def check(self):
+        if self.fired or time.monotonic() > self.deadline_at:
+            raise self.error()
+
+    def iter_content(self, chunk_size):
+        """response.iter_content with the deadline checked before each read."""
+        chunks = self.response.iter_content(chunk_size=chunk_size)
+        while True:
+            self.check()
+            chunk = next(chunks, None)
+            if chunk is None:
+                # A shutdown socket can also look like the end of the body
+                self.check()
+                return
+            yield chunk
+
+
+def _check_response_headers(headers, max_bytes):
+    """Rejects responses that are clearly not a PDF or are declared larger than ``max_bytes``."""
+    content_type = headers.get('Content-Type', '').lower()
+    if content_type.startswith(_NON_PDF_CONTENT_TYPES):
+        raise DownloadError('NOT_PDF', f"Expected a PDF but server returned Content-Type '{content_type}'")
+    _check_declared_size(headers, max_bytes, 'PDF')
+
+
+class _Spooler:
+    """Writes body chunks to a temp file, enforcing the PDF magic bytes, size cap and deadline."""
+
+    def __init__(self, max_bytes, deadline_seconds, started):
+        self.max_bytes = max_bytes
+        self.deadline_seconds = deadline_seconds
+        self.started = started
+        self.size = 0
+        fd, self.path = tempfile.mkstemp(suffix='.pdf')
+        self._file = os.fdopen(fd, 'wb')
+
+    def write(self, chunk):
+        if not chunk:
+            return
+        if self.size == 0 and b'%PDF' not in chunk[:1024]:
+            raise DownloadError('NOT_PDF', "Response body does not start with a PDF header")
+        self.size += len(chunk)
+        if self.size > self.max_bytes:
+            raise DownloadError('TOO_LARGE', f"PDF exceeded {self.max_bytes / 1024 / 1024:.0f} MB while downloading")
+        if time.monotonic() - self.started > self.deadline_seconds:
+            raise DownloadError('DEADLINE_EXCEEDED', f"PDF download exceeded {self.deadline_seconds:.0f}s")
+        self._file.write(chunk)
+
+    def close(self, url, status_code, headers):
+        """Closes the file and returns the SpooledDownload."""
+        self._file.close()
+        if self.size == 0:
+            raise DownloadError('NOT_PDF', "Empty response body")
+        elapsed = time.monotonic() - self.started
+        logging.info(f"Downloaded {self.size / 1024:.0f} KB in {elapsed:.2f}s to temp file")
+        return SpooledDownload(url, status_code, headers, path=self.path, size=self.size, elapsed=elapsed)
+
+    def discard(self):
+        self._file.close()
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+
+def download_pdf(url, headers=None, timeout=20, max_bytes=None, deadline_seconds=None, session=None):
+    """Streams ``url`` to a temp file and returns a SpooledDownload.
+
+    A 304 response (conditional GET) returns a SpooledDownload without a file.
+    HTTP errors raise requests.HTTPError; local limits raise DownloadError, which is
+    also a RequestException so existing download error handling applies.
+    """
+    max_bytes = max_bytes or MAX_DOWNLOAD_BYTES
+    deadline_seconds = deadline_seconds or DOWNLOAD_DEADLINE_SECONDS
+    started = time.monotonic()
+    http = session or requests
+    response = http.get(url, headers=headers, stream=True, timeout=timeout)
+    try:
+        if response.status_code == 304:
+            return SpooledDownload(url, 304, response.headers, elapsed=time.monotonic() - started)
+        response.raise_for_status()
+        _check_response_headers(response.headers, max_bytes)
+
+        spooler = _Spooler(max_bytes, deadline_seconds, started)
+        try:
+            with _DeadlineWatchdog(response, deadline_seconds, started) as watchdog:
+                for chunk in watchdog.iter_content(CHUNK_SIZE):
+                    spooler.write(chunk)
+            return spooler.close(url, response.status_code, response.headers)
+        except BaseException:
+            spooler.discard()
+            raise
+    finally:
+        response.close()
+
+
+def _content_range_total(headers):
+    """Total size from a ``Content-Range: bytes 0-N/TOTAL`` header, or None."""
+    total = headers.get('Content-Range', '').rpartition('/')[2].strip()
+    return int(total) if total.isdigit() else None
+
+
+def download_pdf_head(url, head_bytes, probe=None, headers=None, timeout=20, deadline_seconds=None, session=None):
+    """Fetches the first ``head_bytes`` bytes of a PDF and returns a PdfHead.
+
+    Sends ``Range: bytes=0-<head_bytes-1>``; when the server ignores it (200), the
+    body is read up to ``head_bytes`` and the connection dropped. ``probe`` is called
+    with the first chunk: returning False stops the download there (e.g. the head
+    will not be usable), and the PdfHead holds just that chunk. Errors follow download_pdf.
+    """
+    deadline_seconds = deadline_seconds or DOWNLOAD_DEADLINE_SECONDS
+    started = time.monotonic()
+    request_headers = dict(headers or {})
+    request_headers['Range'] = f'bytes=0-{head_bytes - 1}'
+    response = (session or get_session()).get(url, headers=request_headers, stream=True, timeout=timeout)
+    try:
+        response.raise_for_status()
+        if response.status_code == 206:
+            content_type = response.headers.get('Content-Type', '').lower()
+            if content_type.startswith(_NON_PDF_CONTENT_TYPES):
+                raise DownloadError('NOT_PDF', f"Expected a PDF but server returned Content-Type '{content_type}'")
+            total_size = _content_range_total(response.headers)
+        else:
+            _check_response_headers(response.headers, MAX_DOWNLOAD_BYTES)
+            declared = response.headers.get('Content-Length', '')
+            total_size = int(declared) if declared.isdigit() else None
+        chunks = []
+        size = 0
+        stopped = False
+        with _DeadlineWatchdog(response, deadline_seconds, started) as watchdog:
+            for chunk in watchdog.iter_content(CHUNK_SIZE):
+                if not chunk:
+                    continue
+                if size == 0:
+                    if b'%PDF' not in chunk[:1024]:
+                        raise DownloadError('NOT_PDF', "Response body does not start with a PDF header")
+                    if probe is not None and not probe(chunk):
+                        chunks.append(chunk)
+                        size = len(chunk)
+                        stopped = True
+                        break
+                chunks.append(chunk)
+                size += len(chunk)
+                if size >= head_bytes:
+                    stopped = True
+                    break
+        if size == 0:
+            raise DownloadError('NOT_PDF', "Empty response body")
+        body = b''.join(chunks)[:head_bytes]
+        complete = (total_size is not None and len(body) >= total_size) or (response.status_code != 206 and not stopped)
+        elapsed = time.monotonic() - started
+        logging.info(f"Downloaded {len(body) / 1024:.0f} KB PDF head in {elapsed:.2f}s (HTTP {response.status_code}"
+                     f"{', whole file' if complete else ''})")
+        return PdfHead(url, response.status_code, response.headers, body=body, total_size=total_size,
+                       complete=complete, elapsed=elapsed)
+    finally:
+        response.close()
+
+
+def make_async_client(timeout=20):
+    """Pooled HTTP client for download_pdf_async; create it on the event loop that will use it."""
+    if httpx is None:
+        raise RuntimeError("httpx is required for async downloads (pip install -r requirements.txt)")
+    return httpx.AsyncClient(
+        timeout=httpx.Timeout(timeout),
+        follow_redirects=True,
+        limits=httpx.Limits(max_connections=20, max_keepalive_connections=10),
+    )
+
+
+async def download_pdf_async(url, client, headers=None, max_bytes=None, deadline_seconds=None):
+    """Async counterpart of download_pdf over a pooled httpx.AsyncClient.
+
+    Same limits and return value; transport and HTTP errors are raised as
+    requests exceptions so callers share one error-handling path. The whole request
+    runs under asyncio.wait_for, so the deadline holds even while a read is pending.
+    """
+    max_bytes = max_bytes or MAX_DOWNLOAD_BYTES
+    deadline_seconds = deadline_seconds or DOWNLOAD_DEADLINE_SECONDS
+    started = time.monotonic()
+
+    async def download():
+        async with client.stream('GET', url, headers=headers) as response:
+            if response.status_code == 304:
+                return SpooledDownload(url, 304, response.headers, elapsed=time.monotonic() - started)
+            if response.status_code >= 400:
+                raise requests.exceptions.HTTPError(f"{response.status_code} Error: {response.reason_phrase} for url: {url}")
+            _check_response_headers(response.headers, max_bytes)
+
+            spooler = _Spooler(max_bytes, deadline_seconds, started)
+            try:
+                async for chunk in response.aiter_bytes(CHUNK_SIZE):
+                    spooler.write(chunk)
+                return spooler.close(url, response.status_code, response.headers)
+            except BaseException:
+                spooler.discard()
+                raise
+
+    try:
+        return await asyncio.wait_for(download(), deadline_seconds)
+    except asyncio.TimeoutError as e:
+        raise _deadline_error('PDF', deadline_seconds) from e
+    except httpx.TimeoutException as e:
+        raise requests.exceptions.Timeout(f"Timed out downloading {url}: {e}") from e
+    except httpx.HTTPError as e:
+        raise requests.exceptions.ConnectionError(f"Error downloading {url}: {e}") from e
+
+
+def _charset(content_type):
+    """Charset declared in a Content-Type header, or None (the parser then sniffs <meta charset>)."""
+    for param in content_type.split(';')[1:]:
+        name, _, value = param.partition('=')
+        if name.strip().lower() == 'charset' and value.strip():
+            return value.strip().strip('"\'')
+    return None
+
+
+class _PageBuffer:
+    """Accumulates a page body in memory, enforcing the size cap and deadline."""
+
+    def __init__(self, max_bytes, deadline_seconds, started):
+        self.max_bytes = max_bytes
+        self.deadline_seconds = deadline_seconds
+        self.started = started
+        self._chunks = []
+        self.size = 0
+
+    def write(self, chunk):
+        self.size += len(chunk)
+        if self.size > self.max_bytes:
+            raise DownloadError('TOO_LARGE', f"Page exceeded {self.max_bytes / 1024 / 1024:.0f} MB while downloading")
+        if time.monotonic() - self.started > self.deadline_seconds:
+            raise DownloadError('DEADLINE_EXCEEDED', f"Page download exceeded {self.deadline_seconds:.0f}s")
+        self._chunks.append(chunk)
+
+    def close(self, url, status_code, headers):
+        elapsed = time.monotonic() - self.started
+        logging.info(f"Downloaded {self.size / 1024:.0f} KB page in {elapsed:.2f}s")
+        return FetchedPage(url, status_code, headers, body=b''.join(self._chunks),
+                           encoding=_charset(headers.get('Content-Type', '')), elapsed=elapsed)
+
+
+def fetch_html(url, headers=None, timeout=20, max_bytes=None, deadline_seconds=None, session=None):
+    """Fetches a web page over the pooled session and returns a FetchedPage.
+
+    Errors follow download_pdf: HTTP errors raise requests.HTTPError, local limits
+    raise DownloadError.
+    """
+    max_bytes = max_bytes or MAX_HTML_BYTES
+    deadline_seconds = deadline_seconds or DOWNLOAD_DEADLINE_SECONDS
+    started = time.monotonic()
+    response = (session or get_session()).get(url, headers=headers, stream=True, timeout=timeout)
+    try:
+        if response.status_code == 304:
+            return FetchedPage(url, 304, response.headers, elapsed=time.monotonic() - started)
+        response.raise_for_status()
+        _check_declared_size(response.headers, max_bytes, 'Page')
+        page = _PageBuffer(max_bytes, deadline_seconds, started)
+        with _DeadlineWatchdog(response, deadline_seconds, started, kind='Page') as watchdog:
+            for chunk in watchdog.iter_content(CHUNK_SIZE):
+                page.write(chunk)
+        return page.close(url, response.status_code, response.headers)
+    finally:
+        response.close()
+
+
+async def fetch_html_async(url, client, headers=None, max_bytes=None, deadline_seconds=None):
+    """Async counterpart of fetch_html over a pooled httpx.AsyncClient (deadline as in download_pdf_async)."""
+    max_bytes = max_bytes or MAX_HTML_BYTES
+    deadline_seconds = deadline_seconds or DOWNLOAD_DEADLINE_SECONDS
+    started = time.monotonic()
+
+    async def fetch():
+        async with client.stream('GET', url, headers=headers) as response:
+            if response.status_code == 304:
+                return FetchedPage(url, 304, response.headers, elapsed=time.monotonic() - started)
+            if response.status_code >= 400:
+                raise requests.exceptions.HTTPError(f"{response.status_code} Error: {response.reason_phrase} for url: {url}")
+            _check_declared_size(response.headers, max_bytes, 'Page')
+            page = _PageBuffer(max_bytes, deadline_seconds, started)
+            async for chunk in response.aiter_bytes(CHUNK_SIZE):
+                page.write(chunk)
+            return page.close(url, response.status_code, response.headers)
+
+    try:
+        return await asyncio.wait_for(fetch(), deadline_seconds)
+    except asyncio.TimeoutError as e:
+        raise _deadline_error('Page', deadline_seconds) from e
+    except httpx.TimeoutException as e:
+        raise requests.exceptions.Timeout(f"Timed out downloading {url}: {e}") from e
+    except httpx.HTTPError as e:
+        raise requests.exceptions.ConnectionError(f"Error downloading {url}: {e}") from e
@@ -0,0 +1,130 @@
+"""
+Incremental decoding of one string field of a JSON object that arrives in chunks.
+
+Gemini answers the marketing prompt with ``{"html_content": "<h2>..."}`` (optionally
+inside ```json fences). To show the content while it is generated, the streamed
+chunks are fed to a JsonStringFieldDecoder, which follows the JSON structure just
+enough to find the top-level key and returns the *unescaped* characters of its
+string value as they arrive. Escape sequences (including \\uXXXX surrogate pairs)
+split across chunk boundaries are held back until complete.
+
+The decoder does not validate the document: the caller still parses the full
+response with json.loads once the stream ends, and that result supersedes the
+streamed text.
+"""
+
+_SIMPLE_ESCAPES = {'"': '"', '\\': '\\', '/': '/', 'b': '\b', 'f': '\f', 'n': '\n', 'r': '\r', 't': '\t'}
+
+# Parser states
+_SCAN = 0          # between tokens
+_KEY = 1           # inside a top-level key
+_STRING = 2        # inside any other string (skipped)
+_AFTER_KEY = 3     # top-level key read, waiting for ':'
+_BEFORE_VALUE = 4  # ':' read after the wanted key, waiting for the opening quote
+_VALUE = 5         # inside the wanted string value (decoded)
+_DONE = 6
+
+
+class JsonStringFieldDecoder:
+    """Streams the value of the top-level string field ``key``: ``feed(chunk)`` returns the new text."""
+
+    def __init__(self, key):
+        self.key = key
+        self.state = _SCAN
+        self.depth = 0
+        self._expect_key = False
+        self._key_chars = []
+        self._escaped = False
+        self._pending = ''        # incomplete escape sequence of the value, e.g. '\\u00'
+        self._high_surrogate = None
+
+    @property
+    def done(self):
+        """True once the closing quote of the value has been read."""
+        return self.state == _DONE
+
+    def feed(self, chunk):
+        out = []
+        for ch in chunk:
+            state = self.state
+            if state == _VALUE:
+                self._feed_value(ch, out)
+            elif state == _DONE:
+                break
+            elif state in (_KEY, _STRING):
+                if self._escaped:
+                    self._escaped = False
+                    if state == _KEY:
+                        self._key_chars.append('\\' + ch)
+                elif ch == '\\':
+                    self._escaped = True
+                elif ch == '"':
+                    self.state = _AFTER_KEY if state == _KEY else _SCAN
+                elif state == _KEY:
+                    self._key_chars.append(ch)
+            elif state == _AFTER_KEY:
+                if ch == ':':
+                    wanted = ''.join(self._key_chars) == self.key
+                    self.state = _BEFORE_VALUE if wanted else _SCAN
+            elif state == _BEFORE_VALUE:
+                if ch == '"':
+                    self.state = _VALUE
+                elif not ch.isspace():
+                    # Not a string (null, number, object...): nothing to stream
+                    self.state = _SCAN
+                    self._scan(ch)
+            else:
+                self._scan(ch)
+        return ''.join(out)
+
+    def _scan(self, ch):
+        if ch == '"':
+            if self.depth == 1 and self._expect_key:
+                self._key_chars = []
+                self.state = _KEY
+            else:
+                self.state = _STRING
+            self._expect_key = False
+        elif ch in '{[':
+            self.depth += 1
+            self._expect_key = ch == '{' and self.depth == 1
+        elif ch in '}]':
+            self.depth = max(0, self.depth - 1)
+        elif ch == ',' and self.depth == 1:
+            self._expect_key = True
+
+    def _feed_value(self, ch, out):
+        if self._pending:
+            self._pending += ch
+            if self._pending[1] == 'u':
+                if len(self._pending) == 6:
+                    try:
+                        self._emit_code_unit(int(self._pending[2:], 16), out)
+                    except ValueError:
+                        pass  # malformed escape; json.loads reports it at the end
+                    self._pending = ''
+            else:
+                self._emit(_SIMPLE_ESCAPES.get(ch, ch), out)
+                self._pending = ''
+        elif ch == '\\':
+            self._pending = ch
+        elif ch == '"':
+            self._high_surrogate = None
+            self.state = _DONE
+        else:
+            self._emit(ch, out)
+
+    def _emit_code_unit(self, code, out):
+        # Surrogate pairs are combined; lone surrogates cannot be written as UTF-8 and are dropped
+        if 0xD800 <= code <= 0xDBFF:
+            self._high_surrogate = code
+        elif 0xDC00 <= code <= 0xDFFF:
+            if self._high_surrogate is not None:
+                out.append(chr(0x10000 + ((self._high_surrogate - 0xD800) << 10) + (code - 0xDC00)))
+            self._high_surrogate = None
+        else:
+            self._emit(chr(code), out)
+
+    def _emit(self, text, out):
+        self._high_surrogate = None
+        out.append(text)
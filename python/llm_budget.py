@@ -0,0 +1,241 @@
+"""
+Request/token budgets for the asyncio batch processors (processor.py and
+processor_boletines.py at the repository root).
+
+OpenAI limits requests per minute (RPM) and tokens per minute (TPM) per model and
+organisation. A RateBudget keeps a sliding 60 s window of the calls made from this
+process: acquire() waits until one more call of the estimated size fits in it, and
+the reservation is corrected with the real token count when the answer arrives.
+
+The configured limits are only an upper bound. When the API still answers 429 (other
+processes share the quota, or the limits are set too high), rate_limited() halves
+the share of the limits in use and pauses every caller for the Retry-After time;
+each run of successful calls gives back a tenth of the limits, up to the configured
+values.
+
+map_ordered() runs one coroutine per item with bounded concurrency and yields the
+results in input order, so callers can keep accumulating stats as the sequential
+loop did.
+
+Configuration (environment):
+    OPENAI_RPM_LIMIT   requests per minute per model (default 500)
+    OPENAI_TPM_LIMIT   tokens per minute per model (default 200000)
+"""
+
+import asyncio
+import logging
+import os
+import time
+from collections import deque
+
+RPM_LIMIT = int(os.getenv("OPENAI_RPM_LIMIT", "500"))
+TPM_LIMIT = int(os.getenv("OPENAI_TPM_LIMIT", "200000"))
+
+WINDOW_SECONDS = 60.0
+# Share of the limits kept after repeated 429s, and how it is given back
+MIN_SHARE = 0.1
+RECOVERY_STEP = 0.1
+RECOVER_AFTER = 20
+# Pause after a 429 without a Retry-After header
+DEFAULT_RETRY_AFTER = 5.0
+# Several in-flight calls usually fail together; they count as one 429 for the share
+RATE_LIMIT_DEBOUNCE = 1.0
+
+# Spanish legal text averages about 4 characters per token; 3 keeps the estimate on the safe side
+CHARS_PER_TOKEN = 3
+
+
+def estimate_tokens(*texts, output_tokens=0):
+    """Rough token count of a request made of ``texts`` plus the expected answer size."""
+    return sum(len(text or "") for text in texts) // CHARS_PER_TOKEN + output_tokens
+
+
+class Reservation:
+    """One call counted in the window; settle its real size with RateBudget.succeeded()."""
+
+    __slots__ = ("at", "tokens", "live", "waited_ms")
+
+    def __init__(self, at, tokens, waited_ms):
+        self.at = at
+        self.tokens = tokens
+        self.live = True
+        self.waited_ms = waited_ms
+
+
+class RateBudget:
+    """Sliding-window RPM/TPM budget shared by the coroutines of one event loop.
+
+    Only the event loop thread may use it: the check and the reservation in
+    acquire() happen without an await in between, so no lock is needed.
+    """
+
+    def __init__(self, name, rpm=RPM_LIMIT, tpm=TPM_LIMIT):
+        self.name = name
+        self.rpm = max(1, int(rpm))
+        self.tpm = max(1, int(tpm))
+        self.share = 1.0
+        self._window = deque()
+        self._window_tokens = 0
+        self._paused_until = 0.0
+        self._last_cut = 0.0
+        self._successes = 0
+        self.requests = 0
+        self.tokens = 0
+        self.rate_limited_count = 0
+        self.waited_ms = 0.0
+
+    @property
+    def rpm_in_use(self):
+        return max(1, int(self.rpm * self.share))
+
+    @property
+    def tpm_in_use(self):
+        return max(1, int(self.tpm * self.share))
+
+    def _trim(self, now):
+        window = self._window
+        while window and window[0].at <= now - WINDOW_SECONDS:
+            expired = window.popleft()
+            expired.live = False
+            self._window_tokens -= expired.tokens
+
+    def _delay(self, now, tokens):
+        """Seconds until a call of ``tokens`` fits in the window (0 when it fits now)."""
+        delay = max(0.0, self._paused_until - now)
+        window = self._window
+        rpm = self.rpm_in_use
+        if len(window) >= rpm:
+            delay = max(delay, window[len(window) - rpm].at + WINDOW_SECONDS - now)
+        excess = self._window_tokens + tokens - self.tpm_in_use
+        if excess > 0 and window:
+            # Wait for the oldest calls whose expiry frees enough tokens; a single call
+            # larger than the whole budget goes through once the window is empty
+            freed = 0
+            for entry in window:
+                freed += entry.tokens
+                if freed >= excess:
+                    break
+            delay = max(delay, entry.at + WINDOW_SECONDS - now)
+        return delay
+
+    async def acquire(self, tokens):
+        """Waits until one more call of about ``tokens`` tokens fits and reserves it."""
+        tokens = max(1, int(tokens))
+        started = time.monotonic()
+        while True:
+            now = time.monotonic()
+            self._trim(now)
+            delay = self._delay(now, tokens)
+            if delay <= 0:
+                break
+            await asyncio.sleep(delay)
+        waited_ms = round((now - started) * 1000, 1)
+        reservation = Reservation(now, tokens, waited_ms)
+        self._window.append(reservation)
+        self._window_tokens += tokens
+        self.requests += 1
+        self.waited_ms += waited_ms
+        return reservation
+
+    def succeeded(self, reservation, actual_tokens=None):
+        """Replaces the estimate with the real usage and slowly restores the share after 429s."""
+        if actual_tokens is not None:
+            if reservation.live:
+                self._window_tokens += actual_tokens - reservation.tokens
+            reservation.tokens = actual_tokens
+        self.tokens += reservation.tokens
+        self._successes += 1
+        if self.share < 1.0 and self._successes >= RECOVER_AFTER:
+            self.share = min(1.0, self.share + RECOVERY_STEP)
+            self._successes = 0
+            logging.info(f"[{self.name}] Rate budget raised to {self.share:.0%} ({self.rpm_in_use} RPM, {self.tpm_in_use} TPM)")
+
+    def rate_limited(self, retry_after=None):
+        """Records a 429: pauses every caller and halves the share of the limits in use."""
+        now = time.monotonic()
+        self.rate_limited_count += 1
+        self._successes = 0
+        pause = retry_after if retry_after and retry_after > 0 else DEFAULT_RETRY_AFTER
+        self._paused_until = max(self._paused_until, now + pause)
+        if now - self._last_cut >= RATE_LIMIT_DEBOUNCE:
+            self._last_cut = now
+            self.share = max(MIN_SHARE, self.share / 2)
+            logging.warning(
+                f"[{self.name}] Rate limited: pausing {pause:.1f}s, budget lowered to {self.share:.0%} "
+                f"({self.rpm_in_use} RPM, {self.tpm_in_use} TPM)"
+            )
+
+    def stats(self):
+        return {
+            "requests": self.requests,
+            "tokens": self.tokens,
+            "rate_limited": self.rate_limited_count,
+            "waited_ms": round(self.waited_ms, 1),
+            "share": round(self.share, 2),
+            "rpm": self.rpm_in_use,
+            "tpm": self.tpm_in_use,
+        }
+
+
+_budgets = {}
+
+
+def for_model(model):
+    """The process-wide budget of ``model`` (the limits apply per model, not per processor)."""
+    budget = _budgets.get(model)
+    if budget is None:
+        budget = _budgets[model] = RateBudget(model)
+    return budget
+
+
+def retry_after_seconds(error):
+    """The Retry-After header of an API error in seconds, or None."""
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None) or {}
+    value = headers.get("retry-after-ms")
+    if value is not None:
+        try:
+            return float(value) / 1000
+        except ValueError:
+            pass
+    value = headers.get("retry-after")
+    if value is not None:
+        try:
+            return float(value)
+        except ValueError:
+            pass
+    return None
+
+
+async def _iterate(items):
+    if hasattr(items, "__aiter__"):
+        async for item in items:
+            yield item
+    else:
+        for item in items:
+            yield item
+
+
+async def map_ordered(fn, items, concurrency):
+    """Runs ``await fn(item)`` for each item, at most ``concurrency`` at a time, and yields
+    the results in input order. ``items`` may be an iterable or an async iterable (a
+    cursor); at most twice ``concurrency`` items are taken from it ahead of the results.
+    """
+    concurrency = max(1, int(concurrency))
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def run(item):
+        async with semaphore:
+            return await fn(item)
+
+    pending = deque()
+    try:
+        async for item in _iterate(items):
+            pending.append(asyncio.ensure_future(run(item)))
+            if len(pending) >= 2 * concurrency:
+                yield await pending.popleft()
+        while pending:
+            yield await pending.popleft()
+    finally:
+        for task in pending:
+            task.cancel()
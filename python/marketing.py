@@ -7,9 +7,19 @@ import sys
 import json
 import time
 import requests
-import io
+import queue
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from urllib.parse import urlparse
+from http_fetch import HostLimiter, download_pdf, download_pdf_head, get_session, current_rss_mb, peak_rss_mb, sample_rss, track_peak_rss
+from json_stream import JsonStringFieldDecoder
+import perf_metrics
+from prompt_templates import registry as prompt_registry
+from tag_definitions import EMPTY as EMPTY_TAG_DEFINITIONS, TagDefinitionResolver, user_ids_in
 try:
     import pypdf
+    from pdf_extract import extract_head_page_texts, extract_page_texts, head_has_catalog
 except Exception:
     pypdf = None
     logging.warning("pypdf not available; PDF text extraction will be skipped if needed.")
@@ -19,7 +29,6 @@ try:
 except Exception:
     BeautifulSoup = None
     logging.warning("BeautifulSoup (bs4) not available; HTML scraping will use a regex fallback.")
-from bson import ObjectId
 import re
 
 # Configure UTF-8 encoding for stdout
@@ -67,43 +76,178 @@ except Exception as e:
     logging.exception(f"Error initializing Gemini model: {e}")
     model = None
 
+# Enrichment (PDF download / HTML scrape) runs concurrently over one pooled session
+ENRICH_CONCURRENCY = int(os.getenv("MARKETING_ENRICH_CONCURRENCY", "6"))
+ENRICH_PER_HOST = int(os.getenv("MARKETING_ENRICH_PER_HOST", "2"))
+# Documents not enriched by then fall back to their metadata summary
+ENRICH_DEADLINE_SECONDS = float(os.getenv("MARKETING_ENRICH_DEADLINE_SECONDS", "45"))
+_host_limiter = HostLimiter(ENRICH_PER_HOST)
+
+# build_marketing_prompt only quotes the first lines of each document, so PDFs are
+# extracted in excerpt mode: up to EXCERPT_PAGES pages / EXCERPT_CHARS characters (0 = whole document)
+EXCERPT_PAGES = int(os.getenv("MARKETING_EXCERPT_PAGES", "2"))
+EXCERPT_CHARS = int(os.getenv("MARKETING_EXCERPT_CHARS", "4000"))
+# Leading bytes requested with an HTTP range request before falling back to the whole PDF
+EXCERPT_HEAD_BYTES = int(os.getenv("MARKETING_EXCERPT_HEAD_KB", "512")) * 1024
+# A host goes straight to the full download only after this many consecutive unreadable
+# heads, and only for HEAD_HOST_SKIP_SECONDS; single PDFs are remembered by URL
+HEAD_HOST_FAILURES = int(os.getenv("MARKETING_HEAD_HOST_FAILURES", "3"))
+HEAD_HOST_SKIP_SECONDS = float(os.getenv("MARKETING_HEAD_HOST_SKIP_SECONDS", "600"))
+HEAD_FAILED_URLS = 1024
+
+
+class _HeadFallbacks:
+    """PDFs whose head could not be read (catalog at the end...); they get the full download directly."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._urls = OrderedDict()
+        self._host_failures = {}
+        self._host_skip_until = {}
+
+    def skip(self, url):
+        host = urlparse(url).hostname
+        with self._lock:
+            return url in self._urls or self._host_skip_until.get(host, 0) > time.monotonic()
+
+    def failed(self, url):
+        host = urlparse(url).hostname
+        with self._lock:
+            self._urls[url] = True
+            if len(self._urls) > HEAD_FAILED_URLS:
+                self._urls.popitem(last=False)
+            failures = self._host_failures[host] = self._host_failures.get(host, 0) + 1
+            if failures >= HEAD_HOST_FAILURES:
+                self._host_failures[host] = 0
+                self._host_skip_until[host] = time.monotonic() + HEAD_HOST_SKIP_SECONDS
+                logging.info(f"      +-- {failures} PDFs seguidos de {host} sin inicio legible; "
+                             f"descarga completa durante {HEAD_HOST_SKIP_SECONDS:.0f} s.")
+
+    def succeeded(self, url):
+        with self._lock:
+            self._host_failures.pop(urlparse(url).hostname, None)
+
+
+_head_fallbacks = _HeadFallbacks()
+
+# Gemini calls run at once when several formats (documentTypes) are requested together
+FORMAT_CONCURRENCY = int(os.getenv("MARKETING_FORMAT_CONCURRENCY", "4"))
+
+# One pooled client per process (marketing.py may serve many requests in a worker)
+_mongo_client = None
+_mongo_client_lock = threading.Lock()
+
 def connect_to_mongodb():
-    """Connects to MongoDB and returns the database object."""
+    """Connects to MongoDB reusing a global client and returns the database object."""
+    global _mongo_client
     try:
-        client = pymongo.MongoClient(DB_URI)
-        db = client[DB_NAME]
-        logging.info(f"Connected to MongoDB database: {DB_NAME}")
+        with _mongo_client_lock:
+            if _mongo_client is None:
+                _mongo_client = pymongo.MongoClient(DB_URI)
+        db = _mongo_client[DB_NAME]
+        logging.info(f"Connected (or reused connection) to MongoDB database: {DB_NAME}")
         return db
     except pymongo.errors.ConnectionFailure as e:
         logging.error(f"Could not connect to MongoDB: {e}")
         return None
 
-def ask_gemini_marketing(prompt):
-    """Asks Gemini to generate marketing content and returns the response."""
+def ask_gemini_marketing(prompt, on_delta=None, mark_first_token=True):
+    """Asks Gemini to generate marketing content and returns the response.
+
+    When ``on_delta`` is given the response is streamed and every chunk of raw text is
+    passed to it as it arrives; the return value is still the whole response.
+    Concurrent calls pass ``mark_first_token=False`` so they don't interleave stage marks.
+    """
     if not model:
         logging.error("ERROR: El modelo de Gemini no está inicializado.")
         return None
     try:
         # The detailed prompt logging is now handled in the main function
-        response = model.generate_content(prompt)
+        if on_delta is None:
+            response = model.generate_content(prompt)
+            text = response.text
+        else:
+            response = model.generate_content(prompt, stream=True)
+            parts = []
+            for chunk in response:
+                try:
+                    chunk_text = chunk.text
+                except ValueError:
+                    # Chunks without text parts (e.g. the final finish_reason chunk)
+                    continue
+                if not chunk_text:
+                    continue
+                if not parts and mark_first_token:
+                    perf_metrics.mark('gemini_first_token')
+                if not parts:
+                    logging.info("   [+] Primer fragmento recibido de Gemini.")
+                parts.append(chunk_text)
+                on_delta(chunk_text)
+            text = "".join(parts)
         logging.info("   [+] LLamada a la API de Gemini finalizada con éxito.")
-        return response.text
+        usage = getattr(response, 'usage_metadata', None)
+        if usage is not None:
+            perf_metrics.add(
+                model_calls=1,
+                prompt_tokens=getattr(usage, 'prompt_token_count', 0),
+                output_tokens=getattr(usage, 'candidates_token_count', 0)
+            )
+        return text
     except Exception as e:
         logging.error(f"   [!] Error al consultar a Gemini: {e}")
         return None
 
-def download_and_extract_text_from_pdf(pdf_url):
-    """Downloads a PDF from a URL and extracts the text content."""
+def _join_pages(pages):
+    return "".join(text for _, text, _ in pages if text)
+
+def _extract_pdf_head(pdf_url, max_pages, max_chars):
+    """Excerpt from the first EXCERPT_HEAD_BYTES of the PDF, or None when the whole file is needed."""
+    if _head_fallbacks.skip(pdf_url):
+        return None
+    try:
+        head = download_pdf_head(pdf_url, EXCERPT_HEAD_BYTES, probe=head_has_catalog, timeout=20, session=get_session())
+    except requests.exceptions.RequestException as e:
+        logging.warning(f"      +-- No se pudo descargar el inicio del PDF ({e}); se descarga completo.")
+        return None
+    perf_metrics.add(download_bytes=head.size)
+    try:
+        if head.complete:
+            pages = extract_page_texts(pdf_bytes=head.body, max_pages=max_pages, max_chars=max_chars)
+        else:
+            pages = extract_head_page_texts(head.body, max_pages=max_pages, max_chars=max_chars)
+    except Exception as e:
+        _head_fallbacks.failed(pdf_url)
+        logging.info(f"      +-- El inicio del PDF no se puede leer por separado ({e}); se descarga completo.")
+        return None
+    text = _join_pages(pages)
+    if not (head.complete or (max_pages and len(pages) >= max_pages) or (max_chars and len(text) >= max_chars)):
+        logging.info(f"      +-- Los primeros {head.size / 1024:.0f} KB solo contienen {len(pages)} páginas; se descarga completo.")
+        return None
+    _head_fallbacks.succeeded(pdf_url)
+    perf_metrics.add(page_count=len(pages), pdf_head_excerpts=1)
+    logging.info(f"      +-- Extracto de {len(pages)} páginas con los primeros {head.size / 1024:.0f} KB del PDF"
+                 f"{' (rango HTTP)' if head.range_supported else ''}.")
+    return text
+
+def download_and_extract_text_from_pdf(pdf_url, max_pages=None, max_chars=None):
+    """Downloads a PDF from a URL and extracts the text content.
+
+    With ``max_pages`` / ``max_chars`` only an excerpt is extracted, from the leading bytes
+    of the PDF when they suffice (see _extract_pdf_head) and from the full download otherwise.
+    """
     try:
         if pypdf is None:
             logging.warning("      +-- pypdf module not available; skipping PDF extraction.")
             return None
         logging.info(f"   -> Descargando y extrayendo texto del PDF: {pdf_url}")
-        response = requests.get(pdf_url, stream=True, timeout=20)
-        response.raise_for_status()
-        pdf_file = io.BytesIO(response.content)
-        reader = pypdf.PdfReader(pdf_file)
-        text = "".join(page.extract_text() for page in reader.pages)
+        with _host_limiter.slot(pdf_url):
+            text = _extract_pdf_head(pdf_url, max_pages, max_chars) if (max_pages or max_chars) else None
+            if text is None:
+                # Streamed to a temp file (size cap + deadline) and parsed through mmap
+                with download_pdf(pdf_url, timeout=20, session=get_session()) as download:
+                    pages = extract_page_texts(pdf_path=download.path, max_pages=max_pages, max_chars=max_chars)
+                    perf_metrics.add(page_count=len(pages), download_bytes=download.size)
+                text = _join_pages(pages)
         if text.strip():
             logging.info("      +-- Éxito en extracción de texto de PDF.")
             return text
@@ -122,7 +266,8 @@ def scrape_text_from_html(html_url):
     try:
         logging.info(f"   -> Haciendo web scraping de HTML: {html_url}")
         headers = {'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/58.0.3029.110 Safari/537.3'}
-        response = requests.get(html_url, timeout=20, headers=headers)
+        with _host_limiter.slot(html_url):
+            response = get_session().get(html_url, timeout=20, headers=headers)
         response.raise_for_status()
         if BeautifulSoup is not None:
             soup = BeautifulSoup(response.content, 'html.parser')
@@ -158,34 +303,148 @@ def scrape_text_from_html(html_url):
         logging.exception(f"      +-- Error en web scraping: {e}")
         return None
 
-def get_user_tag_definitions(user_id, db_cache={}):
-    """Retrieve tag definitions for a given user from MongoDB, using a simple in-memory cache."""
-    logging.info(f"[TAG_DEF] Solicitando definiciones para userId: {user_id}")
-    if user_id in db_cache:
-        logging.info("[TAG_DEF] Resultado obtenido de caché")
-        return db_cache[user_id]
-    db = connect_to_mongodb()
-    if db is None:
-        logging.warning("[TAG_DEF] No se pudo conectar a MongoDB, devolviendo vacío")
-        return {}
-    try:
-        user_doc = db['users'].find_one({"_id": ObjectId(user_id)}, {"etiquetas_personalizadas": 1})
-        if user_doc is None:
-            logging.warning("[TAG_DEF] No se encontró usuario con ese ID en la colección users")
-            db_cache[user_id] = {}
-            return {}
-        definitions = user_doc.get('etiquetas_personalizadas', {})
-        logging.info(f"[TAG_DEF] Definiciones recuperadas ({len(definitions)} keys)")
-        db_cache[user_id] = definitions
-        return definitions
-    except Exception as e:
-        logging.error(f"[TAG_DEF] Error al buscar definiciones de usuario: {e}")
-        db_cache[user_id] = {}
-        return {}
+# Process-level TTL cache of users' tag definitions, shared across requests
+_tag_resolver = TagDefinitionResolver(connect_to_mongodb)
+
+def _parse_custom_tags(doc, tag_definitions):
+    """Normalises etiquetas_personalizadas to a list of {nombre, definicion, nivel_impacto, explicacion}.
+
+    ``tag_definitions`` is the ``{userId: UserTagDefinitions}`` map resolved for all documents.
+    """
+    parsed_tags = []
+    if 'etiquetas_personalizadas' in doc and doc['etiquetas_personalizadas']:
+        if isinstance(doc['etiquetas_personalizadas'], list):
+            # Old format – already a list of dicts
+            parsed_tags = doc['etiquetas_personalizadas']
+        elif isinstance(doc['etiquetas_personalizadas'], dict):
+            # New nested format {userId: { tagName: {explicacion, nivel_impacto} } }
+            for uid, tag_obj in doc['etiquetas_personalizadas'].items():
+                logging.info(f"      >> Analizando etiquetas para userId: {uid}")
+                if not isinstance(tag_obj, dict):
+                    logging.warning("      !! tag_obj no es un dict, se ignora")
+                    continue
+                user_defs = tag_definitions.get(uid, EMPTY_TAG_DEFINITIONS)
+                logging.info(f"      >> Definiciones recuperadas para userId {uid}: keys={list(user_defs.keys())[:10]}")
+                for tag_name, tag_info in tag_obj.items():
+                    # Exact name first, then case-insensitive (indexed once per user)
+                    definicion = user_defs.get(tag_name)
+                    # Extract impacto / explicacion with fallbacks
+                    if isinstance(tag_info, dict):
+                        nivel_imp = tag_info.get('nivel_impacto', 'N/A')
+                        explic = tag_info.get('explicacion', '')
+                    elif isinstance(tag_info, str):
+                        nivel_imp = 'N/A'
+                        explic = tag_info
+                    else:
+                        nivel_imp = 'N/A'
+                        explic = ''
+
+                    logging.info(f"         -> Etiqueta encontrada: {tag_name} | Definición?: {'Sí' if definicion else 'No'} | Nivel: {nivel_imp} | Explicación: {explic[:60]}")
+
+                    parsed_tags.append({
+                        'nombre': tag_name,
+                        'definicion': definicion,
+                        'nivel_impacto': nivel_imp,
+                        'explicacion': explic
+                    })
+    return parsed_tags
+
+def _extract_document_text(i, total, doc, max_pages=None, max_chars=None):
+    """Gets the full text of one document: PDF, then HTML, then the metadata summary.
+
+    ``max_pages`` / ``max_chars`` limit PDF extraction to an excerpt.
+    Returns ``(text, source_used, seconds)``. Runs on the enrichment pool.
+    """
+    start_time = time.time()
+    full_text = None
+    source_used = "Ninguna"
+
+    # 1. Try PDF
+    if doc.get('url_pdf'):
+        pdf_text = download_and_extract_text_from_pdf(doc['url_pdf'], max_pages, max_chars)
+        if pdf_text:
+            full_text = pdf_text
+            source_used = "PDF"
+
+    # 2. Try HTML if PDF failed
+    if not full_text and doc.get('url_html'):
+        html_text = scrape_text_from_html(doc.get('url_html'))
+        if html_text:
+            full_text = html_text
+            source_used = "HTML"
+
+    # 3. Fallback to summary
+    if not full_text:
+        full_text = doc.get('resumen', '')
+        source_used = "Resumen de metadatos (Fallback)"
+
+    extraction_time = time.time() - start_time
+    logging.info(f"   [+] Documento {i}/{total} \"{doc.get('short_name', 'Sin título')}\" - Tiempo de extracción: {extraction_time:.2f} segundos. (Fuente: {source_used})")
+    return full_text, source_used, extraction_time
+
+def _extract_document_texts(documents, max_pages=None, max_chars=None):
+    """Fills ``full_text`` of every document concurrently, keeping the original order.
+
+    ``max_pages`` / ``max_chars`` declare how much text the caller uses (None = all of it).
+
+    Up to ENRICH_CONCURRENCY documents are fetched at once (ENRICH_PER_HOST per host).
+    Whatever is not done after ENRICH_DEADLINE_SECONDS uses its metadata summary.
+    Returns ``(wall_seconds, summed_seconds)``.
+    """
+    started = time.time()
+    timer = perf_metrics.current()
+    jobs = queue.Queue()
+    futures = []
+    for i, doc in enumerate(documents, 1):
+        future = Future()
+        futures.append(future)
+        jobs.put((i, doc, future))
+
+    def worker():
+        # Pool threads don't inherit the request context; page counts / bytes go to this request
+        perf_metrics.bind(timer)
+        while True:
+            try:
+                i, doc, future = jobs.get_nowait()
+            except queue.Empty:
+                return
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(_extract_document_text(i, len(documents), doc, max_pages, max_chars))
+            except Exception as e:
+                future.set_exception(e)
+
+    # Daemon threads: a fetch still running at the deadline must not keep the process alive
+    for _ in range(min(ENRICH_CONCURRENCY, len(documents))):
+        threading.Thread(target=worker, daemon=True).start()
+    done, pending = wait(futures, timeout=ENRICH_DEADLINE_SECONDS)
+    for future in pending:
+        future.cancel()
+
+    summed_time = 0.0
+    timeouts = 0
+    for i, (doc, future) in enumerate(zip(documents, futures), 1):
+        if future in done and future.exception() is None:
+            full_text, source_used, extraction_time = future.result()
+            summed_time += extraction_time
+        else:
+            if future in done:
+                logging.error(f"   [!] Error extrayendo el documento {i}: {future.exception()}")
+            else:
+                timeouts += 1
+                logging.warning(f"   [!] Documento {i} \"{doc.get('short_name', 'Sin título')}\" sin terminar tras {ENRICH_DEADLINE_SECONDS:.0f} s; se usa el resumen de metadatos")
+            full_text = doc.get('resumen', '')
+        doc['full_text'] = full_text
+        perf_metrics.add(doc_chars=len(full_text))
 
-def _normalize_tag(tag):
-    """Utility to normalize tag names for case-insensitive matching and trimming."""
-    return re.sub(r"\s+", " ", tag.strip().lower()) if isinstance(tag, str) else tag
+    wall_time = time.time() - started
+    perf_metrics.set_fields(
+        extraction_wall_ms=round(wall_time * 1000, 1),
+        extraction_summed_ms=round(summed_time * 1000, 1),
+        extraction_timeouts=timeouts
+    )
+    return wall_time, summed_time
 
 def build_marketing_prompt(documents, instructions, language, document_type, idioma='español'):
     """Builds the marketing prompt based on the provided documents and settings."""
@@ -330,46 +589,16 @@ El contenido debe estructurarse como un mensaje corto de WhatsApp con:
    - Análisis de cada documento relevante
    - Conclusiones o puntos clave en lista"""
 
-    # Build the complete prompt
+    # Build the complete prompt from prompts/generacion_contenido.md (parsed once, reloaded on change)
     try:
-        # Resolve path to ../prompts/generacion_contenido.md relative to this file
-        prompts_path = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'prompts', 'generacion_contenido.md'))
-        with open(prompts_path, 'r', encoding='utf-8') as f:
-            md_text = f.read()
-        md_trim = md_text.lstrip()
-        template = None
-        if md_trim.startswith('---'):
-            end_idx = md_trim.find('\n---')
-            if end_idx != -1:
-                yaml_block = md_trim[3:end_idx+1]
-                lines = yaml_block.split('\n')
-                current_key = None
-                buffer = []
-                for line in lines:
-                    m = re.match(r'^([A-Z_]+):\s*(\|)?\s*$', line)
-                    if m:
-                        if current_key == 'MARKETING_CONTENT':
-                            template = '\n'.join(buffer).rstrip()
-                        current_key = m.group(1).strip()
-                        buffer = []
-                    elif current_key:
-                        buffer.append(re.sub(r'^\s{2}', '', line))
-                if current_key == 'MARKETING_CONTENT' and template is None:
-                    template = '\n'.join(buffer).rstrip()
-        if not template:
-            template = md_text
+        template = prompt_registry.get('generacion_contenido', 'MARKETING_CONTENT')
     except Exception as e:
         logging.exception(f"Error loading marketing template: {e}")
         template = None
 
-    def _render(tpl: str, mapping: dict) -> str:
-        out = tpl
-        for k, v in mapping.items():
-            out = re.sub(r'\{\{'+re.escape(k)+r'\}\}', str(v or ''), out)
-        return out
-
     if template:
-        prompt = _render(template, {
+        perf_metrics.set_fields(prompt_template_version=template.version)
+        prompt = template.render({
             'INSTRUCTIONS': instructions,
             'LANGUAGE_INSTRUCTION': language_instruction,
             'DOCUMENT_STRUCTURE': document_structure,
@@ -438,105 +667,177 @@ Genera el contenido siguiendo exactamente estas instrucciones."""
 
     return prompt
 
-def main(documents_data, instructions, language, document_type, idioma='español'):
-    """Main function to generate marketing content based on documents."""
-    
+def _parse_marketing_response(gemini_response):
+    """Validates Gemini's JSON answer and returns the result dict ({success, content} or {success, error})."""
+    if gemini_response:
+        try:
+            # Clean the response (remove potential markdown fences)
+            cleaned_response = gemini_response.strip()
+            if cleaned_response.startswith("```json"):
+                cleaned_response = cleaned_response[7:]
+            if cleaned_response.startswith("```"):
+                cleaned_response = cleaned_response[3:]
+            if cleaned_response.endswith("```"):
+                cleaned_response = cleaned_response[:-3]
+            cleaned_response = cleaned_response.strip()
+
+            logging.info(f"   [+] Respuesta de Gemini procesada (longitud: {len(cleaned_response)} caracteres).")
+
+            # Parse JSON response
+            response_data = json.loads(cleaned_response)
+            html_content = response_data.get("html_content")
+
+            if html_content:
+                logging.info(f"   [+] Contenido HTML generado con éxito (longitud: {len(html_content)} caracteres).")
+                logging.info("\n" + "="*50)
+                logging.info("  PROCESO FINALIZADO CON ÉXITO")
+                logging.info("="*50 + "\n")
+                return {
+                    "success": True,
+                    "content": html_content
+                }
+            else:
+                logging.error("   [!] ERROR: La clave 'html_content' no se encontró en la respuesta JSON de Gemini.")
+                logging.error(f"      - Claves disponibles: {list(response_data.keys())}")
+                return {
+                    "success": False,
+                    "error": "La respuesta no tiene el formato HTML esperado"
+                }
+                
+        except json.JSONDecodeError as e:
+            logging.error(f"   [!] ERROR: Fallo al decodificar la respuesta JSON de Gemini: {e}")
+            logging.error(f"      - Respuesta en bruto de Gemini: {gemini_response}")
+            return {
+                "success": False,
+                "error": "La respuesta del modelo no es un JSON válido"
+            }
+        except Exception as e:
+            logging.exception(f"   [!] ERROR: Error inesperado al procesar la respuesta de Gemini: {e}")
+            return {
+                "success": False,
+                "error": "Error inesperado al procesar la respuesta"
+            }
+    else:
+        logging.error("   [!] ERROR: La API de Gemini no respondió o devolvió un error.")
+        return {
+            "success": False,
+            "error": "El modelo de IA no respondió"
+        }
+
+_stdout_lock = threading.Lock()
+
+def _emit_frame(frame):
+    """Writes one NDJSON frame to stdout and flushes so the caller can forward it immediately."""
+    line = json.dumps(frame, ensure_ascii=False, separators=(',', ':'))
+    # Formats generated concurrently must not interleave their lines
+    with _stdout_lock:
+        print(line, flush=True)
+
+def _html_delta_writer(document_type=None):
+    """on_delta callback for streaming mode: emits the html_content text of each chunk as a delta frame.
+
+    With several formats in one request each frame also names its ``format``.
+    """
+    decoder = JsonStringFieldDecoder("html_content")
+
+    def on_delta(chunk_text):
+        text = decoder.feed(chunk_text)
+        if text:
+            frame = {"type": "delta", "text": text}
+            if document_type is not None:
+                frame["format"] = document_type
+            _emit_frame(frame)
+    return on_delta
+
+def _timings_as_dict(timer):
+    """Per-step durations in ms (relative to the previous mark) plus the total."""
+    result = timer.stages()
+    if timer.total_ms() is not None:
+        result['total'] = timer.total_ms()
+        first_token = timer.since_start_ms('gemini_first_token')
+        if first_token is not None:
+            result['time_to_first_token'] = first_token
+    sample_rss(timer)
+    result['peak_rss_mb'] = timer.fields.get('peak_rss_mb')
+    return result
+
+def main(documents_data, instructions, language, document_type, idioma='español', stream=False):
+    """Main function to generate marketing content based on documents.
+
+    ``document_type`` may also be a list of formats: the documents are enriched once,
+    one prompt per format is built from them and the Gemini calls run concurrently.
+    The result is then ``{"success", "formats": {format: {"success", "content" | "error"}}}``.
+
+    With ``stream=True`` the output is NDJSON on stdout: ``{"type": "delta", "text": ...}``
+    frames carry the html_content as Gemini generates it, then a ``done`` frame carries
+    the validated content (which supersedes the deltas) and the timings, or an ``error``
+    frame. With several formats, deltas name their ``format``, each format ends with a
+    ``{"type": "result", "format", ...}`` frame and the ``done`` frame holds ``formats``.
+    The returned result dict is the same in both modes.
+    """
+    rss_start_mb = current_rss_mb()
+    timer = perf_metrics.start_request(
+        "marketing",
+        document_type=document_type,
+        language=language,
+        documents=len(documents_data or []),
+        stream=stream,
+        ok=False,
+        rss_start_mb=rss_start_mb,
+        peak_rss_mb=rss_start_mb
+    )
+    timer.mark('start')
+    result = None
+    try:
+        result = _generate_marketing_content(documents_data, instructions, language, document_type, idioma, stream)
+        if stream:
+            timer.mark('response')
+            frame = {"type": "done" if result.get("success") else "error"}
+            frame.update((key, value) for key, value in result.items() if key != "success")
+            frame["timings"] = _timings_as_dict(timer)
+            _emit_frame(frame)
+        return result
+    finally:
+        sample_rss(timer)
+        timer.finish(
+            ok=bool(result and result.get("success")),
+            error=result.get("error") if result else None
+        )
+
+def _generate_marketing_content(documents_data, instructions, language, document_type, idioma, stream=False):
     logging.info("\n" + "="*50)
     logging.info("  INICIANDO PROCESO DE ANÁLISIS Y GENERACIÓN")
     logging.info("="*50 + "\n")
 
-    total_extraction_time = 0
     enriched_documents = []
 
     logging.info("-" * 50)
     logging.info(" PASO 1: EXTRACCIÓN DE TEXTO DE DOCUMENTOS")
     logging.info("-" * 50)
 
+    # Every userId referenced by the selected documents, resolved with one query
+    tag_definitions = _tag_resolver.resolve(user_ids_in(documents_data or []))
+
     for i, doc in enumerate(documents_data, 1):
         logging.info(f"\n[ PROCESANDO DOCUMENTO {i}/{len(documents_data)}: \"{doc.get('short_name', 'Sin título')}\" ]")
         logging.info(f"   >> RAW etiquetas_personalizadas: {type(doc.get('etiquetas_personalizadas'))} - {str(doc.get('etiquetas_personalizadas'))[:500]}")
-        start_time = time.time()
-        full_text = None
-        source_used = "Ninguna"
-
-        # --- Parse etiquetas_personalizadas structure and enrich with definitions ---
-        parsed_tags = []
-        if 'etiquetas_personalizadas' in doc and doc['etiquetas_personalizadas']:
-            if isinstance(doc['etiquetas_personalizadas'], list):
-                # Old format – already a list of dicts
-                parsed_tags = doc['etiquetas_personalizadas']
-            elif isinstance(doc['etiquetas_personalizadas'], dict):
-                # New nested format {userId: { tagName: {explicacion, nivel_impacto} } }
-                for uid, tag_obj in doc['etiquetas_personalizadas'].items():
-                    logging.info(f"      >> Analizando etiquetas para userId: {uid}")
-                    if not isinstance(tag_obj, dict):
-                        logging.warning("      !! tag_obj no es un dict, se ignora")
-                        continue
-                    user_defs = get_user_tag_definitions(uid)
-                    logging.info(f"      >> Definiciones recuperadas para userId {uid}: keys={list(user_defs.keys())[:10]}")
-                    for tag_name, tag_info in tag_obj.items():
-                        # Try to obtain definition (case-insensitive)
-                        norm_tag = _normalize_tag(tag_name)
-                        definicion = ''
-                        if isinstance(user_defs, dict):
-                            if tag_name in user_defs:
-                                definicion = user_defs[tag_name]
-                            else:
-                                # case-insensitive lookup
-                                for key, val in user_defs.items():
-                                    if _normalize_tag(key) == norm_tag:
-                                        definicion = val
-                                        break
-                        # Extract impacto / explicacion with fallbacks
-                        if isinstance(tag_info, dict):
-                            nivel_imp = tag_info.get('nivel_impacto', 'N/A')
-                            explic = tag_info.get('explicacion', '')
-                        elif isinstance(tag_info, str):
-                            nivel_imp = 'N/A'
-                            explic = tag_info
-                        else:
-                            nivel_imp = 'N/A'
-                            explic = ''
-
-                        logging.info(f"         -> Etiqueta encontrada: {tag_name} | Definición?: {'Sí' if definicion else 'No'} | Nivel: {nivel_imp} | Explicación: {explic[:60]}")
-
-                        parsed_tags.append({
-                            'nombre': tag_name,
-                            'definicion': definicion,
-                            'nivel_impacto': nivel_imp,
-                            'explicacion': explic
-                        })
-        doc['etiquetas_personalizadas'] = parsed_tags  # standardise format for downstream
-
-        # 1. Try PDF
-        if doc.get('url_pdf'):
-            pdf_text = download_and_extract_text_from_pdf(doc['url_pdf'])
-            if pdf_text:
-                full_text = pdf_text
-                source_used = "PDF"
-
-        # 2. Try HTML if PDF failed
-        if not full_text and doc.get('url_html'):
-            html_text = scrape_text_from_html(doc.get('url_html'))
-            if html_text:
-                full_text = html_text
-                source_used = "HTML"
-        
-        # 3. Fallback to summary
-        if not full_text:
-            full_text = doc.get('resumen', '')
-            source_used = "Resumen de metadatos (Fallback)"
-
-        doc['full_text'] = full_text
+        doc['etiquetas_personalizadas'] = _parse_custom_tags(doc, tag_definitions)  # standardise format for downstream
         enriched_documents.append(doc)
 
-        end_time = time.time()
-        extraction_time = end_time - start_time
-        total_extraction_time += extraction_time
-        logging.info(f"   [+] Tiempo de extracción: {extraction_time:.2f} segundos. (Fuente: {source_used})")
-
+    # The prompt quotes only the beginning of each document; RSS is polled while the PDFs are parsed
+    with track_peak_rss():
+        wall_time, total_extraction_time = _extract_document_texts(enriched_documents, EXCERPT_PAGES, EXCERPT_CHARS)
+    perf_metrics.mark('extraction')
     logging.info("\n" + "-"*50)
-    logging.info(f" TIEMPO TOTAL DE EXTRACCIÓN: {total_extraction_time:.2f} segundos para {len(documents_data)} documentos")
+    logging.info(f" TIEMPO TOTAL DE EXTRACCIÓN: {wall_time:.2f} segundos de reloj para {len(documents_data)} documentos")
+    speedup = f" (x{total_extraction_time / wall_time:.1f} por concurrencia)" if wall_time > 0 else ""
+    logging.info(f" SUMA DE TIEMPOS POR DOCUMENTO: {total_extraction_time:.2f} segundos{speedup}")
+    request_rss = perf_metrics.current().fields.get('peak_rss_mb')
+    if request_rss is not None:
+        logging.info(f" PICO DE MEMORIA (RSS durante esta petición): {request_rss:.1f} MB")
+    rss = peak_rss_mb()
+    if rss is not None:
+        logging.info(f" PICO DE MEMORIA (RSS del proceso desde su arranque): {rss:.1f} MB")
     logging.info("-" * 50 + "\n")
     
     if not documents_data:
@@ -577,92 +878,108 @@ def main(documents_data, instructions, language, document_type, idioma='español
 
     logging.info("\n[RESUMEN RAW DOCUMENTS INPUT] -> Primer documento recibido:\n" + json.dumps(documents_data[0], ensure_ascii=False)[:1000] if documents_data else "No documents_data")
 
+    if isinstance(document_type, (list, tuple)):
+        return _generate_formats(enriched_documents, instructions, language, document_type, idioma, stream)
+
     prompt = build_marketing_prompt(enriched_documents, instructions, language, document_type, idioma)
+    perf_metrics.set_fields(prompt_chars=len(prompt))
+    perf_metrics.mark('prompt_build')
     
     logging.info("\n" + "="*50)
     logging.info(" PASO 3: LLAMADA A LA API DE GEMINI")
     logging.info("="*50 + "\n")
 
     api_start_time = time.time()
-    gemini_response = ask_gemini_marketing(prompt)
+    gemini_response = ask_gemini_marketing(prompt, _html_delta_writer() if stream else None)
     api_end_time = time.time()
     api_duration = api_end_time - api_start_time
+    perf_metrics.mark('gemini_call')
     
     logging.info(f"\n   [+] Tiempo de respuesta de la API: {api_duration:.2f} segundos.")
     
-    if gemini_response:
-        try:
-            # Clean the response (remove potential markdown fences)
-            cleaned_response = gemini_response.strip()
-            if cleaned_response.startswith("```json"):
-                cleaned_response = cleaned_response[7:]
-            if cleaned_response.startswith("```"):
-                cleaned_response = cleaned_response[3:]
-            if cleaned_response.endswith("```"):
-                cleaned_response = cleaned_response[:-3]
-            cleaned_response = cleaned_response.strip()
+    return _parse_marketing_response(gemini_response)
 
-            logging.info(f"   [+] Respuesta de Gemini procesada (longitud: {len(cleaned_response)} caracteres).")
+def _generate_formats(documents, instructions, language, document_types, idioma, stream=False):
+    """Generates every format from the same enriched documents, with concurrent Gemini calls.
 
-            # Parse JSON response
-            response_data = json.loads(cleaned_response)
-            html_content = response_data.get("html_content")
+    Returns ``{"success", "formats": {format: result}}``; ``success`` is True if any format succeeded.
+    """
+    formats = list(dict.fromkeys(document_types))
+    if not formats:
+        return {"success": False, "error": "No se indicó ningún tipo de documento"}
+    prompts = {fmt: build_marketing_prompt(documents, instructions, language, fmt, idioma) for fmt in formats}
+    perf_metrics.set_fields(prompt_chars=sum(len(prompt) for prompt in prompts.values()), formats=len(formats))
+    perf_metrics.mark('prompt_build')
 
-            if html_content:
-                logging.info(f"   [+] Contenido HTML generado con éxito (longitud: {len(html_content)} caracteres).")
-                logging.info("\n" + "="*50)
-                logging.info("  PROCESO FINALIZADO CON ÉXITO")
-                logging.info("="*50 + "\n")
-                return {
-                    "success": True,
-                    "content": html_content
-                }
-            else:
-                logging.error("   [!] ERROR: La clave 'html_content' no se encontró en la respuesta JSON de Gemini.")
-                logging.error(f"      - Claves disponibles: {list(response_data.keys())}")
-                return {
-                    "success": False,
-                    "error": "La respuesta no tiene el formato HTML esperado"
-                }
-                
-        except json.JSONDecodeError as e:
-            logging.error(f"   [!] ERROR: Fallo al decodificar la respuesta JSON de Gemini: {e}")
-            logging.error(f"      - Respuesta en bruto de Gemini: {gemini_response}")
-            return {
-                "success": False,
-                "error": "La respuesta del modelo no es un JSON válido"
-            }
-        except Exception as e:
-            logging.exception(f"   [!] ERROR: Error inesperado al procesar la respuesta de Gemini: {e}")
-            return {
-                "success": False,
-                "error": "Error inesperado al procesar la respuesta"
-            }
+    logging.info("\n" + "="*50)
+    logging.info(f" PASO 3: LLAMADAS A LA API DE GEMINI ({len(formats)} formatos: {', '.join(formats)})")
+    logging.info("="*50 + "\n")
+
+    timer = perf_metrics.current()
+
+    def generate(fmt):
+        # Pool threads don't inherit the request context; token counts go to this request
+        perf_metrics.bind(timer)
+        started = time.time()
+        on_delta = _html_delta_writer(fmt) if stream else None
+        result = _parse_marketing_response(ask_gemini_marketing(prompts[fmt], on_delta, mark_first_token=False))
+        elapsed = time.time() - started
+        logging.info(f"   [+] Formato '{fmt}' - Tiempo de generación: {elapsed:.2f} segundos. ({'éxito' if result.get('success') else result.get('error')})")
+        if stream:
+            _emit_frame({"type": "result", "format": fmt, **result})
+        return result, elapsed
+
+    started = time.time()
+    with ThreadPoolExecutor(max_workers=max(1, min(FORMAT_CONCURRENCY, len(formats))), thread_name_prefix="marketing-format") as pool:
+        outcomes = dict(zip(formats, pool.map(generate, formats)))
+    wall_time = time.time() - started
+    summed_time = sum(elapsed for _, elapsed in outcomes.values())
+    perf_metrics.mark('gemini_call')
+    perf_metrics.set_fields(
+        gemini_wall_ms=round(wall_time * 1000, 1),
+        gemini_summed_ms=round(summed_time * 1000, 1)
+    )
+    logging.info(f"\n   [+] Tiempo total de generación: {wall_time:.2f} segundos de reloj (suma por formato: {summed_time:.2f} segundos).")
+
+    results = {fmt: result for fmt, (result, _) in outcomes.items()}
+    response = {"success": any(result.get("success") for result in results.values()), "formats": results}
+    if not response["success"]:
+        response["error"] = next(iter(results.values())).get("error")
+    return response
+
+def _print_result(result, stream):
+    """Prints the JSON result; in streaming mode main() has already written the final frame."""
+    if not stream:
+        # Print with UTF-8 encoding and ensure_ascii=False for Spanish characters
+        print(json.dumps(result, ensure_ascii=False, separators=(',', ':')))
+
+def _print_error(message, stream):
+    if stream:
+        _emit_frame({"type": "error", "error": message})
     else:
-        logging.error("   [!] ERROR: La API de Gemini no respondió o devolvió un error.")
-        return {
-            "success": False,
-            "error": "El modelo de IA no respondió"
-        }
+        print(json.dumps({"success": False, "error": message}, ensure_ascii=False, separators=(',', ':')))
 
 if __name__ == "__main__":
+    # --stream (or "stream": true in the input) switches the output to NDJSON frames, see main()
+    stream = "--stream" in sys.argv[1:]
+    argv = [arg for arg in sys.argv if arg != "--stream"]
     # This allows the script to be called directly for testing
-    if len(sys.argv) > 1:
+    if len(argv) > 1:
         # Parse command line arguments for testing
         try:
-            test_data = json.loads(sys.argv[1])
+            test_data = json.loads(argv[1])
+            stream = stream or bool(test_data.get('stream'))
             result = main(
                 test_data.get('documents', []),
                 test_data.get('instructions', ''),
                 test_data.get('language', 'juridico'),
-                test_data.get('documentType', 'whatsapp'),
-                test_data.get('idioma', 'español')
+                test_data.get('documentTypes') or test_data.get('documentType', 'whatsapp'),
+                test_data.get('idioma', 'español'),
+                stream=stream
             )
-            # Print with UTF-8 encoding and ensure_ascii=False for Spanish characters
-            print(json.dumps(result, ensure_ascii=False, separators=(',', ':')))
+            _print_result(result, stream)
         except Exception as e:
-            error_result = {"success": False, "error": str(e)}
-            print(json.dumps(error_result, ensure_ascii=False, separators=(',', ':')))
+            _print_error(str(e), stream)
     else:
         # Read from stdin when no arguments are provided (called from Node.js)
         try:
@@ -670,18 +987,17 @@ if __name__ == "__main__":
             input_data = sys.stdin.read().strip()
             if input_data:
                 test_data = json.loads(input_data)
+                stream = stream or bool(test_data.get('stream'))
                 result = main(
                     test_data.get('documents', []),
                     test_data.get('instructions', ''),
                     test_data.get('language', 'juridico'),
-                    test_data.get('documentType', 'whatsapp'),
-                    test_data.get('idioma', 'español')
+                    test_data.get('documentTypes') or test_data.get('documentType', 'whatsapp'),
+                    test_data.get('idioma', 'español'),
+                    stream=stream
                 )
-                # Print with UTF-8 encoding and ensure_ascii=False for Spanish characters
-                print(json.dumps(result, ensure_ascii=False, separators=(',', ':')))
+                _print_result(result, stream)
             else:
-                error_result = {"success": False, "error": "No input data provided"}
-                print(json.dumps(error_result, ensure_ascii=False, separators=(',', ':')))
+                _print_error("No input data provided", stream)
         except Exception as e:
-            error_result = {"success": False, "error": str(e)}
-            print(json.dumps(error_result, ensure_ascii=False, separators=(',', ':')))
+            _print_error(str(e), stream)
@@ -0,0 +1,489 @@
+"""
+Page-level PDF text extraction behind one interface, with pluggable backends.
+
+Backends wrap the PDF libraries used across the codebase: PyMuPDF (pymupdf/fitz),
+pypdf, PyPDF2 and pdfplumber. pypdf is a hard requirement; the others are used
+when installed. Each document is extracted with the fastest available backend,
+ranked by measured milliseconds per page once a backend has handled
+PDF_BACKEND_MEASURE_MIN_PAGES pages (a typical per-page cost until then), so
+PyMuPDF leads when it is installed. PDF_BACKEND moves one backend to the front.
+When a backend cannot open a document, or returns no text at all, the next one
+is tried for that document. Per-backend documents, failures, pages, characters
+and time are kept in backend_stats() and in the perf_metrics histograms
+(pipeline "pdf_extract"), and every request records the backend it used.
+
+The pure-Python backends are CPU-bound on a single core, so above
+PDF_PARALLEL_MIN_PAGES pages the page range is split across a process pool: the
+PDF bytes are written once to a temp file, each worker opens it and extracts its
+slice, and the parent reassembles the pages in order. Small PDFs keep the
+sequential path, where spinning up workers would cost more than it saves.
+Spooled downloads (see http_fetch.py) are passed by path and read through mmap,
+so the PDF is never copied onto the heap.
+
+Excerpt mode: callers that only need the beginning of a document pass max_pages /
+max_chars and extraction stops there (sequentially, since only a few pages are
+read). extract_head_page_texts reads the leading bytes of a PDF fetched with an
+HTTP range request: linearized files (and those written catalog-first) put the
+catalog, page tree and first pages at the start, so the truncated head is closed
+with a rebuilt xref table and the pages it fully contains are extracted without
+downloading the rest. PDFs that keep the catalog at the end need the whole file.
+
+This module has no import-time side effects so pool workers can import it cheaply.
+"""
+
+import io
+import logging
+import mmap
+import multiprocessing
+import os
+import re
+import tempfile
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager
+
+import pypdf
+from pypdf.errors import PdfReadError
+
+import perf_metrics
+
+try:
+    import pymupdf
+except ImportError:
+    try:
+        import fitz as pymupdf  # PyMuPDF < 1.24
+    except ImportError:
+        pymupdf = None
+
+try:
+    import PyPDF2
+except ImportError:
+    PyPDF2 = None
+
+try:
+    import pdfplumber
+except ImportError:
+    pdfplumber = None
+
+PARALLEL_MIN_PAGES = int(os.getenv('PDF_PARALLEL_MIN_PAGES', '40'))
+PARALLEL_WORKERS = int(os.getenv('PDF_PARALLEL_WORKERS', str(min(4, os.cpu_count() or 1))))
+# Backend tried first (pymupdf, pypdf, pypdf2 or pdfplumber); the others remain fallbacks
+PREFERRED_BACKEND = os.getenv('PDF_BACKEND', '').strip().lower() or None
+# Pages a backend must have extracted before its measured speed replaces its typical one
+MEASURE_MIN_PAGES = int(os.getenv('PDF_BACKEND_MEASURE_MIN_PAGES', '50'))
+
+_pool = None
+_pool_lock = threading.Lock()
+
+_OBJECT_HEADER = re.compile(rb'(?<![0-9])(\d+)\s+(\d+)\s+obj\b')
+_CATALOG = re.compile(rb'/Type\s*/Catalog\b')
+
+
+class PdfBackend:
+    """One PDF library behind the common interface: ``open()`` a document, then page_count / page_text."""
+
+    name = None
+    module = None
+    # Rough single-core cost, used to rank backends until real timings exist
+    typical_ms_per_page = None
+    # CPU-bound pure-Python extractors are worth fanning out to the process pool
+    parallel = True
+
+    @property
+    def available(self):
+        return self.module is not None
+
+    @contextmanager
+    def open(self, pdf_bytes=None, pdf_path=None):
+        document = self._open(pdf_bytes, pdf_path)
+        try:
+            yield document
+        finally:
+            self._close(document)
+
+    def _close(self, document):
+        pass
+
+
+class PypdfBackend(PdfBackend):
+    name = 'pypdf'
+    module = pypdf
+    typical_ms_per_page = 25
+
+    def _open(self, pdf_bytes, pdf_path):
+        # (reader, mmap or None): a spooled file is read through mmap rather than copied
+        if pdf_path is None:
+            return self.module.PdfReader(io.BytesIO(pdf_bytes)), None
+        with open(pdf_path, 'rb') as f:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            return self.module.PdfReader(mapped), mapped
+        except BaseException:
+            mapped.close()
+            raise
+
+    def _close(self, document):
+        if document[1] is not None:
+            document[1].close()
+
+    def page_count(self, document):
+        return len(document[0].pages)
+
+    def page_text(self, document, page_num):
+        return document[0].pages[page_num].extract_text()
+
+
+class PyPDF2Backend(PypdfBackend):
+    name = 'pypdf2'
+    module = PyPDF2
+    typical_ms_per_page = 30
+
+
+class PdfplumberBackend(PdfBackend):
+    name = 'pdfplumber'
+    module = pdfplumber
+    typical_ms_per_page = 80
+
+    def _open(self, pdf_bytes, pdf_path):
+        return self.module.open(pdf_path if pdf_path is not None else io.BytesIO(pdf_bytes))
+
+    def _close(self, document):
+        document.close()
+
+    def page_count(self, document):
+        return len(document.pages)
+
+    def page_text(self, document, page_num):
+        page = document.pages[page_num]
+        try:
+            return page.extract_text()
+        finally:
+            # Drops the page's parsed layout objects; pdfplumber keeps them otherwise
+            if hasattr(page, 'close'):
+                page.close()
+
+
+class PymupdfBackend(PdfBackend):
+    name = 'pymupdf'
+    module = pymupdf
+    typical_ms_per_page = 2
+    # Native code: a single process is already faster than a pool of pypdf workers
+    parallel = False
+
+    def _open(self, pdf_bytes, pdf_path):
+        if pdf_path is not None:
+            return self.module.open(pdf_path)
+        return self.module.open(stream=pdf_bytes, filetype='pdf')
+
+    def _close(self, document):
+        document.close()
+
+    def page_count(self, document):
+        return document.page_count
+
+    def page_text(self, document, page_num):
+        return document.load_page(page_num).get_text()
+
+
+BACKENDS = {
+    backend.name: backend
+    for backend in (PymupdfBackend(), PypdfBackend(), PyPDF2Backend(), PdfplumberBackend())
+    if backend.available
+}
+
+_stats = {name: Counter() for name in BACKENDS}
+_stats_lock = threading.Lock()
+
+
+def _ms_per_page(name):
+    with _stats_lock:
+        stats = _stats[name]
+        if stats['pages'] >= MEASURE_MIN_PAGES:
+            return stats['ms'] / stats['pages']
+    return BACKENDS[name].typical_ms_per_page
+
+
+def backend_order():
+    """Installed backends, fastest first (PDF_BACKEND, when installed, leads)."""
+    order = sorted(BACKENDS, key=_ms_per_page)
+    if PREFERRED_BACKEND in BACKENDS:
+        order.remove(PREFERRED_BACKEND)
+        order.insert(0, PREFERRED_BACKEND)
+    return order
+
+
+def backend_stats():
+    """``{"order": [...], "backends": {name: {documents, failures, empty, pages, chars, ms, ms_per_page}}}``."""
+    with _stats_lock:
+        backends = {
+            name: {
+                'documents': stats['documents'],
+                'failures': stats['failures'],
+                'empty': stats['empty'],
+                'pages': stats['pages'],
+                'chars': stats['chars'],
+                'ms': round(stats['ms'], 1),
+                'ms_per_page': round(stats['ms'] / stats['pages'], 2) if stats['pages'] else None,
+            }
+            for name, stats in _stats.items()
+        }
+    return {'order': backend_order(), 'backends': backends}
+
+
+def _record(name, ms, outcome, pages=0, chars=0):
+    """Adds one document to the backend's counters; ``outcome`` is documents, empty or failures."""
+    with _stats_lock:
+        stats = _stats[name]
+        stats[outcome] += 1
+        if outcome != 'failures':
+            stats['pages'] += pages
+            stats['chars'] += chars
+            stats['ms'] += ms
+    perf_metrics.observe('pdf_extract', name, round(ms, 1))
+
+
+def _get_pool():
+    """Lazily creates the shared process pool (reused across requests in worker mode).
+
+    The calling process runs the event loop, gRPC and worker threads, and forking it could
+    leave a child blocked on a lock held at fork time. Workers therefore come from a
+    forkserver that preloads this module (spawn where forkserver is unavailable); tasks
+    only reference the module-level _extract_page_range_from_file.
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            if 'forkserver' in multiprocessing.get_all_start_methods():
+                context = multiprocessing.get_context('forkserver')
+                context.set_forkserver_preload([__name__])
+            else:
+                context = multiprocessing.get_context('spawn')
+            _pool = ProcessPoolExecutor(max_workers=PARALLEL_WORKERS, mp_context=context)
+        return _pool
+
+
+def _discard_pool(pool):
+    """Drops a broken pool so the next parallel extraction creates a new one."""
+    global _pool
+    with _pool_lock:
+        if _pool is pool:
+            _pool = None
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+def _extract_pages(backend, document, start, end):
+    """Extracts pages [start, end) from an open document as (page_num, text, error) tuples."""
+    results = []
+    for page_num in range(start, end):
+        try:
+            results.append((page_num, backend.page_text(document, page_num), None))
+        except Exception as e:
+            results.append((page_num, None, str(e)))
+    return results
+
+
+def _extract_leading_pages(backend, document, max_pages=None, max_chars=None, stop_on_error=False):
+    """Extracts pages from the start until ``max_pages`` pages or ``max_chars`` characters are reached."""
+    total_pages = backend.page_count(document)
+    end = min(total_pages, max_pages) if max_pages else total_pages
+    results = []
+    chars = 0
+    for page_num in range(end):
+        try:
+            text = backend.page_text(document, page_num)
+        except Exception as e:
+            if stop_on_error:
+                break
+            results.append((page_num, None, str(e)))
+            continue
+        results.append((page_num, text, None))
+        chars += len(text or '')
+        if max_chars and chars >= max_chars:
+            break
+    return results
+
+
+def _extract_page_range_from_file(backend_name, pdf_path, start, end):
+    """Pool worker: opens the PDF from ``pdf_path`` and extracts pages [start, end)."""
+    backend = BACKENDS[backend_name]
+    with backend.open(pdf_path=pdf_path) as document:
+        return _extract_pages(backend, document, start, end)
+
+
+def _split_ranges(total_pages, parts):
+    size, remainder = divmod(total_pages, parts)
+    ranges = []
+    start = 0
+    for i in range(parts):
+        end = start + size + (1 if i < remainder else 0)
+        if end > start:
+            ranges.append((start, end))
+        start = end
+    return ranges
+
+
+def extract_page_texts(pdf_bytes=None, pdf_path=None, max_pages=None, max_chars=None, backends=None):
+    """Returns ``[(page_num, text, error), ...]`` for every page, in page order.
+
+    Pass either the PDF bytes or the path of a spooled download; a path is read
+    through mmap and handed to pool workers directly without another copy.
+    With ``max_pages`` / ``max_chars`` only the leading pages are extracted.
+    ``backends`` overrides the backend order (names from BACKENDS).
+
+    Raises pypdf.errors.PdfReadError if no backend can open the document; errors on
+    individual pages are returned in the ``error`` slot so callers keep per-page tolerance.
+    """
+    first_error = None
+    empty_results = None
+    tried = []
+    for name in backends or backend_order():
+        backend = BACKENDS[name]
+        tried.append(name)
+        started = time.perf_counter()
+        try:
+            results = _extract_with_backend(backend, pdf_bytes, pdf_path, max_pages, max_chars)
+        except Exception as e:
+            _record(name, (time.perf_counter() - started) * 1000, 'failures')
+            logging.warning(f"PDF backend {name} could not read the document: {e}")
+            first_error = first_error or e
+            continue
+        ms = (time.perf_counter() - started) * 1000
+        chars = sum(len(text or '') for _, text, _ in results)
+        if not chars:
+            _record(name, ms, 'empty', pages=len(results))
+            logging.warning(f"PDF backend {name} extracted no text from {len(results)} pages")
+            if empty_results is None:
+                empty_results = (name, ms, results)
+            continue
+        _record(name, ms, 'documents', pages=len(results), chars=chars)
+        _record_request(name, tried, ms, chars)
+        logging.info(f"Extracted {len(results)} pages ({chars} chars) with {name} in {ms:.0f} ms")
+        return results
+    if empty_results is not None:
+        name, ms, results = empty_results
+        _record_request(name, tried, ms, 0)
+        return results
+    if isinstance(first_error, PdfReadError):
+        raise first_error
+    raise PdfReadError(f"No PDF backend could read the document ({', '.join(tried)}): {first_error}") from first_error
+
+
+def _record_request(name, tried, ms, chars):
+    """Backend used, its time and output length, and the fallbacks taken, on the current request record."""
+    perf_metrics.set_fields(pdf_backend=name)
+    perf_metrics.add(pdf_backend_ms=round(ms, 1), pdf_backend_chars=chars, pdf_backend_fallbacks=len(tried) - 1)
+
+
+def _extract_with_backend(backend, pdf_bytes, pdf_path, max_pages, max_chars):
+    with backend.open(pdf_bytes, pdf_path) as document:
+        if max_pages or max_chars:
+            return _extract_leading_pages(backend, document, max_pages, max_chars)
+        total_pages = backend.page_count(document)
+        if not backend.parallel or total_pages < PARALLEL_MIN_PAGES or PARALLEL_WORKERS < 2:
+            return _extract_pages(backend, document, 0, total_pages)
+        return _extract_parallel(backend, document, total_pages, pdf_bytes, pdf_path)
+
+
+def _extract_parallel(backend, document, total_pages, pdf_bytes=None, pdf_path=None):
+    ranges = _split_ranges(total_pages, PARALLEL_WORKERS)
+    logging.info(f"Extracting {total_pages} pages in parallel with {backend.name} ({len(ranges)} workers)")
+    temp_path = None
+    pool = None
+    try:
+        if pdf_path is None:
+            fd, temp_path = tempfile.mkstemp(suffix='.pdf')
+            with os.fdopen(fd, 'wb') as f:
+                f.write(pdf_bytes)
+            pdf_path = temp_path
+        pool = _get_pool()
+        futures = [pool.submit(_extract_page_range_from_file, backend.name, pdf_path, start, end) for start, end in ranges]
+        results = []
+        for future in futures:
+            results.extend(future.result())
+        results.sort(key=lambda item: item[0])
+        return results
+    except (BrokenProcessPool, OSError) as e:
+        logging.warning(f"Parallel PDF extraction failed ({e}); falling back to sequential")
+        if pool is not None:
+            _discard_pool(pool)
+        return _extract_pages(backend, document, 0, total_pages)
+    finally:
+        if temp_path is not None:
+            try:
+                os.remove(temp_path)
+            except OSError:
+                pass
+
+
+_head_parse = threading.local()
+_head_filter_installed = False
+
+
+class _MissingObjectFilter(logging.Filter):
+    """Drops pypdf's "Object N not defined" warnings while this thread parses a truncated head,
+    where the objects past the cut are missing by construction."""
+
+    def filter(self, record):
+        return not getattr(_head_parse, 'active', False)
+
+
+def head_has_catalog(head):
+    """True when the document catalog is within ``head``, i.e. a truncated head can be parsed."""
+    return _CATALOG.search(head) is not None
+
+
+def _close_truncated_pdf(head):
+    """Makes the leading bytes of a PDF parseable: cuts at the last complete object and
+    appends an xref table and trailer pointing at the objects found (and the catalog)."""
+    end = head.rfind(b'endobj')
+    if end == -1:
+        raise PdfReadError("No complete object in the PDF head")
+    head = head[:end + len(b'endobj')]
+    offsets = {}
+    root = None
+    for m in _OBJECT_HEADER.finditer(head):
+        number, generation = int(m.group(1)), int(m.group(2))
+        offsets[number] = (m.start(), generation)
+        if root is None:
+            body_end = head.find(b'endobj', m.end())
+            if _CATALOG.search(head, m.end(), body_end):
+                root = (number, generation)
+    if root is None:
+        raise PdfReadError("Document catalog is not in the PDF head")
+    size = max(offsets) + 1
+    lines = [b'', b'xref', b'0 %d' % size]
+    for number in range(size):
+        lines.append(b'%010d %05d n ' % offsets[number] if number in offsets else b'0000000000 65535 f ')
+    lines.append(b'trailer\n<< /Size %d /Root %d %d R >>\nstartxref\n%d\n%%%%EOF\n' % (size, root[0], root[1], len(head) + 1))
+    return head + b'\n'.join(lines)
+
+
+def extract_head_page_texts(head, max_pages=None, max_chars=None):
+    """Extracts the leading pages contained in ``head``, the first bytes of a linearized PDF.
+
+    The objects inside compressed object streams are not indexed, so heads that
+    rely on them fail like non-linearized ones and the caller downloads the file.
+
+    The last page reached may be cut off, so only the pages before it are used.
+    Returns the same tuples as extract_page_texts (possibly fewer pages than asked
+    for); raises PdfReadError when the head holds no complete page.
+    """
+    global _head_filter_installed
+    if not _head_filter_installed:
+        logging.getLogger('pypdf._reader').addFilter(_MissingObjectFilter())
+        _head_filter_installed = True
+    # The rebuilt xref is read by pypdf; the other backends would repair the file their own way
+    backend = BACKENDS['pypdf']
+    _head_parse.active = True
+    try:
+        with backend.open(pdf_bytes=_close_truncated_pdf(head)) as document:
+            complete_pages = backend.page_count(document) - 1
+            if complete_pages < 1:
+                raise PdfReadError("No complete page in the PDF head")
+            max_pages = min(max_pages, complete_pages) if max_pages else complete_pages
+            return _extract_leading_pages(backend, document, max_pages, max_chars, stop_on_error=True)
+    finally:
+        _head_parse.active = False
@@ -0,0 +1,249 @@
+"""
+Per-request stage timings as machine-readable records, plus rolling latency percentiles.
+
+Every Python entry point (questionsMongo.py, marketing.py and the legal initiatives
+processors) times its stages with a RequestTimer. When a request finishes, the timer
+does two things:
+
+- it writes one JSON line with the stage durations and the request attributes
+  (document size, page count, cache hits, model tokens, ...) to the metrics sink;
+- it feeds the durations into in-process rolling histograms, so a long-lived worker
+  can report p50/p95/p99 per stage on demand (see the "metrics" command in
+  analysis_worker.py).
+
+Record format:
+    {"ts": "2024-05-01T10:00:00.123+00:00", "pipeline": "questionsMongo",
+     "stages": {"mongo_connect_end": 12.3, ...}, "total_ms": 2210.4,
+     "document_id": "BOE-A-2024-1", "doc_chars": 48211, "page_count": 12, ...}
+
+The sink is configured with environment variables:
+    PERF_METRICS_FD    file descriptor to write records to, e.g. an extra stdio pipe
+                       opened by the Node parent (takes precedence)
+    PERF_METRICS_FILE  JSONL file to append records to
+With neither set no records are written, but the histograms are still kept.
+"""
+
+import contextvars
+import json
+import logging
+import math
+import os
+import threading
+import time
+from collections import deque
+from datetime import datetime, timezone
+
+HISTOGRAM_WINDOW = int(os.getenv('PERF_METRICS_WINDOW', '1000'))
+PERCENTILES = (50, 95, 99)
+
+_sink = None
+_sink_opened = False
+_sink_lock = threading.Lock()
+
+
+def _get_sink():
+    """Opens the configured sink once; returns None when records are disabled."""
+    global _sink, _sink_opened
+    if not _sink_opened:
+        _sink_opened = True
+        fd = os.getenv('PERF_METRICS_FD')
+        path = os.getenv('PERF_METRICS_FILE')
+        try:
+            if fd:
+                _sink = os.fdopen(int(fd), 'a', buffering=1, encoding='utf-8', closefd=False)
+            elif path:
+                directory = os.path.dirname(path)
+                if directory:
+                    os.makedirs(directory, exist_ok=True)
+                _sink = open(path, 'a', buffering=1, encoding='utf-8')
+        except (OSError, ValueError) as e:
+            logging.warning(f"Metrics sink unavailable ({e}); timing records disabled")
+            _sink = None
+    return _sink
+
+
+def write_record(record):
+    """Writes one record as a JSON line to the sink (no-op when disabled)."""
+    line = json.dumps(record, ensure_ascii=False, default=str) + '\n'
+    with _sink_lock:
+        sink = _get_sink()
+        if sink is None:
+            return
+        try:
+            sink.write(line)
+        except OSError as e:
+            logging.warning(f"Could not write timing record: {e}")
+
+
+class RollingHistogram:
+    """Keeps the last ``window`` samples of a latency and computes percentiles over them."""
+
+    def __init__(self, window=HISTOGRAM_WINDOW):
+        self._samples = deque(maxlen=window)
+        self.count = 0
+
+    def add(self, value):
+        self._samples.append(value)
+        self.count += 1
+
+    def summary(self):
+        samples = sorted(self._samples)
+        if not samples:
+            return {"count": self.count, "window": 0}
+        result = {"count": self.count, "window": len(samples), "min": samples[0], "max": samples[-1]}
+        for p in PERCENTILES:
+            # Nearest-rank percentile
+            rank = max(1, math.ceil(p / 100 * len(samples)))
+            result[f"p{p}"] = samples[rank - 1]
+        return result
+
+
+_histograms = {}
+_histograms_lock = threading.Lock()
+
+
+def observe(pipeline, stage, duration_ms):
+    """Adds one latency sample (ms) to the rolling histogram of ``pipeline``/``stage``."""
+    with _histograms_lock:
+        histogram = _histograms.get((pipeline, stage))
+        if histogram is None:
+            histogram = _histograms[(pipeline, stage)] = RollingHistogram()
+        histogram.add(duration_ms)
+
+
+def snapshot(reset=False):
+    """Returns ``{pipeline: {stage: {count, window, min, max, p50, p95, p99}}}``."""
+    with _histograms_lock:
+        result = {}
+        for (pipeline, stage), histogram in sorted(_histograms.items()):
+            result.setdefault(pipeline, {})[stage] = histogram.summary()
+        if reset:
+            _histograms.clear()
+    return result
+
+
+class RequestTimer:
+    """Collects the stage marks and attributes of one request.
+
+    ``mark(step)`` records a timestamp; a stage's duration is the time since the
+    previous mark, so the first mark is the request start. ``finish()`` emits the
+    record and updates the histograms (once; later calls are ignored).
+    """
+
+    def __init__(self, pipeline, **fields):
+        self.pipeline = pipeline
+        self.fields = dict(fields)
+        self.marks = []
+        self.started_at = datetime.now(timezone.utc)
+        self.finished = False
+        self._lock = threading.Lock()
+
+    def mark(self, step):
+        self.marks.append((step, time.perf_counter()))
+
+    def set(self, **fields):
+        with self._lock:
+            self.fields.update(fields)
+
+    def add(self, **counters):
+        """Increments numeric attributes (safe to call from helper threads, e.g. token counts)."""
+        with self._lock:
+            for name, value in counters.items():
+                self.fields[name] = self.fields.get(name, 0) + (value or 0)
+
+    def maximum(self, **fields):
+        """Keeps the highest value seen for each attribute (e.g. RSS samples from a poller thread)."""
+        with self._lock:
+            for name, value in fields.items():
+                if value is not None and (self.fields.get(name) is None or value > self.fields[name]):
+                    self.fields[name] = value
+
+    def stages(self):
+        """Per-step durations in ms, relative to the previous mark."""
+        return {
+            self.marks[i][0]: round((self.marks[i][1] - self.marks[i - 1][1]) * 1000, 1)
+            for i in range(1, len(self.marks))
+        }
+
+    def total_ms(self):
+        if len(self.marks) < 2:
+            return None
+        return round((self.marks[-1][1] - self.marks[0][1]) * 1000, 1)
+
+    def since_start_ms(self, step):
+        """Time from the first mark to the first ``step`` mark, or None."""
+        at = next((t for name, t in self.marks if name == step), None)
+        if at is None or not self.marks:
+            return None
+        return round((at - self.marks[0][1]) * 1000, 1)
+
+    def record(self):
+        with self._lock:
+            fields = dict(self.fields)
+        return {
+            "ts": self.started_at.isoformat(timespec='milliseconds'),
+            "pipeline": self.pipeline,
+            "stages": self.stages(),
+            "total_ms": self.total_ms(),
+            **fields,
+        }
+
+    def finish(self, **fields):
+        """Emits the record and feeds the histograms. Returns the record."""
+        if self.finished:
+            return None
+        self.finished = True
+        self.set(**fields)
+        record = self.record()
+        for stage, duration_ms in record["stages"].items():
+            observe(self.pipeline, stage, duration_ms)
+        if record["total_ms"] is not None:
+            observe(self.pipeline, "total", record["total_ms"])
+        write_record(record)
+        return record
+
+
+# Current request, for code paths that don't pass the timer around. A context variable
+# behaves like a thread-local in plain threads and is also per-task under asyncio
+# (asyncio.to_thread carries it into the worker thread).
+_current = contextvars.ContextVar('perf_metrics_timer', default=None)
+
+
+def start_request(pipeline, **fields):
+    """Creates a RequestTimer and makes it the current request of this thread/task."""
+    timer = RequestTimer(pipeline, **fields)
+    _current.set(timer)
+    return timer
+
+
+def current():
+    return _current.get()
+
+
+def bind(timer):
+    """Makes ``timer`` the current request of this thread (for helper/pool threads)."""
+    _current.set(timer)
+
+
+def mark(step):
+    timer = current()
+    if timer is not None:
+        timer.mark(step)
+
+
+def set_fields(**fields):
+    timer = current()
+    if timer is not None:
+        timer.set(**fields)
+
+
+def add(**counters):
+    timer = current()
+    if timer is not None:
+        timer.add(**counters)
+
+
+def maximum(**fields):
+    timer = current()
+    if timer is not None:
+        timer.maximum(**fields)
@@ -0,0 +1,160 @@
+"""
+Compiled registry of the prompt templates in prompts/*.md.
+
+Each file holds YAML-like front matter with one block per template:
+
+    ---
+    MARKETING_CONTENT: |
+      Eres un experto ... {{INSTRUCTIONS}} ...
+    ---
+
+A file is parsed once into CompiledTemplate objects whose text is pre-split at
+its {{PLACEHOLDER}} positions, so rendering is a single join instead of one
+regex substitution over the whole template per placeholder. Files are re-read
+only when their mtime (or size) changes, which keeps edits to prompts/ live in a
+long-running worker.
+
+Every template has a version hash (sha256 of its text, 12 hex chars) that response
+caches and timing records can key on: see version() / versions().
+"""
+
+import hashlib
+import logging
+import os
+import re
+import threading
+
+DEFAULT_PROMPTS_DIR = os.getenv(
+    'PROMPTS_DIR',
+    os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'prompts'))
+)
+
+_PLACEHOLDER = re.compile(r'\{\{([A-Za-z0-9_]+)\}\}')
+_BLOCK_KEY = re.compile(r'^([A-Z_]+):\s*(\|)?\s*$')
+_INDENT = re.compile(r'^\s{2}')
+
+
+class CompiledTemplate:
+    """A template split into literal text and placeholder names (odd positions of ``parts``)."""
+
+    def __init__(self, name, text):
+        self.name = name
+        self.text = text
+        self.parts = _PLACEHOLDER.split(text)
+        self.placeholders = frozenset(self.parts[1::2])
+        self.version = hashlib.sha256(text.encode('utf-8')).hexdigest()[:12]
+
+    def render(self, values):
+        """Single-pass substitution. Placeholders missing from ``values`` are left as they are."""
+        parts = self.parts
+        out = []
+        for i, part in enumerate(parts):
+            if i % 2 == 0:
+                out.append(part)
+            elif part in values:
+                out.append(str(values[part] or ''))
+            else:
+                out.append('{{' + part + '}}')
+        return ''.join(out)
+
+
+def parse_front_matter(md_text):
+    """Returns ``{KEY: template_text}`` from the front matter, or ``{None: md_text}`` without one."""
+    md_trim = md_text.lstrip()
+    if md_trim.startswith('---'):
+        end_idx = md_trim.find('\n---')
+        if end_idx != -1:
+            blocks = {}
+            current_key = None
+            buffer = []
+            for line in md_trim[3:end_idx + 1].split('\n'):
+                m = _BLOCK_KEY.match(line)
+                if m:
+                    if current_key:
+                        blocks[current_key] = '\n'.join(buffer).rstrip()
+                    current_key = m.group(1).strip()
+                    buffer = []
+                elif current_key:
+                    buffer.append(_INDENT.sub('', line))
+            if current_key:
+                blocks[current_key] = '\n'.join(buffer).rstrip()
+            if blocks:
+                return blocks
+    return {None: md_text}
+
+
+class _PromptFile:
+    def __init__(self, path, stamp, templates):
+        self.path = path
+        self.stamp = stamp
+        self.templates = templates
+
+
+class TemplateRegistry:
+    """Loads prompts/<name>.md on first use and reloads it when the file changes. Thread-safe."""
+
+    def __init__(self, directory=DEFAULT_PROMPTS_DIR):
+        self.directory = directory
+        self._files = {}
+        self._lock = threading.Lock()
+        self.loads = 0
+
+    def _path(self, name):
+        return os.path.join(self.directory, name + '.md')
+
+    def _file(self, name):
+        path = self._path(name)
+        st = os.stat(path)
+        stamp = (st.st_mtime_ns, st.st_size)
+        loaded = self._files.get(name)
+        if loaded is not None and loaded.stamp == stamp:
+            return loaded
+        with self._lock:
+            loaded = self._files.get(name)
+            if loaded is None or loaded.stamp != stamp:
+                with open(path, 'r', encoding='utf-8') as f:
+                    blocks = parse_front_matter(f.read())
+                templates = {key: CompiledTemplate(f"{name}:{key}" if key else name, text) for key, text in blocks.items()}
+                loaded = self._files[name] = _PromptFile(path, stamp, templates)
+                self.loads += 1
+                logging.info(f"Loaded prompt templates from {path}: {', '.join(k for k in templates if k) or '(whole file)'}")
+        return loaded
+
+    def get(self, name, key=None):
+        """The compiled ``key`` template of prompts/<name>.md (the whole file if it has no front matter).
+
+        Raises FileNotFoundError / KeyError when the file or the block does not exist.
+        """
+        templates = self._file(name).templates
+        if key in templates:
+            return templates[key]
+        if None in templates:
+            return templates[None]
+        raise KeyError(f"Template {key} not found in {self._path(name)}")
+
+    def render(self, name, key, values):
+        return self.get(name, key).render(values)
+
+    def version(self, name, key=None):
+        return self.get(name, key).version
+
+    def versions(self):
+        """``{file: {key: version}}`` for every prompts/*.md file (loading the ones not seen yet)."""
+        result = {}
+        try:
+            names = sorted(f[:-3] for f in os.listdir(self.directory) if f.endswith('.md'))
+        except OSError as e:
+            logging.warning(f"Cannot list prompt templates in {self.directory}: {e}")
+            return result
+        for name in names:
+            try:
+                templates = self._file(name).templates
+            except OSError as e:
+                logging.warning(f"Cannot load prompt templates {name}: {e}")
+                continue
+            result[name] = {key or name: template.version for key, template in templates.items()}
+        return result
+
+
+# Shared by every pipeline in the process
+registry = TemplateRegistry()
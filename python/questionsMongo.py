@@ -1,15 +1,30 @@
 import os
+import asyncio
+import contextvars
+import queue
 import pymongo
+import bson
+import motor.motor_asyncio
 from dotenv import load_dotenv
 import google.generativeai as genai
 import logging
 import sys
 import requests
-import io
 import pypdf
 import json
 import hashlib
+import threading
 import time  # Add timing
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from gemini_cache import GeminiResponseCache, cache_from_env
+from text_cache import text_cache_from_env
+from pdf_extract import extract_page_texts
+from http_fetch import download_pdf, download_pdf_async, fetch_html, fetch_html_async, get_session, make_async_client, current_rss_mb, peak_rss_mb, sample_rss, track_peak_rss
+from html_extract import html_to_text
+from text_normalizer import clean_fragment, normalize_text
+from text_chunker import estimate_tokens, split_into_chunks
+import perf_metrics
+import analysis_worker
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -31,78 +46,300 @@ else:
     logging.info("GEMINI_API_KEY found in .env file")
 
 # Set up the Gemini model
+GEMINI_MODEL_NAME = 'gemini-2.5-flash'
 try:
     genai.configure(api_key=GEMINI_API_KEY)
-    model = genai.GenerativeModel('gemini-2.5-flash')  # Specify the correct model here
-    logging.info("Gemini model initialized successfully with gemini-2.5-flash")
+    model = genai.GenerativeModel(GEMINI_MODEL_NAME)  # Specify the correct model here
+    logging.info(f"Gemini model initialized successfully with {GEMINI_MODEL_NAME}")
 except Exception as e:
     logging.exception(f"Error initializing Gemini model: {e}")
     model = None
 
+# Persistent response cache (see gemini_cache.py); None when disabled
+_response_cache = cache_from_env()
+
+# On-disk cache of cleaned text extracted from PDFs (see text_cache.py); None when disabled
+_text_cache = text_cache_from_env()
+
+# Map-reduce mode for very long documents: above MAP_REDUCE_MIN_TOKENS the text is split
+# into sections, each section is summarised concurrently and a final call answers the prompt
+MAP_REDUCE_ENABLED = os.getenv("MAP_REDUCE_ENABLED", "true").strip().lower() in ("1", "true", "yes", "on")
+MAP_REDUCE_MIN_TOKENS = int(os.getenv("MAP_REDUCE_MIN_TOKENS", "150000"))
+MAP_REDUCE_CHUNK_TOKENS = int(os.getenv("MAP_REDUCE_CHUNK_TOKENS", "40000"))
+MAP_REDUCE_CONCURRENCY = int(os.getenv("MAP_REDUCE_CONCURRENCY", "4"))
+# Process-wide, so concurrent requests in worker mode share one bound on map calls
+_map_semaphore = threading.BoundedSemaphore(MAP_REDUCE_CONCURRENCY)
+
+# Gemini warm-up when the event loop starts (see _warm_up_gemini_async). When GEMINI_WARMUP
+# is unset it is only enabled in worker mode, where later requests reuse the opened channel;
+# a one-shot CLI run would just pay one more billable call
+GEMINI_WARMUP = os.getenv("GEMINI_WARMUP", "").strip().lower()
+GEMINI_WARMUP_ENABLED = GEMINI_WARMUP in ("1", "true", "yes", "on")
+
+MAP_PROMPT_TEMPLATE = (
+    "Eres un abogado experto. El siguiente texto es la sección {index} de {total} de un documento normativo extenso. "
+    "Extrae de esta sección, de forma fiel y concisa, toda la información necesaria para responder a la instrucción final "
+    "que aparece a continuación (título, fechas, entrada en vigor, ámbito, sujetos afectados, obligaciones, plazos, sanciones "
+    "y cualquier otro dato relevante). No respondas todavía a la instrucción: devuelve solo notas en texto plano, sin HTML ni JSON. "
+    "Si la sección no contiene nada relevante, responde \"Sin contenido relevante\".\n\n"
+    "=== Instrucción final ===\n{prompt}"
+)
+REDUCE_CONTEXT_HEADER = (
+    "El documento original es demasiado extenso para analizarlo de una sola vez. A continuación se incluyen, en orden, "
+    "las notas extraídas de cada una de sus {total} secciones. Basa tu respuesta únicamente en ellas."
+)
+
 # Global reusable MongoDB client to avoid repeated SRV lookups
 _mongo_client = None
+_mongo_client_lock = threading.Lock()
+
+# Async pipeline: one event loop per process on a daemon thread. The Motor client, the
+# pooled httpx client and Gemini's async gRPC channel are bound to it and reused by
+# every request (main() calls from worker threads all submit to this loop).
+_event_loop = None
+_event_loop_lock = threading.Lock()
+_async_mongo_client = None
+_http_client = None
 
-# Performance timing
-_timings = []
+def _get_event_loop():
+    global _event_loop
+    with _event_loop_lock:
+        if _event_loop is None:
+            loop = asyncio.new_event_loop()
+            threading.Thread(target=loop.run_forever, name="questions-event-loop", daemon=True).start()
+            _event_loop = loop
+            # Once per loop (so once per process): Gemini's async channel is bound to it
+            if model and GEMINI_WARMUP_ENABLED:
+                asyncio.run_coroutine_threadsafe(_warm_up_gemini_async(), loop)
+    return _event_loop
 
+def _get_http_client():
+    """Pooled async HTTP client; only called on the event loop thread."""
+    global _http_client
+    if _http_client is None:
+        _http_client = make_async_client(timeout=20)
+    return _http_client
+
+# Performance timing: one perf_metrics.RequestTimer per request, current per thread
+# (so concurrent requests in worker mode don't mix); see perf_metrics.py for the records
 def _mark(step: str):
-    _timings.append((step, time.perf_counter()))
+    perf_metrics.mark(step)
+
+def _timings_as_dict():
+    """Per-step durations in ms (relative to the previous mark) plus the total."""
+    timer = perf_metrics.current()
+    result = timer.stages() if timer is not None else {}
+    if timer is not None and timer.total_ms() is not None:
+        result['total'] = timer.total_ms()
+        first_token = timer.since_start_ms('gemini_first_token')
+        if first_token is not None:
+            result['time_to_first_token'] = first_token
+    if timer is not None and timer.fields.get('mongo_bytes') is not None:
+        result['mongo_bytes'] = timer.fields['mongo_bytes']
+    if timer is not None:
+        sample_rss(timer)
+        result['peak_rss_mb'] = timer.fields.get('peak_rss_mb')
+    return result
+
+# Request output: classic (printed response), streaming (NDJSON frames) or batch (result
+# frames built by run_batch). Kept in a context variable so it follows the request into
+# asyncio tasks and asyncio.to_thread workers, like the perf_metrics timer.
+class _RequestOutput:
+    def __init__(self, stream=False, batch=False, write=None):
+        self.stream = stream
+        self.batch = batch
+        # main() passes a queue writer so lines produced on the event loop are printed by the calling thread
+        self._write = write
+
+    def write_line(self, line):
+        if self._write is None:
+            print(line, flush=True)
+        else:
+            self._write(line)
+
+_output_var = contextvars.ContextVar('questions_output', default=_RequestOutput())
+
+def _is_streaming():
+    return _output_var.get().stream
+
+def _write_line(line):
+    _output_var.get().write_line(line)
+
+def _emit_frame(frame):
+    """Writes one NDJSON frame to stdout and flushes so the caller can forward it immediately."""
+    _write_line(json.dumps(frame, ensure_ascii=False))
+
+def _report_error(code, message=None):
+    """Reports an error token: a plain line in classic mode, an error frame in streaming mode."""
+    perf_metrics.set_fields(error=code)
+    if _output_var.get().batch:
+        # Batch mode reports errors in the item's result frame instead
+        return
+    if _is_streaming():
+        _emit_frame({"type": "error", "error": code, "message": message})
+    else:
+        _write_line(code)
+
+def _clean_stream_delta(text):
+    """Light per-chunk cleaning; the full normalisation runs once on the final response."""
+    return clean_fragment(text)
 
 def connect_to_mongodb():
     """Connects to MongoDB reusing a global client and returns the database object."""
     global _mongo_client
     try:
-        if _mongo_client is None:
-            # Use shorter timeouts to fail fast if DNS/connection issue
-            _mongo_client = pymongo.MongoClient(
+        with _mongo_client_lock:
+            if _mongo_client is None:
+                # Use shorter timeouts to fail fast if DNS/connection issue
+                _mongo_client = pymongo.MongoClient(
+                    DB_URI,
+                    serverSelectionTimeoutMS=10000,   # 10s for DNS & initial handshake
+                    connectTimeoutMS=10000,
+                    socketTimeoutMS=20000,
+                    retryWrites=False  # Avoid extra retries that add latency
+                )
+        db = _mongo_client[DB_NAME]
+        logging.info(f"Connected (or reused connection) to MongoDB database: {DB_NAME}")
+        return db
+    except pymongo.errors.ConnectionFailure as e:
+        logging.error(f"Could not connect to MongoDB: {e}")
+        return None
+
+# contenido up to this size comes back with the first query; larger texts are read by a
+# second query that projects contenido alone
+CONTENIDO_INLINE_MAX_BYTES = int(os.getenv("MONGO_CONTENIDO_INLINE_KB", "256")) * 1024
+
+def _content_source_pipeline(match):
+    """Phase 1 of the document fetch: content-source fields plus their sizes, never the whole document.
+
+    BOE documents carry large etiquetas_personalizadas maps (one entry per matching user
+    and company); only url_pdf / url_html, a small contenido, the contenido size and the
+    stored document size ($bsonSize, for the I/O comparison) cross the wire.
+    """
+    return [
+        {"$match": match},
+        {"$project": {
+            "url_pdf": 1,
+            "url_html": 1,
+            "contenido": 1,
+            "contenido_bytes": {"$cond": [{"$eq": [{"$type": "$contenido"}, "string"]}, {"$strLenBytes": "$contenido"}, 0]},
+            "document_bytes": {"$bsonSize": "$$ROOT"},
+        }},
+        {"$set": {"contenido": {"$cond": [{"$lte": ["$contenido_bytes", CONTENIDO_INLINE_MAX_BYTES]}, "$contenido", "$$REMOVE"]}}},
+    ]
+
+def _needs_contenido_fetch(document):
+    return "contenido" not in document and (document.get("contenido_bytes") or 0) > 0
+
+def _bson_size(document):
+    return len(bson.encode(document)) if document else 0
+
+def _record_fetch_sizes(content_info):
+    """Adds the Mongo I/O of a document fetch to the current request's timing record."""
+    if content_info:
+        perf_metrics.set_fields(
+            mongo_bytes=content_info.get("fetched_bytes"),
+            mongo_document_bytes=content_info.get("document_bytes"),
+            contenido_bytes=content_info.get("contenido_bytes"),
+        )
+
+def _content_source_from_document(document, fetched_bytes=None):
+    """Picks the content source of a document: contenido, then url_pdf, then url_html.
+
+    When ``document`` comes from _content_source_pipeline, the sizes are carried along
+    (``fetched_bytes``, ``document_bytes``, ``contenido_bytes``) for the timing record.
+    """
+    id_value = document.get("_id")
+    sizes = {}
+    if "document_bytes" in document:
+        sizes = {
+            "fetched_bytes": fetched_bytes,
+            "document_bytes": document.get("document_bytes"),
+            "contenido_bytes": document.get("contenido_bytes"),
+        }
+
+    # Priority 1: Check for "contenido" field first
+    if "contenido" in document and document["contenido"]:
+        logging.info("Found 'contenido' field in document. Using direct text content.")
+        return {
+            "type": "contenido",
+            "content": document["contenido"],
+            **sizes
+        }
+
+    # Priority 2: Check for "url_pdf" field
+    if "url_pdf" in document and document["url_pdf"]:
+        logging.info("Found 'url_pdf' field in document. Using PDF URL.")
+        return {
+            "type": "url_pdf",
+            "url": document["url_pdf"],
+            **sizes
+        }
+
+    # Priority 3: Check for "url_html" field
+    if "url_html" in document and document["url_html"]:
+        logging.info("Found 'url_html' field in document. Using HTML URL.")
+        return {
+            "type": "url_html",
+            "url": document["url_html"],
+            **sizes
+        }
+
+    # If none of the content sources are available
+    logging.warning(f"Document with id '{id_value}' found but no content sources available (contenido, url_pdf, url_html).")
+    return None
+
+def connect_to_mongodb_async():
+    """Returns the database object of the process-wide Motor client (created on first use).
+
+    Must be called on the shared event loop (see _get_event_loop), which the client binds to.
+    """
+    global _async_mongo_client
+    try:
+        if _async_mongo_client is None:
+            _async_mongo_client = motor.motor_asyncio.AsyncIOMotorClient(
                 DB_URI,
-                serverSelectionTimeoutMS=10000,   # 10s for DNS & initial handshake
+                serverSelectionTimeoutMS=10000,
                 connectTimeoutMS=10000,
                 socketTimeoutMS=20000,
-                retryWrites=False  # Avoid extra retries that add latency
+                retryWrites=False
             )
-        db = _mongo_client[DB_NAME]
-        logging.info(f"Connected (or reused connection) to MongoDB database: {DB_NAME}")
+        db = _async_mongo_client[DB_NAME]
+        logging.info(f"Connected (or reused async connection) to MongoDB database: {DB_NAME}")
         return db
-    except pymongo.errors.ConnectionFailure as e:
+    except pymongo.errors.ConfigurationError as e:
         logging.error(f"Could not connect to MongoDB: {e}")
         return None
 
+def _log_fetch_sizes(id_value, content_info):
+    if content_info and content_info.get("document_bytes"):
+        logging.info(
+            f"Fetched {content_info['fetched_bytes'] / 1024:.1f} KB of document '{id_value}' "
+            f"(stored size {content_info['document_bytes'] / 1024:.1f} KB)"
+        )
+
 def get_pdf_url_from_mongodb(db, collection_name, id_value): #added db as param
-    """Retrieves the PDF URL from the MongoDB document given the document ID ( _id field)."""
+    """Retrieves the content source (contenido, PDF URL or HTML URL) of a document given its _id.
+
+    Two phases: a projected aggregation returns the source fields and sizes, and a
+    contenido larger than CONTENIDO_INLINE_MAX_BYTES is read by a second targeted query.
+    """
     try:
         collection = db[collection_name] #Added collecion
-        document = collection.find_one({"_id": id_value}) # Find using _id
-        if document:
+        documents = list(collection.aggregate(_content_source_pipeline({"_id": id_value}))) # Find using _id
+        if documents:
+            document = documents[0]
             logging.info(f"Document with id '{id_value}' found.")
-            
-            # Priority 1: Check for "contenido" field first
-            if "contenido" in document and document["contenido"]:
-                logging.info("Found 'contenido' field in document. Using direct text content.")
-                return {
-                    "type": "contenido",
-                    "content": document["contenido"]
-                }
-            
-            # Priority 2: Check for "url_pdf" field
-            if "url_pdf" in document and document["url_pdf"]:
-                logging.info("Found 'url_pdf' field in document. Using PDF URL.")
-                return {
-                    "type": "url_pdf",
-                    "url": document["url_pdf"]
-                }
-            
-            # Priority 3: Check for "url_html" field
-            if "url_html" in document and document["url_html"]:
-                logging.info("Found 'url_html' field in document. Using HTML URL.")
-                return {
-                    "type": "url_html",
-                    "url": document["url_html"]
-                }
-            
-            # If none of the content sources are available
-            logging.warning(f"Document with id '{id_value}' found but no content sources available (contenido, url_pdf, url_html).")
-            return None
+            fetched_bytes = _bson_size(document)
+            if _needs_contenido_fetch(document):
+                logging.info(f"'contenido' is {document['contenido_bytes'] / 1024:.0f} KB; reading it with a second query")
+                contenido = collection.find_one({"_id": id_value}, {"contenido": 1})
+                fetched_bytes += _bson_size(contenido)
+                document["contenido"] = (contenido or {}).get("contenido")
+            content_info = _content_source_from_document(document, fetched_bytes)
+            _log_fetch_sizes(id_value, content_info)
+            _record_fetch_sizes(content_info)
+            return content_info
         else:
             logging.warning(f"Document with id '{id_value}' not found.")
             return None
@@ -110,349 +347,757 @@ def get_pdf_url_from_mongodb(db, collection_name, id_value): #added db as param
         logging.exception(f"Error retrieving document from MongoDB: {e}")
         return None
 
-def download_and_extract_text_from_pdf(pdf_url):
-    """Downloads a PDF from a URL and extracts the text content with improved UTF-8 handling."""
+async def get_pdf_url_from_mongodb_async(db, collection_name, id_value):
+    """Async get_pdf_url_from_mongodb over the Motor client (same two-phase fetch)."""
     try:
-        logging.info(f"Downloading PDF from: {pdf_url}")
-        
-        # Set headers to ensure proper handling
-        headers = {
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
-        }
-        
-        response = requests.get(pdf_url, stream=True, headers=headers)
-        response.raise_for_status()  # Raise an exception for bad status codes
-        
-        pdf_file = io.BytesIO(response.content)
-        reader = pypdf.PdfReader(pdf_file)
-        
-        # Extract text with improved handling of encoding
-        text_parts = []
-        total_pages = len(reader.pages)
-        logging.info(f"Processing {total_pages} pages...")
-        
-        for page_num, page in enumerate(reader.pages):
-            try:
-                page_text = page.extract_text()
-                
-                # Basic validation that text extraction worked
-                if page_text and len(page_text.strip()) > 0:
-                    text_parts.append(page_text)
-                    logging.debug(f"Extracted {len(page_text)} characters from page {page_num + 1}")
-                else:
-                    logging.warning(f"No text extracted from page {page_num + 1}")
-                    
-            except Exception as e:
-                logging.warning(f"Error extracting text from page {page_num + 1}: {e}")
-                continue
-        
-        # Combine all text parts
-        text = "\n".join(text_parts)
-        
-        # Log extraction summary
-        if text:
-            char_count = len(text)
-            logging.info(f"Successfully extracted {char_count} characters from {len(text_parts)} pages")
-            
-            # Check for potential encoding issues early
-            replacement_chars = text.count('\ufffd')
-            if replacement_chars > 0:
-                logging.warning(f"Detected {replacement_chars} replacement characters in extracted text")
-            
-            # Check for double-encoding indicators
-            double_encoding_indicators = ['Ã¡', 'Ã©', 'Ã­', 'Ã³', 'Ãº', 'Ã±']
-            double_encoding_count = sum(text.count(indicator) for indicator in double_encoding_indicators)
-            if double_encoding_count > 0:
-                logging.warning(f"Detected {double_encoding_count} potential double-encoding issues")
-        else:
-            logging.error("No text could be extracted from PDF")
-            return None
-            
-        return text
-        
-    except requests.exceptions.RequestException as e:
-        logging.error(f"Error downloading PDF: {e}")
-        print("PDF_ACCESS_ERROR")
-        return None
-    except pypdf.errors.PdfReadError as e:
-        logging.error(f"Error reading PDF: {e}")
-        print("PDF_ACCESS_ERROR")
+        collection = db[collection_name]
+        documents = await collection.aggregate(_content_source_pipeline({"_id": id_value})).to_list(length=1)
+        if documents:
+            document = documents[0]
+            logging.info(f"Document with id '{id_value}' found.")
+            fetched_bytes = _bson_size(document)
+            if _needs_contenido_fetch(document):
+                logging.info(f"'contenido' is {document['contenido_bytes'] / 1024:.0f} KB; reading it with a second query")
+                contenido = await collection.find_one({"_id": id_value}, {"contenido": 1})
+                fetched_bytes += _bson_size(contenido)
+                document["contenido"] = (contenido or {}).get("contenido")
+            content_info = _content_source_from_document(document, fetched_bytes)
+            _log_fetch_sizes(id_value, content_info)
+            _record_fetch_sizes(content_info)
+            return content_info
+        logging.warning(f"Document with id '{id_value}' not found.")
         return None
     except Exception as e:
-        logging.exception(f"Error processing PDF: {e}")
-        print("PDF_ACCESS_ERROR")
+        logging.exception(f"Error retrieving document from MongoDB: {e}")
         return None
 
-def clean_text_for_processing(text):
-    """Clean text to remove invalid Unicode characters and fix encoding issues dynamically."""
-    if not text:
-        return ""
-    
-    import re
-    import unicodedata
+def get_content_sources_from_mongodb(db, collection_name, id_values):
+    """Batch version of get_pdf_url_from_mongodb: one $in aggregation for all ids of a collection,
+    plus one $in query for the contenido fields too large to come back inline.
+
+    Returns ``{id: content_info or None}``; ids that were not found are missing from the dict.
+    Raises on database errors so the caller can fail the affected items.
+    """
+    collection = db[collection_name]
+    documents = {
+        document["_id"]: document
+        for document in collection.aggregate(_content_source_pipeline({"_id": {"$in": list(id_values)}}))
+    }
+    fetched = {id_value: _bson_size(document) for id_value, document in documents.items()}
+    large_ids = [id_value for id_value, document in documents.items() if _needs_contenido_fetch(document)]
+    if large_ids:
+        for document in collection.find({"_id": {"$in": large_ids}}, {"contenido": 1}):
+            documents[document["_id"]]["contenido"] = document.get("contenido")
+            fetched[document["_id"]] += _bson_size(document)
+    sources = {
+        id_value: _content_source_from_document(document, fetched[id_value])
+        for id_value, document in documents.items()
+    }
+    logging.info(
+        f"Fetched {len(sources)}/{len(id_values)} documents from '{collection_name}' in "
+        f"{2 if large_ids else 1} queries ({sum(fetched.values()) / 1024:.1f} KB)"
+    )
+    return sources
+
+PDF_REQUEST_HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
+}
+
+def extract_pdf_text(pdf_bytes=None, pdf_path=None):
+    """Extracts the text content of a PDF (in memory or spooled to disk) with improved UTF-8 handling."""
+    # Pages come back in order; large PDFs are split across a process pool (see pdf_extract.py)
+    page_results = extract_page_texts(pdf_bytes=pdf_bytes, pdf_path=pdf_path)
     
-    original_length = len(text)
+    # Extract text with improved handling of encoding
+    text_parts = []
+    total_pages = len(page_results)
+    perf_metrics.set_fields(page_count=total_pages)
+    logging.info(f"Processing {total_pages} pages...")
     
-    try:
-        # First, handle potential encoding issues more carefully
-        if isinstance(text, bytes):
-            try:
-                # Try UTF-8 first
-                text = text.decode('utf-8')
-            except UnicodeDecodeError:
-                try:
-                    # Try Latin-1 as fallback
-                    text = text.decode('latin-1')
-                except UnicodeDecodeError:
-                    # Last resort: ignore errors
-                    text = text.decode('utf-8', errors='ignore')
-        
-        # Detect and fix double-encoding issues (common when UTF-8 is misinterpreted as Latin-1)
-        if any(seq in text for seq in ['Ã¡', 'Ã©', 'Ã­', 'Ã³', 'Ãº', 'Ã±', 'Ã', 'Ã‰', 'Ã', 'Ã"', 'Ãš']):
-            logging.info("Detected double UTF-8 encoding, attempting to fix...")
-            try:
-                # Fix double-encoding by re-encoding to Latin-1 then decoding as UTF-8
-                fixed_bytes = text.encode('latin-1')
-                text = fixed_bytes.decode('utf-8')
-                logging.info("Successfully fixed double UTF-8 encoding")
-            except (UnicodeDecodeError, UnicodeEncodeError):
-                logging.warning("Could not fix double encoding, proceeding with original text")
-        
-        # Fix Unicode replacement characters (�) dynamically
-        if '\ufffd' in text:
-            logging.info("Detected Unicode replacement characters; replacing with apostrophes to avoid losing context")
-            text = text.replace('\ufffd', "'")
-        
-        # Remove surrogate characters (critical for UTF-8 encoding)
-        # These characters (0xD800-0xDFFF) are valid in UTF-16 but not in UTF-8
-        text = ''.join(char for char in text if not (0xD800 <= ord(char) <= 0xDFFF))
-        
-        # Normalize Unicode to ensure consistent representation
-        text = unicodedata.normalize('NFC', text)
-        
-        # Remove any remaining replacement characters and other problematic Unicode
-        text = re.sub(r'[\ufffd\ufeff]', '', text)  # Remove replacement chars and BOM
+    for page_num, page_text, page_error in page_results:
+        if page_error:
+            logging.warning(f"Error extracting text from page {page_num + 1}: {page_error}")
+            continue
         
-        # Remove other problematic control characters while preserving normal whitespace
-        text = re.sub(r'[\x00-\x08\x0B\x0C\x0E-\x1F\x7F]', '', text)
-        
-        # Preserve meaningful whitespace and line breaks; avoid collapsing which can harm accents context
-        text = re.sub(r'[ \t]+', ' ', text)
-        text = re.sub(r'\r\n', '\n', text)
-        text = text.strip()
+        # Basic validation that text extraction worked
+        if page_text and len(page_text.strip()) > 0:
+            text_parts.append(page_text)
+            logging.debug(f"Extracted {len(page_text)} characters from page {page_num + 1}")
+        else:
+            logging.warning(f"No text extracted from page {page_num + 1}")
+    
+    # Combine all text parts
+    text = "\n".join(text_parts)
+    
+    # Log extraction summary
+    if text:
+        char_count = len(text)
+        logging.info(f"Successfully extracted {char_count} characters from {len(text_parts)} pages")
         
-        # Final validation - ensure the text can be encoded as UTF-8
-        try:
-            text.encode('utf-8')
-        except UnicodeEncodeError as e:
-            logging.warning(f"UTF-8 encoding issue at position {e.start}: {e.reason}")
-            # Remove the specific problematic characters
-            text = text[:e.start] + text[e.end:]
-            logging.info("Removed problematic characters that couldn't be UTF-8 encoded")
+        # Check for potential encoding issues early
+        replacement_chars = text.count('\ufffd')
+        if replacement_chars > 0:
+            logging.warning(f"Detected {replacement_chars} replacement characters in extracted text")
         
-        # Log the result
-        final_length = len(text)
-        if final_length != original_length:
-            logging.info(f"Text length changed from {original_length} to {final_length} characters")
-            
-        # Log if significant cleaning was done
-        if final_length < original_length * 0.9:  # If we lost more than 10% of content
-            logging.warning(f"Significant text cleaning performed: {original_length} -> {final_length} characters")
+        # Check for double-encoding indicators
+        double_encoding_indicators = ['Ã¡', 'Ã©', 'Ã­', 'Ã³', 'Ãº', 'Ã±']
+        double_encoding_count = sum(text.count(indicator) for indicator in double_encoding_indicators)
+        if double_encoding_count > 0:
+            logging.warning(f"Detected {double_encoding_count} potential double-encoding issues")
+    else:
+        logging.error("No text could be extracted from PDF")
+        return None
         
+    return text
+
+def _lookup_text_cache(url):
+    """Returns ``(cached_entry, request_headers, fresh_text)``; ``fresh_text`` is set when no request is needed."""
+    cached = _text_cache.get(url) if _text_cache is not None else None
+    if cached and _text_cache.is_fresh(cached):
+        logging.info(f"✓ Text cache HIT (fresh) for {url}")
+        perf_metrics.set_fields(text_cache="hit")
+        _text_cache.record(served=True)
+        _text_cache.touch(url)
+        return cached, None, cached['text']
+
+    headers = dict(PDF_REQUEST_HEADERS)
+    if cached:
+        if cached.get('etag'):
+            headers['If-None-Match'] = cached['etag']
+        if cached.get('last_modified'):
+            headers['If-Modified-Since'] = cached['last_modified']
+    return cached, headers, None
+
+def _text_from_download(pdf_url, cached, download):
+    """Turns a finished (possibly 304) download into cleaned text and stores it in the text cache."""
+    if cached and download.not_modified:
+        logging.info(f"✓ Text cache HIT (304 Not Modified) for {pdf_url}")
+        perf_metrics.set_fields(text_cache="revalidated")
+        _text_cache.record(served=True)
+        _text_cache.touch(pdf_url)
+        return cached['text']
+    perf_metrics.set_fields(text_cache="miss" if _text_cache is not None else "disabled", download_bytes=download.size)
+    if _text_cache is not None:
+        _text_cache.record(served=False)
+    raw_text = extract_pdf_text(pdf_path=download.path)
+    if not raw_text:
+        return None
+    text = clean_text_for_processing(raw_text)
+    if _text_cache is not None:
+        _text_cache.put(
+            pdf_url,
+            text,
+            etag=download.headers.get('ETag'),
+            last_modified=download.headers.get('Last-Modified')
+        )
+    return text
+
+def _text_fetch_error(cached, e, kind='PDF'):
+    """Error path of get_pdf_text / get_html_text: serves stale cached text or reports ``<kind>_ACCESS_ERROR``."""
+    if isinstance(e, requests.exceptions.RequestException):
+        if _text_cache is not None:
+            _text_cache.record(served=bool(cached))
+        if cached:
+            logging.warning(f"Error revalidating {kind} ({e}); serving cached text")
+            perf_metrics.set_fields(text_cache="stale")
+            return cached['text']
+        logging.error(f"Error downloading {kind}: {e}")
+    elif isinstance(e, pypdf.errors.PdfReadError):
+        logging.error(f"Error reading PDF: {e}")
+    else:
+        logging.exception(f"Error processing {kind}: {e}")
+    _report_error(f"{kind}_ACCESS_ERROR")
+    return None
+
+def get_pdf_text(pdf_url):
+    """Returns the cleaned text of a PDF, served from the on-disk text cache when still valid.
+
+    Cached entries are revalidated with a conditional GET (If-None-Match /
+    If-Modified-Since); a 304 reuses the stored text without downloading or parsing.
+    """
+    cached, headers, text = _lookup_text_cache(pdf_url)
+    if text is not None:
         return text
-        
+    try:
+        logging.info(f"Downloading PDF from: {pdf_url}{' (conditional)' if cached else ''}")
+        # Streamed to a temp file with size/deadline limits; raises for bad status codes
+        with track_peak_rss(), download_pdf(pdf_url, headers=headers, session=get_session()) as download:
+            return _text_from_download(pdf_url, cached, download)
     except Exception as e:
-        logging.error(f"Error in clean_text_for_processing: {e}")
-        # Return original text if all else fails
-        return text if isinstance(text, str) else str(text)
+        return _text_fetch_error(cached, e)
 
+async def get_pdf_text_async(pdf_url):
+    """Async get_pdf_text: pooled httpx download; cache file I/O and PDF parsing run in worker threads."""
+    cached, headers, text = await asyncio.to_thread(_lookup_text_cache, pdf_url)
+    if text is not None:
+        return text
+    try:
+        logging.info(f"Downloading PDF from: {pdf_url}{' (conditional)' if cached else ''}")
+        with track_peak_rss():
+            download = await download_pdf_async(pdf_url, _get_http_client(), headers=headers)
+            with download:
+                # Parsing is CPU-bound (and may fan out to the pdf_extract process pool)
+                return await asyncio.to_thread(_text_from_download, pdf_url, cached, download)
+    except Exception as e:
+        return _text_fetch_error(cached, e)
 
-def ask_gemini(text, prompt):
-    """Asks Gemini a question about the text and returns the response."""
-    if not model:
-        logging.error("Gemini model is not initialized. Cannot ask Gemini.")
+def _text_from_page(url, cached, page):
+    """Turns a fetched (possibly 304) web page into cleaned text and stores it in the text cache."""
+    if cached and page.not_modified:
+        logging.info(f"✓ Text cache HIT (304 Not Modified) for {url}")
+        perf_metrics.set_fields(text_cache="revalidated")
+        _text_cache.record(served=True)
+        _text_cache.touch(url)
+        return cached['text']
+    perf_metrics.set_fields(text_cache="miss" if _text_cache is not None else "disabled", download_bytes=page.size)
+    if _text_cache is not None:
+        _text_cache.record(served=False)
+    raw_text = html_to_text(page.body, page.encoding)
+    if not raw_text:
+        logging.error("No text could be extracted from HTML page")
         return None
+    text = clean_text_for_processing(raw_text)
+    logging.info(f"Successfully extracted {len(text)} characters from HTML page")
+    if _text_cache is not None:
+        _text_cache.put(
+            url,
+            text,
+            etag=page.headers.get('ETag'),
+            last_modified=page.headers.get('Last-Modified')
+        )
+    return text
+
+def get_html_text(html_url):
+    """Returns the cleaned text of a web page (url_html documents), sharing the PDF text cache and revalidation."""
+    cached, headers, text = _lookup_text_cache(html_url)
+    if text is not None:
+        return text
     try:
-        # Clean the text and prompt before processing
-        cleaned_text = clean_text_for_processing(text)
-        cleaned_prompt = clean_text_for_processing(prompt)
-        
-        content_hash = hashlib.md5(f"{cleaned_prompt}:{cleaned_text}".encode('utf-8')).hexdigest()
-        logging.info(f"Processing content with hash: {content_hash}")
-        logging.info(f"Prompt length: {len(cleaned_prompt)} chars, Content length: {len(cleaned_text)} chars")
-        logging.info(f"Sending prompt to Gemini: {cleaned_prompt[:200]}...")
-        
-        # Log a sample of the content to verify it includes context
-        if "CONTEXTO" in cleaned_prompt:
-            logging.info("✓ Context sections detected in prompt")
-        if "etiqueta" in cleaned_prompt.lower():
-            logging.info("✓ Tags/labels detected in prompt") 
-        if len(cleaned_text) > 1000:
-            logging.info(f"✓ Substantial content detected: {len(cleaned_text)} characters")
-        
-        # Verify full prompt context is included
-        context_indicators = [
-            ("PERFIL REGULATORIO", "✓ Regulatory profile context included"),
-            ("ETIQUETA SELECCIONADA", "✓ Selected tag context included"),
-            ("IDIOMA DE RESPUESTA", "✓ Language preference included"),
-            ("Formato de salida", "✓ Output format instructions included")
-        ]
-        
-        for indicator, message in context_indicators:
-            if indicator in cleaned_prompt:
-                logging.info(message)
-        
-        # Log content sample to verify encoding
-        if cleaned_text and len(cleaned_text) > 100:
-            content_sample = cleaned_text[:100]
-            # Check for both uppercase and lowercase accented characters
-            if any(char in content_sample for char in ['í', 'ó', 'ñ', 'á', 'é', 'ú', 'Á', 'É', 'Í', 'Ó', 'Ú', 'Ñ']):
-                logging.info("✓ Spanish accented characters detected in content (good encoding)")
-            elif any(seq in content_sample for seq in ['Ã­', 'Ã³', 'Ã±', 'Ã¡', 'Ã©', 'Ã', 'Ã‰', '�']):
-                logging.warning("⚠ Problematic encoding detected in content sample")
-            else:
-                logging.info("Content sample without special characters")
-        
-        # Final verification: total input size
-        total_input_size = len(f"{cleaned_prompt}:\n\n{cleaned_text}")
-        logging.info(f"✓ Total input to Gemini: {total_input_size} characters (no truncation)")
+        logging.info(f"Fetching HTML page from: {html_url}{' (conditional)' if cached else ''}")
+        page = fetch_html(html_url, headers=headers)
+        return _text_from_page(html_url, cached, page)
+    except Exception as e:
+        return _text_fetch_error(cached, e, kind='HTML')
 
-        # Use the most direct and stable configuration for determinism
-        generation_config = genai.GenerationConfig(
-            candidate_count=1,
-            temperature=0.0,
-            top_p=1.0,
-            top_k=1
-        )
+async def get_html_text_async(html_url):
+    """Async get_html_text over the pooled httpx client; parsing runs in a worker thread."""
+    cached, headers, text = await asyncio.to_thread(_lookup_text_cache, html_url)
+    if text is not None:
+        return text
+    try:
+        logging.info(f"Fetching HTML page from: {html_url}{' (conditional)' if cached else ''}")
+        page = await fetch_html_async(html_url, _get_http_client(), headers=headers)
+        return await asyncio.to_thread(_text_from_page, html_url, cached, page)
+    except Exception as e:
+        return _text_fetch_error(cached, e, kind='HTML')
 
-        # Set safety settings to be less restrictive to reduce variability
-        safety_settings = {
-            'HARM_CATEGORY_HARASSMENT': 'BLOCK_ONLY_HIGH',
-            'HARM_CATEGORY_HATE_SPEECH': 'BLOCK_ONLY_HIGH',
-            'HARM_CATEGORY_SEXUALLY_EXPLICIT': 'BLOCK_ONLY_HIGH',
-            'HARM_CATEGORY_DANGEROUS_CONTENT': 'BLOCK_ONLY_HIGH',
-        }
+def load_document_text(content_info):
+    """Returns ``(text, error_code)`` for a content source; exactly one of them is None.
 
-        logging.info(f"Using generation config: {generation_config} and safety_settings: {safety_settings}")
+    For url_pdf / url_html failures get_pdf_text / get_html_text have already
+    reported PDF_ACCESS_ERROR / HTML_ACCESS_ERROR.
+    """
+    if content_info["type"] == "contenido":
+        # Priority 1: Use direct text content from database
+        logging.info("Using direct text content from 'contenido' field")
+        return clean_text_for_processing(content_info["content"]), None
+    if content_info["type"] == "url_pdf":
+        # Priority 2: Download and extract text from PDF
+        logging.info("Using PDF URL to extract text")
+        _mark('download_pdf_start')
+        text = get_pdf_text(content_info["url"])
+        _mark('download_pdf_end')
+        if not text:
+            logging.error("Failed to extract text from PDF")
+            return None, "PDF_ACCESS_ERROR"
+        return text, None
+    if content_info["type"] == "url_html":
+        # Priority 3: Fetch the web page and extract its text
+        logging.info("Using HTML URL to extract text")
+        _mark('download_html_start')
+        text = get_html_text(content_info["url"])
+        _mark('download_html_end')
+        if not text:
+            logging.error("Failed to extract text from HTML page")
+            return None, "HTML_ACCESS_ERROR"
+        return text, None
+    logging.error(f"Unknown content type: {content_info['type']}")
+    return None, "UNKNOWN_CONTENT_TYPE"
 
+async def load_document_text_async(content_info):
+    """Async load_document_text: PDFs and web pages go through the pooled async client, text cleaning runs off the loop."""
+    if content_info["type"] == "url_html":
+        logging.info("Using HTML URL to extract text")
+        _mark('download_html_start')
+        text = await get_html_text_async(content_info["url"])
+        _mark('download_html_end')
+        if not text:
+            logging.error("Failed to extract text from HTML page")
+            return None, "HTML_ACCESS_ERROR"
+        return text, None
+    if content_info["type"] != "url_pdf":
+        return await asyncio.to_thread(load_document_text, content_info)
+    logging.info("Using PDF URL to extract text")
+    _mark('download_pdf_start')
+    text = await get_pdf_text_async(content_info["url"])
+    _mark('download_pdf_end')
+    if not text:
+        logging.error("Failed to extract text from PDF")
+        return None, "PDF_ACCESS_ERROR"
+    return text, None
+
+def clean_text_for_processing(text):
+    """Clean text to remove invalid Unicode characters and fix encoding issues dynamically."""
+    # Shared single-pass implementation (see text_normalizer.py / bench_text_normalizer.py)
+    return normalize_text(text)
+
+
+def _generate(contents, generation_config, safety_settings, on_delta=None):
+    """Runs one Gemini call and returns the raw response text (streaming chunks to ``on_delta`` if given)."""
+    if on_delta is None:
         response = model.generate_content(
-            f"{cleaned_prompt}:\n\n{cleaned_text}",
+            contents,
             generation_config=generation_config,
             safety_settings=safety_settings
         )
-        
-        logging.info("Gemini API call successful")
-        if response.text:
-            response_hash = hashlib.md5(response.text.encode('utf-8')).hexdigest()
-            logging.info(f"Response received. Length: {len(response.text)}, Hash: {response_hash}")
-            
-            # Fix encoding issues in the response from Gemini
-            fixed_response = clean_text_for_processing(response.text)
-            
-            # Check if we fixed any encoding issues
-            if fixed_response != response.text:
-                logging.info("✓ Fixed encoding issues in Gemini response")
-            else:
-                logging.info("✓ Response encoding is correct")
-            
-            return fixed_response
+        _record_token_usage(response)
+        return response.text
 
+    response = model.generate_content(
+        contents,
+        generation_config=generation_config,
+        safety_settings=safety_settings,
+        stream=True
+    )
+    parts = []
+    for chunk in response:
+        _consume_stream_chunk(chunk, parts, on_delta)
+    _record_token_usage(response)
+    return "".join(parts)
+
+async def _generate_async(contents, generation_config, safety_settings, on_delta=None):
+    """Async _generate on generate_content_async (the gRPC channel lives on the shared event loop)."""
+    if on_delta is None:
+        response = await model.generate_content_async(
+            contents,
+            generation_config=generation_config,
+            safety_settings=safety_settings
+        )
+        _record_token_usage(response)
         return response.text
+
+    response = await model.generate_content_async(
+        contents,
+        generation_config=generation_config,
+        safety_settings=safety_settings,
+        stream=True
+    )
+    parts = []
+    async for chunk in response:
+        _consume_stream_chunk(chunk, parts, on_delta)
+    _record_token_usage(response)
+    return "".join(parts)
+
+def _consume_stream_chunk(chunk, parts, on_delta):
+    """Appends a streamed chunk's text to ``parts`` and forwards it to ``on_delta``."""
+    try:
+        chunk_text = chunk.text
+    except ValueError:
+        # Chunks without text parts (e.g. the final finish_reason chunk)
+        return
+    if not chunk_text:
+        return
+    if not parts:
+        _mark('gemini_first_token')
+        logging.info("✓ First streamed chunk received from Gemini")
+    parts.append(chunk_text)
+    on_delta(_clean_stream_delta(chunk_text))
+
+def _record_token_usage(response):
+    """Adds the call's token counts (when the SDK reports them) to the current request record."""
+    usage = getattr(response, 'usage_metadata', None)
+    if usage is not None:
+        perf_metrics.add(
+            model_calls=1,
+            prompt_tokens=getattr(usage, 'prompt_token_count', 0),
+            output_tokens=getattr(usage, 'candidates_token_count', 0)
+        )
+
+def _ask_gemini_map_reduce(cleaned_text, cleaned_prompt, generation_config, safety_settings, on_delta=None):
+    """Map: extract notes from each section concurrently. Reduce: answer the prompt from the notes."""
+    chunks = split_into_chunks(cleaned_text, MAP_REDUCE_CHUNK_TOKENS)
+    total = len(chunks)
+    logging.info(f"Map-reduce mode: {total} sections of <= {MAP_REDUCE_CHUNK_TOKENS} tokens, concurrency {MAP_REDUCE_CONCURRENCY}")
+    _mark('map_reduce_split')
+    perf_metrics.set_fields(map_reduce_sections=total)
+    timer = perf_metrics.current()
+
+    def _map(index, chunk):
+        # Token counts of map calls go to the request that started them
+        perf_metrics.bind(timer)
+        map_prompt = MAP_PROMPT_TEMPLATE.format(index=index, total=total, prompt=cleaned_prompt)
+        with _map_semaphore:
+            try:
+                notes = _generate(f"{map_prompt}:\n\n{chunk}", generation_config, safety_settings)
+                logging.info(f"Map section {index}/{total}: {len(chunk)} chars -> {len(notes or '')} chars of notes")
+                return notes
+            except Exception as e:
+                logging.warning(f"Map section {index}/{total} failed: {e}")
+                return None
+
+    with ThreadPoolExecutor(max_workers=min(MAP_REDUCE_CONCURRENCY, total)) as pool:
+        notes = list(pool.map(_map, range(1, total + 1), chunks))
+    _mark('map_phase')
+
+    failed = sum(1 for n in notes if not n)
+    if failed == total:
+        raise RuntimeError("All map-reduce sections failed")
+    if failed:
+        logging.warning(f"{failed}/{total} sections produced no notes; reducing over the rest")
+
+    combined = "\n\n".join(
+        f"=== Sección {i} de {total} ===\n{section_notes}" for i, section_notes in enumerate(notes, 1) if section_notes
+    )
+    reduce_input = f"{REDUCE_CONTEXT_HEADER.format(total=total)}\n\n{combined}"
+    logging.info(f"Reduce input: {len(reduce_input)} characters from {total - failed} sections")
+    response_text = _generate(f"{cleaned_prompt}:\n\n{reduce_input}", generation_config, safety_settings, on_delta)
+    _mark('reduce_phase')
+    return response_text
+
+def _prepare_gemini_request(text, prompt):
+    """Cleans text and prompt, logs the context checks and builds the call parameters.
+
+    Returns a dict with the call ``contents``, the cleaned inputs, generation config, safety
+    settings, the chosen mode (``use_map_reduce``), the response cache key and the cached
+    response (None on a miss). Shared by ask_gemini and ask_gemini_async.
+    """
+    # Clean the text and prompt before processing
+    cleaned_text = clean_text_for_processing(text)
+    cleaned_prompt = clean_text_for_processing(prompt)
+
+    content_hash = hashlib.md5(f"{cleaned_prompt}:{cleaned_text}".encode('utf-8')).hexdigest()
+    logging.info(f"Processing content with hash: {content_hash}")
+    logging.info(f"Prompt length: {len(cleaned_prompt)} chars, Content length: {len(cleaned_text)} chars")
+    logging.info(f"Sending prompt to Gemini: {cleaned_prompt[:200]}...")
+
+    # Log a sample of the content to verify it includes context
+    if "CONTEXTO" in cleaned_prompt:
+        logging.info("✓ Context sections detected in prompt")
+    if "etiqueta" in cleaned_prompt.lower():
+        logging.info("✓ Tags/labels detected in prompt") 
+    if len(cleaned_text) > 1000:
+        logging.info(f"✓ Substantial content detected: {len(cleaned_text)} characters")
+
+    # Verify full prompt context is included
+    context_indicators = [
+        ("PERFIL REGULATORIO", "✓ Regulatory profile context included"),
+        ("ETIQUETA SELECCIONADA", "✓ Selected tag context included"),
+        ("IDIOMA DE RESPUESTA", "✓ Language preference included"),
+        ("Formato de salida", "✓ Output format instructions included")
+    ]
+
+    for indicator, message in context_indicators:
+        if indicator in cleaned_prompt:
+            logging.info(message)
+
+    # Log content sample to verify encoding
+    if cleaned_text and len(cleaned_text) > 100:
+        content_sample = cleaned_text[:100]
+        # Check for both uppercase and lowercase accented characters
+        if any(char in content_sample for char in ['í', 'ó', 'ñ', 'á', 'é', 'ú', 'Á', 'É', 'Í', 'Ó', 'Ú', 'Ñ']):
+            logging.info("✓ Spanish accented characters detected in content (good encoding)")
+        elif any(seq in content_sample for seq in ['Ã­', 'Ã³', 'Ã±', 'Ã¡', 'Ã©', 'Ã', 'Ã‰', '�']):
+            logging.warning("⚠ Problematic encoding detected in content sample")
+        else:
+            logging.info("Content sample without special characters")
+
+    # Final verification: total input size
+    total_input_size = len(f"{cleaned_prompt}:\n\n{cleaned_text}")
+    use_map_reduce = MAP_REDUCE_ENABLED and estimate_tokens(cleaned_prompt) + estimate_tokens(cleaned_text) >= MAP_REDUCE_MIN_TOKENS
+    if use_map_reduce:
+        logging.info(f"✓ Total input to Gemini: {total_input_size} characters (map-reduce over sections, no truncation)")
+    else:
+        logging.info(f"✓ Total input to Gemini: {total_input_size} characters (no truncation)")
+    perf_metrics.set_fields(doc_chars=len(cleaned_text), prompt_chars=len(cleaned_prompt), mode="map_reduce" if use_map_reduce else "single")
+
+    # Use the most direct and stable configuration for determinism
+    generation_params = {
+        'candidate_count': 1,
+        'temperature': 0.0,
+        'top_p': 1.0,
+        'top_k': 1
+    }
+    generation_config = genai.GenerationConfig(**generation_params)
+
+    # Set safety settings to be less restrictive to reduce variability
+    safety_settings = {
+        'HARM_CATEGORY_HARASSMENT': 'BLOCK_ONLY_HIGH',
+        'HARM_CATEGORY_HATE_SPEECH': 'BLOCK_ONLY_HIGH',
+        'HARM_CATEGORY_SEXUALLY_EXPLICIT': 'BLOCK_ONLY_HIGH',
+        'HARM_CATEGORY_DANGEROUS_CONTENT': 'BLOCK_ONLY_HIGH',
+    }
+
+    logging.info(f"Using generation config: {generation_config} and safety_settings: {safety_settings}")
+
+    cache_key = None
+    cached_response = None
+    if _response_cache is not None:
+        cache_params = dict(generation_params, map_reduce_chunk_tokens=MAP_REDUCE_CHUNK_TOKENS) if use_map_reduce else generation_params
+        cache_key = GeminiResponseCache.make_key(content_hash, GEMINI_MODEL_NAME, cache_params, safety_settings)
+        cached_response = _response_cache.get(cache_key)
+        if cached_response is not None:
+            logging.info(f"✓ Gemini cache HIT for hash {content_hash} ({len(cached_response)} chars)")
+            perf_metrics.set_fields(gemini_cache="hit")
+        else:
+            logging.info(f"Gemini cache MISS for hash {content_hash}")
+            perf_metrics.set_fields(gemini_cache="miss")
+
+    return {
+        "contents": f"{cleaned_prompt}:\n\n{cleaned_text}",
+        "cleaned_text": cleaned_text,
+        "cleaned_prompt": cleaned_prompt,
+        "generation_config": generation_config,
+        "safety_settings": safety_settings,
+        "use_map_reduce": use_map_reduce,
+        "cache_key": cache_key,
+        "cached_response": cached_response,
+    }
+
+def _finalize_gemini_response(response_text, cache_key):
+    """Normalises the model response and stores it in the response cache."""
+    logging.info("Gemini API call successful")
+    if response_text:
+        response_hash = hashlib.md5(response_text.encode('utf-8')).hexdigest()
+        logging.info(f"Response received. Length: {len(response_text)}, Hash: {response_hash}")
+
+        # Fix encoding issues in the response from Gemini
+        fixed_response = clean_text_for_processing(response_text)
+
+        # Check if we fixed any encoding issues
+        if fixed_response != response_text:
+            logging.info("✓ Fixed encoding issues in Gemini response")
+        else:
+            logging.info("✓ Response encoding is correct")
+
+        if cache_key is not None:
+            _response_cache.put(cache_key, fixed_response)
+
+        return fixed_response
+
+    return response_text
+
+def _emit_cached_response(cached_response, on_delta):
+    if on_delta is not None:
+        _mark('gemini_first_token')
+        on_delta(cached_response)
+    return cached_response
+
+def ask_gemini(text, prompt, on_delta=None):
+    """Asks Gemini a question about the text and returns the response.
+
+    When ``on_delta`` is given the response is generated in streaming mode and each
+    chunk is passed to ``on_delta`` as soon as it arrives; the full (cleaned) response
+    is still returned at the end.
+    """
+    if not model:
+        logging.error("Gemini model is not initialized. Cannot ask Gemini.")
+        return None
+    try:
+        request = _prepare_gemini_request(text, prompt)
+        if request["cached_response"] is not None:
+            return _emit_cached_response(request["cached_response"], on_delta)
+
+        if request["use_map_reduce"]:
+            response_text = _ask_gemini_map_reduce(
+                request["cleaned_text"], request["cleaned_prompt"],
+                request["generation_config"], request["safety_settings"], on_delta
+            )
+        else:
+            response_text = _generate(request["contents"], request["generation_config"], request["safety_settings"], on_delta)
+        return _finalize_gemini_response(response_text, request["cache_key"])
     except Exception as e:
         logging.exception(f"Error querying Gemini: {e}")
         return None
 
-def main(document_id, user_prompt, collection_name, html_content=None): # Added html_content parameter
-    """Main function to connect, retrieve PDF URL, extract text, and ask Gemini."""
-    _mark('script_start')
-    logging.info(f"Starting main function with document_id: {document_id}")
-    
+async def ask_gemini_async(text, prompt, on_delta=None):
+    """Async ask_gemini. Input cleaning, response normalisation and the (thread-based)
+    map-reduce mode run in worker threads; single calls use generate_content_async."""
+    if not model:
+        logging.error("Gemini model is not initialized. Cannot ask Gemini.")
+        return None
+    try:
+        request = await asyncio.to_thread(_prepare_gemini_request, text, prompt)
+        if request["cached_response"] is not None:
+            return _emit_cached_response(request["cached_response"], on_delta)
+
+        if request["use_map_reduce"]:
+            response_text = await asyncio.to_thread(
+                _ask_gemini_map_reduce,
+                request["cleaned_text"], request["cleaned_prompt"],
+                request["generation_config"], request["safety_settings"], on_delta
+            )
+        else:
+            response_text = await _generate_async(request["contents"], request["generation_config"], request["safety_settings"], on_delta)
+        return await asyncio.to_thread(_finalize_gemini_response, response_text, request["cache_key"])
+    except Exception as e:
+        logging.exception(f"Error querying Gemini: {e}")
+        return None
+
+async def _warm_up_gemini_async():
+    """Opens Gemini's async channel when the shared event loop starts.
+
+    count_tokens goes through the same async client as generate_content, so the TLS/gRPC
+    setup is paid once here, overlapped with the first request's Mongo/download, instead
+    of inside its Gemini call. Later requests reuse the open channel.
+    """
+    try:
+        await model.count_tokens_async("ping")
+    except Exception as e:
+        logging.warning(f"Gemini warm-up failed (continuing without it): {e}")
+
+_OUTPUT_DONE = object()
+
+def main(document_id, user_prompt, collection_name, html_content=None, stream=False): # Added html_content parameter
+    """Main function to connect, retrieve PDF URL, extract text, and ask Gemini.
+
+    With ``stream=True`` the output is NDJSON: ``{"type": "delta", "text": ...}`` frames
+    while Gemini generates, then ``{"type": "done", "text": ..., "timings": {...}}``
+    (or ``{"type": "error", ...}``).
+
+    Thin synchronous wrapper around main_async: the pipeline runs on the shared event
+    loop and this thread prints its output lines as they are produced, so worker-mode
+    capture and streaming see them on the calling thread.
+    """
     # Set stdout to use utf-8 encoding at the beginning to handle all outputs
     sys.stdout.reconfigure(encoding='utf-8', errors='replace')
     # Also configure stderr for consistency
     sys.stderr.reconfigure(encoding='utf-8', errors='replace')
-    
+
+    lines = queue.Queue()
+    future = asyncio.run_coroutine_threadsafe(
+        main_async(document_id, user_prompt, collection_name, html_content, stream, write=lines.put),
+        _get_event_loop()
+    )
+    future.add_done_callback(lambda _: lines.put(_OUTPUT_DONE))
+    cancellation = analysis_worker.current_cancellation()
+    if cancellation is not None:
+        # Worker mode: stop the pipeline once no request waits for it any more
+        cancellation.add_callback(future.cancel)
+    while True:
+        line = lines.get()
+        if line is _OUTPUT_DONE:
+            break
+        print(line, flush=True)
+    future.result()
+
+async def main_async(document_id, user_prompt, collection_name, html_content=None, stream=False, write=None):
+    """Async pipeline behind main(). ``write`` receives each output line (default: print).
+
+    Every run emits one timing record (see perf_metrics.py), whichever path it exits on.
+    """
+    # Timer and output mode are per task, so concurrent requests on the loop don't mix
+    rss_start_mb = current_rss_mb()
+    timer = perf_metrics.start_request(
+        "questionsMongo",
+        document_id=document_id,
+        collection=collection_name,
+        source="html_content" if html_content else None,
+        stream=stream,
+        ok=False,
+        rss_start_mb=rss_start_mb,
+        peak_rss_mb=rss_start_mb
+    )
+    _output_var.set(_RequestOutput(stream=stream, write=write))
+    try:
+        _mark('script_start')
+        logging.info(f"Starting main function with document_id: {document_id}")
+        await _analyze_document_async(document_id, user_prompt, collection_name, html_content, stream)
+    finally:
+        sample_rss(timer)
+        timer.finish()
+
+async def _analyze_document_async(document_id, user_prompt, collection_name, html_content, stream):
     # If HTML content is provided directly, use it instead of fetching from MongoDB
     if html_content:
         logging.info("Using provided HTML content for analysis")
-        text = clean_text_for_processing(html_content)
+        text = await asyncio.to_thread(clean_text_for_processing, html_content)
     else:
         _mark('mongo_connect_start')
-        db = connect_to_mongodb()
+        db = connect_to_mongodb_async()
         _mark('mongo_connect_end')
         if db is None:
             logging.error("Failed to connect to MongoDB")
+            perf_metrics.set_fields(error="DB_CONNECTION_ERROR")
+            if stream:
+                _report_error("DB_CONNECTION_ERROR")
             return
 
         _mark('fetch_content_start')
-        content_info = get_pdf_url_from_mongodb(db, collection_name, document_id)
+        content_info = await get_pdf_url_from_mongodb_async(db, collection_name, document_id)
         _mark('fetch_content_end')
         if not content_info:
             logging.warning("No content sources found for document")
+            perf_metrics.set_fields(error="NO_CONTENT_SOURCE")
+            if stream:
+                _report_error("NO_CONTENT_SOURCE")
             return
 
         # Handle different content types based on priority
-        if content_info["type"] == "contenido":
-            # Priority 1: Use direct text content from database
-            logging.info("Using direct text content from 'contenido' field")
-            text = clean_text_for_processing(content_info["content"])
-        elif content_info["type"] == "url_pdf":
-            # Priority 2: Download and extract text from PDF
-            logging.info("Using PDF URL to extract text")
-            _mark('download_pdf_start')
-            raw_text = download_and_extract_text_from_pdf(content_info["url"])
-            _mark('download_pdf_end')
-            if not raw_text:
-                logging.error("Failed to extract text from PDF")
-                return
-            text = clean_text_for_processing(raw_text)
-        elif content_info["type"] == "url_html":
-            # Priority 3: For HTML URLs, we need to inform the caller to handle webscraping
-            logging.info("HTML URL found - this should be handled by webscraping in the frontend")
-            # For now, this case should not happen as the frontend handles HTML URLs
-            # through the webscraping endpoint before calling this script
-            logging.warning("HTML URL handling not implemented in this script")
-            return
-        else:
-            logging.error(f"Unknown content type: {content_info['type']}")
+        perf_metrics.set_fields(source=content_info["type"])
+        text, error_code = await load_document_text_async(content_info)
+        if error_code:
+            perf_metrics.set_fields(error=error_code)
+            # get_pdf_text / get_html_text already reported the access error
+            if stream and error_code not in ("PDF_ACCESS_ERROR", "HTML_ACCESS_ERROR"):
+                _report_error(error_code)
             return
 
     # Validate that we have usable text content
     if not text or len(text.strip()) < 10:
         logging.error(f"Insufficient text content after cleaning: {len(text) if text else 0} characters")
-        print(json.dumps({
+        perf_metrics.set_fields(error="INSUFFICIENT_CONTENT")
+        if stream:
+            _report_error("INSUFFICIENT_CONTENT", "Error: El documento no contiene suficiente texto para analizar.")
+            return
+        _write_line(json.dumps({
             "error": "INSUFFICIENT_CONTENT", 
             "message": "Error: El documento no contiene suficiente texto para analizar."
         }))
         return
 
     _mark('gemini_call_start')
-    response_text = ask_gemini(text, user_prompt)
+    on_delta = (lambda delta: _emit_frame({"type": "delta", "text": delta})) if stream else None
+    response_text = await ask_gemini_async(text, user_prompt, on_delta=on_delta)
     _mark('gemini_call_end')
+    perf_metrics.set_fields(ok=response_text is not None)
 
-    if response_text is not None:
+    if stream:
+        if response_text is None:
+            _report_error("GEMINI_NO_RESPONSE", "Error: Gemini did not respond.")
+    elif response_text is not None:
         # Ensure proper UTF-8 output encoding
         try:
             # Make sure we're outputting valid UTF-8
             if isinstance(response_text, str):
                 # Verify the string is valid UTF-8
                 response_text.encode('utf-8')
-                print(response_text, flush=True)
+                _write_line(response_text)
             else:
-                print(str(response_text), flush=True)
+                _write_line(str(response_text))
         except UnicodeEncodeError as e:
             logging.error(f"UTF-8 encoding error in response: {e}")
             # Try to fix encoding issues in the response
             try:
                 fixed_response = response_text.encode('utf-8', errors='replace').decode('utf-8')
-                print(fixed_response, flush=True)
+                _write_line(fixed_response)
             except:
-                print("Error: Response contains invalid characters", flush=True)
+                _write_line("Error: Response contains invalid characters")
     else:
-        print("Error: Gemini did not respond.", flush=True)
+        _write_line("Error: Gemini did not respond.")
 
     # Final timing output
     _mark('script_end')
+    _timings = perf_metrics.current().marks
     if len(_timings) > 1:
         base = _timings[0][1]
         logging.info("\n=== PERFORMANCE TIMINGS (ms) ===")
@@ -465,14 +1110,168 @@ def main(document_id, user_prompt, collection_name, html_content=None): # Added
         total_ms = (_timings[-1][1] - base) * 1000
         logging.info("-"*50)
         logging.info(f"{'TOTAL':35} | {total_ms:8.1f}")
+        request_rss = perf_metrics.current().fields.get('peak_rss_mb')
+        if request_rss is not None:
+            logging.info(f"{'Peak RSS (MB, this request)':35} | {request_rss:8.1f}")
+        rss = peak_rss_mb()
+        if rss is not None:
+            logging.info(f"{'Peak RSS (MB, process lifetime)':35} | {rss:8.1f}")
+        fetch_fields = perf_metrics.current().fields
+        if fetch_fields.get('mongo_bytes') is not None:
+            logging.info(f"{'Mongo KB fetched / stored':35} | {fetch_fields['mongo_bytes'] / 1024:.1f} / {(fetch_fields.get('mongo_document_bytes') or 0) / 1024:.1f}")
+        if _response_cache is not None:
+            cache_stats = _response_cache.stats()
+            logging.info(f"{'Gemini cache hits / misses':35} | {cache_stats['hits']} / {cache_stats['misses']} (hit rate {cache_stats['hit_rate']:.0%})")
+        if _text_cache is not None:
+            text_stats = _text_cache.stats()
+            logging.info(f"{'Text cache hits / misses':35} | {text_stats['hits']} / {text_stats['misses']}")
+
+    if stream and response_text is not None:
+        # Final frame carries the fully normalised response, which supersedes the deltas
+        _emit_frame({"type": "done", "text": response_text, "timings": _timings_as_dict()})
+
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", "4"))
+
+def _analyze_batch_item(index, item, content_info):
+    """Runs one batch item on a pool thread and returns its result frame (never raises)."""
+    timer = perf_metrics.start_request(
+        "questionsMongo.batch",
+        document_id=item.get("document_id"),
+        collection=item.get("collection_name"),
+        ok=False
+    )
+    output_token = _output_var.set(_RequestOutput(batch=True))
+    _mark('item_start')
+    _record_fetch_sizes(content_info)
+    frame = {"type": "result", "index": index, "document_id": item.get("document_id"),
+             "collection_name": item.get("collection_name")}
+    try:
+        if item.get("html_content"):
+            text, error_code = clean_text_for_processing(item["html_content"]), None
+        elif content_info is None:
+            text, error_code = None, "NO_CONTENT_SOURCE"
+        else:
+            text, error_code = load_document_text(content_info)
+
+        if not error_code and (not text or len(text.strip()) < 10):
+            error_code = "INSUFFICIENT_CONTENT"
+        if not error_code:
+            _mark('gemini_call_start')
+            response_text = ask_gemini(text, item.get("user_prompt") or "Realiza un resumen")
+            _mark('gemini_call_end')
+            if response_text is None:
+                error_code = "GEMINI_NO_RESPONSE"
+            else:
+                frame.update(ok=True, text=response_text)
+        if error_code:
+            frame.update(ok=False, error=error_code)
+    except Exception as e:
+        logging.exception(f"Batch item {index} ({item.get('document_id')}) failed: {e}")
+        frame.update(ok=False, error="INTERNAL_ERROR", message=str(e))
+    finally:
+        _output_var.reset(output_token)
+    frame["timings"] = _timings_as_dict()
+    timer.finish(ok=frame["ok"], error=frame.get("error"))
+    return frame
+
+def run_batch(items, concurrency=None):
+    """Analyses many (document_id, collection_name, user_prompt) items in one process.
+
+    Documents are fetched with one $in query per collection, then each item is analysed
+    on a thread pool of ``concurrency`` (default BATCH_CONCURRENCY) Gemini calls. A
+    ``{"type": "result", "index": ..., "ok": ...}`` frame is printed per item as soon as
+    it finishes (completion order), followed by one ``{"type": "batch_done", ...}`` summary.
+    A failing item only fails its own frame.
+    """
+    started = time.perf_counter()
+    concurrency = max(1, concurrency or BATCH_CONCURRENCY)
+    items = [item if isinstance(item, dict) else {} for item in items]
+    for item in items:
+        item.setdefault("collection_name", "BOE")
+
+    # One round trip per collection for every item that needs its document
+    sources = {}
+    failed_collections = {}
+    wanted = {}
+    for item in items:
+        if item.get("document_id") and not item.get("html_content"):
+            wanted.setdefault(item["collection_name"], set()).add(item["document_id"])
+    if wanted:
+        db = connect_to_mongodb()
+        for collection_name, ids in wanted.items():
+            if db is None:
+                failed_collections[collection_name] = "DB_CONNECTION_ERROR"
+                continue
+            try:
+                for id_value, content_info in get_content_sources_from_mongodb(db, collection_name, ids).items():
+                    sources[(collection_name, id_value)] = content_info
+            except Exception as e:
+                logging.exception(f"Error fetching batch documents from '{collection_name}': {e}")
+                failed_collections[collection_name] = "DB_QUERY_ERROR"
+    fetch_ms = round((time.perf_counter() - started) * 1000, 1)
+
+    succeeded = 0
+    with ThreadPoolExecutor(max_workers=min(concurrency, max(1, len(items)))) as pool:
+        futures = []
+        for index, item in enumerate(items):
+            collection_name = item["collection_name"]
+            if not item.get("document_id") and not item.get("html_content"):
+                _emit_frame({"type": "result", "index": index, "ok": False, "error": "INVALID_ITEM"})
+            elif collection_name in failed_collections and not item.get("html_content"):
+                _emit_frame({"type": "result", "index": index, "document_id": item["document_id"],
+                             "collection_name": collection_name, "ok": False, "error": failed_collections[collection_name]})
+            elif not item.get("html_content") and (collection_name, item["document_id"]) not in sources:
+                logging.warning(f"Document with id '{item['document_id']}' not found.")
+                _emit_frame({"type": "result", "index": index, "document_id": item["document_id"],
+                             "collection_name": collection_name, "ok": False, "error": "DOCUMENT_NOT_FOUND"})
+            else:
+                content_info = sources.get((collection_name, item.get("document_id")))
+                futures.append(pool.submit(_analyze_batch_item, index, item, content_info))
+        for future in as_completed(futures):
+            frame = future.result()
+            succeeded += 1 if frame["ok"] else 0
+            _emit_frame(frame)
+
+    summary = {
+        "type": "batch_done",
+        "total": len(items),
+        "succeeded": succeeded,
+        "failed": len(items) - succeeded,
+        "fetch_ms": fetch_ms,
+        "duration_ms": round((time.perf_counter() - started) * 1000, 1),
+    }
+    logging.info(f"✓ Batch finished: {succeeded}/{len(items)} succeeded in {summary['duration_ms']} ms (fetch {fetch_ms} ms)")
+    _emit_frame(summary)
+    return summary
 
 if __name__ == "__main__":
     import sys
-    if len(sys.argv) > 1:
-        document_id = sys.argv[1]
+    # --stream may appear anywhere after the script name; strip it before positional parsing
+    stream = "--stream" in sys.argv[1:]
+    argv = [arg for arg in sys.argv if arg != "--stream"]
+    if len(argv) > 1 and argv[1] == "--worker":
+        # Long-lived mode: load once, serve framed JSON requests (see analysis_worker.py)
+        if not GEMINI_WARMUP:
+            GEMINI_WARMUP_ENABLED = True
+        sys.exit(analysis_worker.run_worker(main, __file__, argv[2:]))
+    elif len(argv) > 1 and argv[1] == "--batch":
+        # Batch mode: stdin is {"items": [{"document_id", "collection_name", "user_prompt"}, ...], "concurrency": N}
+        sys.stdout.reconfigure(encoding='utf-8', errors='replace')
+        sys.stderr.reconfigure(encoding='utf-8', errors='replace')
+        try:
+            data = json.loads(sys.stdin.read())
+        except json.JSONDecodeError as e:
+            logging.error(f"Error parsing batch stdin data: {e}")
+            _emit_frame({"type": "error", "error": "INVALID_BATCH", "message": str(e)})
+            sys.exit(1)
+        if isinstance(data, list):
+            data = {"items": data}
+        run_batch(data.get("items") or [], data.get("concurrency"))
+    elif len(argv) > 1:
+        document_id = argv[1]
         
         # Check if we should read from stdin (when user_prompt is "--stdin")
-        if len(sys.argv) > 2 and sys.argv[2] == "--stdin":
+        if len(argv) > 2 and argv[2] == "--stdin":
             # Read JSON data from stdin
             try:
                 stdin_data = sys.stdin.read()
@@ -480,6 +1279,7 @@ if __name__ == "__main__":
                 user_prompt = data.get("user_prompt", "Realiza un resumen")
                 collection_name = data.get("collection_name", "BOE")
                 html_content = data.get("html_content")
+                stream = stream or bool(data.get("stream"))
             except (json.JSONDecodeError, AttributeError) as e:
                 logging.error(f"Error parsing stdin data: {e}")
                 user_prompt = "Realiza un resumen"
@@ -487,10 +1287,10 @@ if __name__ == "__main__":
                 html_content = None
         else:
             # Use command line arguments as before
-            user_prompt = sys.argv[2] if len(sys.argv) > 2 else "Realiza un resumen" # added get user prompt
-            collection_name = sys.argv[3] if len(sys.argv) > 3 else "BOE"
-            html_content = sys.argv[4] if len(sys.argv) > 4 else None # added html_content parameter
+            user_prompt = argv[2] if len(argv) > 2 else "Realiza un resumen" # added get user prompt
+            collection_name = argv[3] if len(argv) > 3 else "BOE"
+            html_content = argv[4] if len(argv) > 4 else None # added html_content parameter
             
-        main(document_id, user_prompt, collection_name, html_content) # call main with html_content
+        main(document_id, user_prompt, collection_name, html_content, stream=stream) # call main with html_content
     else:
         logging.warning("No document_id provided when running directly.")
\ No newline at end of file
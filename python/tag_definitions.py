@@ -0,0 +1,138 @@
+"""
+Resolves the definitions of users' custom tags (users.etiquetas_personalizadas).
+
+Documents selected in the marketing flow carry etiquetas_personalizadas as
+{userId: {tagName: {explicacion, nivel_impacto}}}, and every tag needs the
+definition its owner wrote. TagDefinitionResolver collects the userIds of all
+documents at once, fetches the ones it does not know yet in a single $in query
+(projected to etiquetas_personalizadas) and indexes each user's definitions by
+exact and normalised name, so every tag is a dictionary lookup.
+
+Resolved users stay in a process-level TTL cache (TAG_DEFINITIONS_TTL_SECONDS), which
+a long-running worker shares across requests.
+"""
+
+import logging
+import os
+import re
+import threading
+import time
+
+from bson import ObjectId
+from bson.errors import InvalidId
+
+DEFAULT_TTL_SECONDS = float(os.getenv("TAG_DEFINITIONS_TTL_SECONDS", "300"))
+
+
+def normalize_tag(tag):
+    """Normalises a tag name for case-insensitive matching and trimming."""
+    return re.sub(r"\s+", " ", tag.strip().lower()) if isinstance(tag, str) else tag
+
+
+class UserTagDefinitions:
+    """One user's tag definitions, indexed by exact and normalised name."""
+
+    def __init__(self, definitions=None):
+        self.definitions = definitions if isinstance(definitions, dict) else {}
+        self._normalized = {}
+        for name, definition in self.definitions.items():
+            # First match wins, like the previous linear scan
+            self._normalized.setdefault(normalize_tag(name), definition)
+
+    def __len__(self):
+        return len(self.definitions)
+
+    def keys(self):
+        return self.definitions.keys()
+
+    def get(self, tag_name):
+        """Definition of ``tag_name`` (exact name first, then case/space-insensitive), or ''."""
+        if tag_name in self.definitions:
+            return self.definitions[tag_name]
+        return self._normalized.get(normalize_tag(tag_name), '')
+
+
+EMPTY = UserTagDefinitions()
+
+
+def user_ids_in(documents):
+    """userIds referenced by the (nested-format) etiquetas_personalizadas of ``documents``."""
+    user_ids = []
+    seen = set()
+    for doc in documents:
+        tags = doc.get('etiquetas_personalizadas')
+        if isinstance(tags, dict):
+            for user_id in tags:
+                if user_id not in seen:
+                    seen.add(user_id)
+                    user_ids.append(user_id)
+    return user_ids
+
+
+class TagDefinitionResolver:
+    """Batched, TTL-cached lookup of users' tag definitions. Thread-safe."""
+
+    def __init__(self, get_db, ttl_seconds=DEFAULT_TTL_SECONDS):
+        # Callable returning the pymongo database (shared client), or None when unavailable
+        self._get_db = get_db
+        self.ttl_seconds = ttl_seconds
+        self._cache = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def resolve(self, user_ids):
+        """Returns ``{user_id: UserTagDefinitions}`` for every id, with at most one query."""
+        now = time.monotonic()
+        result = {}
+        missing = []
+        with self._lock:
+            for user_id in user_ids:
+                entry = self._cache.get(user_id)
+                if entry is not None and entry[0] > now:
+                    result[user_id] = entry[1]
+                    self.hits += 1
+                else:
+                    missing.append(user_id)
+                    self.misses += 1
+        if missing:
+            result.update(self._fetch(missing, now))
+        logging.info(f"[TAG_DEF] Definiciones para {len(result)} usuarios ({len(result) - len(missing)} de caché, {len(missing)} consultados)")
+        return result
+
+    def _fetch(self, user_ids, now):
+        object_ids = {}
+        fetched = {}
+        for user_id in user_ids:
+            try:
+                object_ids[ObjectId(user_id)] = user_id
+            except (InvalidId, TypeError):
+                logging.warning(f"[TAG_DEF] userId no válido: {user_id}")
+                fetched[user_id] = EMPTY
+        if object_ids:
+            db = self._get_db()
+            if db is None:
+                logging.warning("[TAG_DEF] No se pudo conectar a MongoDB, devolviendo vacío")
+                # Not cached: the next request tries again
+                return {user_id: EMPTY for user_id in user_ids}
+            try:
+                cursor = db['users'].find({"_id": {"$in": list(object_ids)}}, {"etiquetas_personalizadas": 1})
+                for user_doc in cursor:
+                    user_id = object_ids[user_doc["_id"]]
+                    fetched[user_id] = UserTagDefinitions(user_doc.get('etiquetas_personalizadas'))
+            except Exception as e:
+                logging.error(f"[TAG_DEF] Error al buscar definiciones de usuario: {e}")
+                return {user_id: fetched.get(user_id, EMPTY) for user_id in user_ids}
+            for user_id in object_ids.values():
+                if user_id not in fetched:
+                    logging.warning(f"[TAG_DEF] No se encontró el usuario {user_id} en la colección users")
+                    fetched[user_id] = EMPTY
+        expires_at = now + self.ttl_seconds
+        with self._lock:
+            for user_id, definitions in fetched.items():
+                self._cache[user_id] = (expires_at, definitions)
+        return fetched
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
@@ -0,0 +1,99 @@
+"""
+Tests for json_stream.JsonStringFieldDecoder.
+
+Run from the repository root with:
+    python -m unittest discover -s python/tests
+"""
+
+import json
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from json_stream import JsonStringFieldDecoder  # noqa: E402
+
+
+def decode(chunks, key="html_content"):
+    """Feeds ``chunks`` to a fresh decoder; returns ``(streamed text, decoder)``."""
+    decoder = JsonStringFieldDecoder(key)
+    return "".join(decoder.feed(chunk) for chunk in chunks), decoder
+
+
+def every_split(text):
+    """All ways of cutting ``text`` into two chunks, plus one chunk per character."""
+    for i in range(len(text) + 1):
+        yield [text[:i], text[i:]]
+    yield list(text)
+
+
+class JsonStringFieldDecoderTest(unittest.TestCase):
+
+    def assertStreams(self, document, key="html_content"):
+        """The streamed text equals json.loads' value for every way of chunking ``document``."""
+        expected = json.loads(document)[key]
+        for chunks in every_split(document):
+            text, decoder = decode(chunks, key)
+            self.assertEqual(text, expected, chunks)
+            self.assertTrue(decoder.done, chunks)
+
+    def test_plain_value(self):
+        self.assertStreams('{"html_content": "<h2>Nueva ley</h2><p>Entra en vigor</p>"}')
+
+    def test_simple_escapes(self):
+        self.assertStreams(r'{"html_content": "a\"b\\c\/d\ne\rf\tg\bh\fi"}')
+
+    def test_unicode_escapes(self):
+        self.assertStreams(r'{"html_content": "Regulaci\u00f3n \u00e1mbito \u20ac"}')
+
+    def test_surrogate_pair_split_across_chunks(self):
+        # U+1F600 is written as the pair \ud83d\ude00; every cut inside either escape must work
+        self.assertStreams(r'{"html_content": "antes \ud83d\ude00 despu\u00e9s"}')
+
+    def test_surrogate_pair_between_chunks(self):
+        text, decoder = decode(['{"html_content": "\\ud83d', '\\ude00"}'])
+        self.assertEqual(text, "\U0001F600")
+        self.assertTrue(decoder.done)
+
+    def test_escape_held_back_until_complete(self):
+        decoder = JsonStringFieldDecoder("html_content")
+        self.assertEqual(decoder.feed('{"html_content": "ab\\u00'), "ab")
+        self.assertEqual(decoder.feed('e9c'), "éc")
+        self.assertEqual(decoder.feed('\\'), "")
+        self.assertEqual(decoder.feed('n"}'), "\n")
+        self.assertTrue(decoder.done)
+
+    def test_lone_surrogates_are_dropped(self):
+        text, _ = decode([r'{"html_content": "a\ud83db\ude00c"}'])
+        self.assertEqual(text, "abc")
+
+    def test_code_fences_and_other_keys(self):
+        document = '```json\n{"title": "html_content", "tags": ["a", {"html_content": "x"}], "html_content": "<p>ok</p>"}\n```'
+        for chunks in every_split(document):
+            text, decoder = decode(chunks)
+            self.assertEqual(text, "<p>ok</p>", chunks)
+            self.assertTrue(decoder.done)
+
+    def test_nested_key_is_ignored(self):
+        text, decoder = decode(['{"meta": {"html_content": "nested"}, "other": 1}'])
+        self.assertEqual(text, "")
+        self.assertFalse(decoder.done)
+
+    def test_escaped_quote_in_preceding_string(self):
+        self.assertStreams(r'{"note": "say \"html_content\": \"no\"", "html_content": "yes"}')
+
+    def test_non_string_value(self):
+        text, decoder = decode(['{"html_content": null, "x": "y"}'])
+        self.assertEqual(text, "")
+        self.assertFalse(decoder.done)
+
+    def test_input_after_value_is_ignored(self):
+        decoder = JsonStringFieldDecoder("html_content")
+        self.assertEqual(decoder.feed('{"html_content": "a"'), "a")
+        self.assertTrue(decoder.done)
+        self.assertEqual(decoder.feed(', "html_content": "b"}'), "")
+
+
+if __name__ == "__main__":
+    unittest.main()
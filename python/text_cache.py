@@ -0,0 +1,194 @@
+"""
+On-disk cache for text extracted from remote documents (PDF, HTML).
+
+Each URL is stored as a single gzip-compressed JSON file holding the cleaned
+text plus the ETag / Last-Modified validators returned by the server, so the
+next request can revalidate with a conditional GET instead of downloading and
+re-parsing the whole document.
+
+The cache is safe to share between concurrent worker processes on the same
+host: entries are written to a temp file and atomically renamed into place,
+writers and the evictor coordinate through fcntl file locks, and least recently
+used entries (by file mtime) are evicted once the directory exceeds its size cap.
+"""
+
+import gzip
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import time
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows: atomic renames still apply, locks become no-ops
+    fcntl = None
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.cache', 'extracted_text')
+ENTRY_SUFFIX = '.json.gz'
+
+
+@contextmanager
+def _file_lock(lock_path, blocking=True):
+    """Exclusive advisory lock on ``lock_path``. Yields False if non-blocking and already held."""
+    if fcntl is None:
+        yield True
+        return
+    fd = os.open(lock_path, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+    finally:
+        os.close(fd)
+
+
+class DiskTextCache:
+    """URL-keyed, size-capped LRU cache of extracted text stored as compressed files."""
+
+    def __init__(self, directory=DEFAULT_CACHE_DIR, max_bytes=500 * 1024 * 1024, max_age_seconds=24 * 3600):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        # Entries without validators are served without revalidation for this long
+        self.max_age_seconds = max_age_seconds
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(self.directory, exist_ok=True)
+
+    @staticmethod
+    def key_for(url):
+        return hashlib.sha256(url.encode('utf-8')).hexdigest()
+
+    def _entry_path(self, key):
+        return os.path.join(self.directory, key + ENTRY_SUFFIX)
+
+    def get(self, url):
+        """Returns the cached entry dict (text, etag, last_modified, stored_at) or None.
+
+        Lookups are not counted: an entry may still be stale and re-downloaded, so callers
+        record() the outcome once they know whether the cached text was served.
+        """
+        path = self._entry_path(self.key_for(url))
+        try:
+            with gzip.open(path, 'rt', encoding='utf-8') as f:
+                entry = json.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            logging.warning(f"Discarding unreadable text cache entry for {url}: {e}")
+            self._remove(path)
+            return None
+        if entry.get('url') != url:
+            return None
+        return entry
+
+    def record(self, served):
+        """Counts a hit when the cached text was served (fresh, 304 or stale on error), a miss otherwise."""
+        if served:
+            self.hits += 1
+        else:
+            self.misses += 1
+
+    def is_fresh(self, entry):
+        """Entries without validators can only be trusted for ``max_age_seconds``."""
+        if entry.get('etag') or entry.get('last_modified'):
+            return False
+        return time.time() - entry.get('stored_at', 0) < self.max_age_seconds
+
+    def touch(self, url):
+        """Marks the entry as recently used (LRU order is the file mtime)."""
+        try:
+            os.utime(self._entry_path(self.key_for(url)))
+        except OSError:
+            pass
+
+    def put(self, url, text, etag=None, last_modified=None):
+        """Atomically writes the entry for ``url`` and evicts old entries above the size cap."""
+        if not text:
+            return
+        key = self.key_for(url)
+        entry = {
+            'url': url,
+            'text': text,
+            'etag': etag,
+            'last_modified': last_modified,
+            'stored_at': time.time(),
+        }
+        try:
+            with _file_lock(os.path.join(self.directory, key + '.lock')):
+                fd, tmp_path = tempfile.mkstemp(dir=self.directory, prefix='.tmp-', suffix=ENTRY_SUFFIX)
+                try:
+                    with os.fdopen(fd, 'wb') as raw, gzip.GzipFile(fileobj=raw, mode='wb', compresslevel=6) as gz:
+                        gz.write(json.dumps(entry, ensure_ascii=False).encode('utf-8'))
+                    os.replace(tmp_path, self._entry_path(key))
+                except BaseException:
+                    self._remove(tmp_path)
+                    raise
+            self.evict()
+        except OSError as e:
+            logging.warning(f"Could not write text cache entry for {url}: {e}")
+
+    def evict(self):
+        """Removes least recently used entries until the directory is under ``max_bytes``."""
+        with _file_lock(os.path.join(self.directory, '.evict.lock'), blocking=False) as acquired:
+            if not acquired:
+                return  # Another process is already evicting
+            entries = []
+            total = 0
+            for name in os.listdir(self.directory):
+                if not name.endswith(ENTRY_SUFFIX) or name.startswith('.tmp-'):
+                    continue
+                path = os.path.join(self.directory, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, path))
+                total += st.st_size
+            if total <= self.max_bytes:
+                return
+            entries.sort()
+            removed = 0
+            for _, size, path in entries:
+                if total <= self.max_bytes:
+                    break
+                # The entry's .lock file stays: another process may hold it or be waiting on
+                # it, and a recreated file would let two writers lock different inodes
+                self._remove(path)
+                total -= size
+                removed += 1
+            logging.info(f"Text cache eviction: removed {removed} entries, {total / 1024 / 1024:.1f} MB remaining")
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses}
+
+
+def text_cache_from_env():
+    """Builds the process-wide cache from TEXT_CACHE_* env vars, or None when disabled."""
+    if os.getenv('TEXT_CACHE_ENABLED', 'true').strip().lower() not in ('1', 'true', 'yes', 'on'):
+        logging.info("Extracted-text cache disabled (TEXT_CACHE_ENABLED)")
+        return None
+    try:
+        return DiskTextCache(
+            directory=os.getenv('TEXT_CACHE_DIR', DEFAULT_CACHE_DIR),
+            max_bytes=int(os.getenv('TEXT_CACHE_MAX_MB', '500')) * 1024 * 1024,
+            max_age_seconds=int(os.getenv('TEXT_CACHE_MAX_AGE_SECONDS', str(24 * 3600))),
+        )
+    except OSError as e:
+        logging.warning(f"Extracted-text cache unavailable: {e}")
+        return None
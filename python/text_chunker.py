@@ -0,0 +1,77 @@
+"""
+Splits long legal texts into token-bounded sections for map-reduce analysis.
+
+Sections are cut along the structure of Spanish legislation (TÍTULO, CAPÍTULO,
+Sección, Artículo, Disposición adicional/transitoria/derogatoria/final, ANEXO)
+and packed greedily up to the token budget. A single section larger than the
+budget falls back to paragraph and then line boundaries, and only as a last
+resort to a hard cut.
+
+Token counts are estimated from characters (~4 chars per token for Spanish
+text); this only needs to be conservative, not exact.
+"""
+
+import re
+
+CHARS_PER_TOKEN = 4
+
+_HEADING = re.compile(
+    r'^[ \t]*(?:'
+    r'T[ÍI]TULO\b|CAP[ÍI]TULO\b|SECCI[ÓO]N\b|Secci[óo]n\s+\d|'
+    r'Art[íi]culo\s+\d|Art\.\s*\d|'
+    r'Disposici[óo]n(?:es)?\s+(?:adicional|transitoria|derogatoria|final)|DISPOSICI[ÓO]N|'
+    r'ANEXO\b|Anexo\s+[IVXLC\d]'
+    r')',
+    re.MULTILINE,
+)
+
+
+def estimate_tokens(text):
+    return len(text) // CHARS_PER_TOKEN + 1
+
+
+def _split_at_headings(text):
+    """Splits ``text`` into sections that each start at a heading (the first may be a preamble)."""
+    starts = [m.start() for m in _HEADING.finditer(text)]
+    if not starts or starts[0] != 0:
+        starts.insert(0, 0)
+    starts.append(len(text))
+    sections = (text[start:end] for start, end in zip(starts, starts[1:]))
+    return [section for section in sections if section.strip()]
+
+
+def _split_oversized(section, max_chars):
+    """Splits a section that alone exceeds ``max_chars`` on paragraphs, then lines, then hard cuts."""
+    for separator in ('\n\n', '\n'):
+        pieces = section.split(separator)
+        if len(pieces) > 1 and all(len(p) <= max_chars for p in pieces):
+            pieces = [p + separator for p in pieces[:-1]] + [pieces[-1]]
+            return _pack(pieces, max_chars)
+    return [section[i:i + max_chars] for i in range(0, len(section), max_chars)]
+
+
+def _pack(pieces, max_chars):
+    chunks = []
+    current = ''
+    for piece in pieces:
+        if current and len(current) + len(piece) > max_chars:
+            chunks.append(current)
+            current = ''
+        current += piece
+    if current.strip():
+        chunks.append(current)
+    return chunks
+
+
+def split_into_chunks(text, max_tokens):
+    """Returns chunks of at most ``max_tokens`` (estimated), cut on legal structure where possible."""
+    max_chars = max_tokens * CHARS_PER_TOKEN
+    if len(text) <= max_chars:
+        return [text]
+    pieces = []
+    for section in _split_at_headings(text):
+        if len(section) > max_chars:
+            pieces.extend(_split_oversized(section, max_chars))
+        else:
+            pieces.append(section)
+    return _pack(pieces, max_chars)
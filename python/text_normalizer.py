@@ -0,0 +1,94 @@
+"""
+Shared text normalisation for documents, prompts and model responses.
+
+One implementation used by questionsMongo.py, marketing.py and the Evals
+scraper. It produces the same output as the original clean_text_for_processing
+but does far less work on megabyte-sized BOE/BOA texts:
+
+- patterns are compiled once at import time instead of on every call;
+- surrogates, BOM and control characters are removed in a single regex pass
+  (instead of a per-character generator join plus two more passes);
+- the mojibake repair (latin-1 round trip) only runs when the text contains 'Ã',
+  the lead character of every double-encoded Spanish accent;
+- NFC normalisation is skipped when the text is already NFC;
+- whitespace runs are only rewritten where the replacement changes something.
+
+See bench_text_normalizer.py for the before/after throughput on real gazette text.
+"""
+
+import logging
+import re
+import unicodedata
+
+# Lead character of UTF-8 accents mis-decoded as Latin-1 (Ã¡, Ã©, Ã±, ...)
+MOJIBAKE_LEAD = 'Ã'
+
+# Surrogates (invalid in UTF-8), BOM and control characters except \t \n \r
+_STRIP_CHARS = re.compile(r'[\ud800-\udfff\ufeff\x00-\x08\x0b\x0c\x0e-\x1f\x7f]')
+# Runs of spaces/tabs that collapse to a single space (a lone space is left untouched)
+_SPACE_RUNS = re.compile(r'\t[ \t]*| [ \t]+')
+
+
+def repair_double_encoding(text):
+    """Fixes UTF-8 text that was decoded as Latin-1. Returns the input unchanged if not applicable."""
+    if MOJIBAKE_LEAD not in text:
+        return text
+    logging.info("Detected double UTF-8 encoding, attempting to fix...")
+    try:
+        text = text.encode('latin-1').decode('utf-8')
+        logging.info("Successfully fixed double UTF-8 encoding")
+    except (UnicodeDecodeError, UnicodeEncodeError):
+        logging.warning("Could not fix double encoding, proceeding with original text")
+    return text
+
+
+def clean_fragment(text):
+    """Cheap cleaning for partial text (streamed chunks): no repair, NFC, whitespace or strip."""
+    return _STRIP_CHARS.sub('', text.replace('\ufffd', "'"))
+
+
+def decode_bytes(data):
+    """Decodes bytes as UTF-8, falling back to Latin-1."""
+    try:
+        return data.decode('utf-8')
+    except UnicodeDecodeError:
+        return data.decode('latin-1')
+
+
+def normalize_text(text):
+    """Cleans text to remove invalid Unicode characters and fix encoding issues.
+
+    Equivalent to the original clean_text_for_processing: repair double encoding,
+    map U+FFFD to an apostrophe, drop surrogates/BOM/control characters, NFC-normalise,
+    collapse spaces and tabs, normalise CRLF and strip.
+    """
+    if not text:
+        return ""
+    if isinstance(text, bytes):
+        text = decode_bytes(text)
+
+    original_length = len(text)
+    try:
+        text = repair_double_encoding(text)
+
+        # Keep context: replacement characters become apostrophes rather than disappearing
+        if '\ufffd' in text:
+            logging.info("Detected Unicode replacement characters; replacing with apostrophes to avoid losing context")
+            text = text.replace('\ufffd', "'")
+
+        text = _STRIP_CHARS.sub('', text)
+        if not unicodedata.is_normalized('NFC', text):
+            text = unicodedata.normalize('NFC', text)
+        text = _SPACE_RUNS.sub(' ', text)
+        text = text.replace('\r\n', '\n').strip()
+    except Exception as e:
+        logging.error(f"Error in normalize_text: {e}")
+        return text
+
+    final_length = len(text)
+    if final_length != original_length:
+        logging.info(f"Text length changed from {original_length} to {final_length} characters")
+    # If we lost more than 10% of content
+    if final_length < original_length * 0.9:
+        logging.warning(f"Significant text cleaning performed: {original_length} -> {final_length} characters")
+    return text
@@ -4,6 +4,8 @@ Endpoints:
 - POST '/api/save-generation-settings' (auth): guarda ajustes por lista
 - POST '/api/get-generation-settings' (auth): obtiene ajustes por lista
 - POST '/api/generate-marketing-content' (auth): genera contenido de marketing vía Python
+  (con body.stream === true responde NDJSON: frames delta con el HTML según se genera y un frame done/error final;
+  con body.documentTypes = ['newsletter', 'linkedin', ...] genera todos los formatos en una sola pasada y responde { success, formats: { formato: { success, content | error } } })
 */
 const express = require('express');
 const { MongoClient, ObjectId } = require('mongodb');
@@ -142,7 +144,7 @@ router.post('/api/get-generation-settings', ensureAuthenticated, async (req, res
 router.post('/api/generate-marketing-content', ensureAuthenticated, async (req, res) => {
 	try {
 		const userEmail = req.user.email;
-		const { selectedDocuments, instructions, language, documentType, idioma, colorPalette } = req.body;
+		const { selectedDocuments, instructions, language, documentType, idioma, colorPalette, stream, documentTypes } = req.body;
 		if (!selectedDocuments || !Array.isArray(selectedDocuments) || selectedDocuments.length === 0) {
 			return res.status(400).json({ success: false, error: 'No se proporcionaron documentos válidos' });
 		}
@@ -193,7 +195,12 @@ router.post('/api/generate-marketing-content', ensureAuthenticated, async (req,
 		} finally {
 			await client.close();
 		}
-		const pythonInput = { documents: enrichedDocuments, instructions: safeInstructions, language: language || 'juridico', documentType: documentType || 'whatsapp', idioma: idioma || 'español' };
+		const wantsStream = stream === true;
+		const pythonInput = { documents: enrichedDocuments, instructions: safeInstructions, language: language || 'juridico', documentType: documentType || 'whatsapp', idioma: idioma || 'español', stream: wantsStream };
+		if (Array.isArray(documentTypes) && documentTypes.length > 0) {
+			// Varios formatos: Python enriquece los documentos una vez y genera los formatos en paralelo
+			pythonInput.documentTypes = documentTypes.filter(t => typeof t === 'string' && t);
+		}
 		// Intentar diferentes comandos de Python según el sistema
 		let pythonCommand = 'python3';
 		try {
@@ -214,6 +221,47 @@ router.post('/api/generate-marketing-content', ensureAuthenticated, async (req,
 		const pythonProcess = spawn(pythonCommand, [path.join(__dirname, '..', 'python', 'marketing.py')], { encoding: 'utf8', env: { ...process.env, PYTHONIOENCODING: 'utf-8' } });
 		pythonProcess.stdin.write(JSON.stringify(pythonInput));
 		pythonProcess.stdin.end();
+		if (wantsStream) {
+			// Python escribe un frame NDJSON por línea; se reenvían tal cual según llegan
+			res.setHeader('Content-Type', 'application/x-ndjson; charset=utf-8');
+			res.setHeader('Cache-Control', 'no-cache');
+			let finalFrameSent = false;
+			// Los chunks de stdout no coinciden con las líneas: se guarda la línea incompleta
+			let partialLine = '';
+			const checkFinalFrame = (line) => {
+				try {
+					const frame = JSON.parse(line);
+					if (frame && (frame.type === 'done' || frame.type === 'error')) finalFrameSent = true;
+				} catch (parseError) {
+					// Línea que no es un frame JSON (salida inesperada de Python)
+				}
+			};
+			pythonProcess.stdout.setEncoding('utf8');
+			pythonProcess.stderr.setEncoding('utf8');
+			pythonProcess.stdout.on('data', (data) => {
+				res.write(data);
+				const lines = (partialLine + data).split('\n');
+				partialLine = lines.pop();
+				lines.forEach(checkFinalFrame);
+			});
+			pythonProcess.stderr.on('data', (data) => { console.log(data.toString('utf8')); });
+			pythonProcess.on('close', (code) => {
+				if (partialLine.trim()) checkFinalFrame(partialLine);
+				if (!finalFrameSent) {
+					console.error(`Python script exited with code ${code} without a final frame`);
+					// Cerrar la línea a medias para que el frame de error sea una línea NDJSON válida
+					if (partialLine) res.write('\n');
+					res.write(JSON.stringify({ type: 'error', error: 'PYTHON_SCRIPT_ERROR', message: 'Error: Ocurrió un error inesperado al procesar la respuesta del análisis. Prueba de nuevo por favor' }) + '\n');
+				}
+				res.end();
+			});
+			pythonProcess.on('error', (error) => {
+				console.error('Error spawning Python process:', error);
+				finalFrameSent = true;
+				res.end(JSON.stringify({ type: 'error', error: 'Error al iniciar el generador de contenido', details: error.message }) + '\n');
+			});
+			return;
+		}
 		let pythonOutput = '';
 		let pythonError = '';
 		pythonProcess.stdout.setEncoding('utf8');
@@ -245,7 +293,10 @@ router.post('/api/generate-marketing-content', ensureAuthenticated, async (req,
 						}
 					}
 					
-					if (jsonResult.html_content) {
+					if (jsonResult.formats) {
+						// Varios formatos: resultado por formato
+						return res.status(jsonResult.success ? 200 : 500).json({ success: !!jsonResult.success, formats: jsonResult.formats, error: jsonResult.error });
+					} else if (jsonResult.html_content) {
 						// Nuevo formato esperado
 						return res.json({ success: true, content: jsonResult.html_content });
 					} else if (jsonResult.html_response) {